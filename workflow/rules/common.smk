@@ -1,14 +1,12 @@
 #!/usr/bin/env python3
 
+import csv
+import json
 import os
+import re
 import subprocess
-import pandas as pd
 
 
-if clusterMode == "gcp" or useRemoteFiles:
-    from snakemake.remote.GS import RemoteProvider as GSRemoteProvider
-    GS = GSRemoteProvider()
-
 # The pipeline will terminate with an error without .bai files
 # The assumption is enforced in input to DV, HC and Strelka2 calling rules
 # NOT USED
@@ -17,11 +15,13 @@ def get_samples(samplesFile):
         bamList = [line.rstrip() for line in f]
     return(bamList)
 
-# read in the samples file, we assume that they are in this order: sample\tbam/cram\tindex    
-def read_samplesFile(samplesFile): 
-    samplesTable = pd.read_table(samplesFile, sep="\t", 
-                   header='infer', dtype=str)
-    return(samplesTable)
+# read in the samples file, we assume that they are in this order: sample\tbam/cram\tindex
+# returns {column name: [values]}, read with csv rather than pandas to keep startup fast
+def read_samplesFile(samplesFile):
+    with open(samplesFile, newline="") as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    header, rows = rows[0], [row for row in rows[1:] if row]
+    return {name: [row[i] if i < len(row) else "" for row in rows] for i, name in enumerate(header)}
 
 
 def get_sm_tag(bam): 
@@ -45,6 +45,78 @@ def path_sanitize(path):
     else:
         return path  
 
+def temp_unless(keep, path):
+    """path, marked temp() unless it is kept as a deliverable."""
+    return path if keep else temp(path)
+
+# compression policy (the compression section of the config) for the files written by each
+# stage class: "temp" for intermediates, "final" for deliverables.  format is bcf (BCF in
+# level 0, stored, BGZF blocks) or bgzf1..bgzf9 (BGZF at that level); threads 0 means the workflow's threads setting
+COMPRESSION_DEFAULTS = {
+    "temp": {"format": "bgzf1", "threads": 1},
+    "final": {"format": "bgzf6", "threads": 0},
+}
+
+def compression_policy(stage):
+    """(format, threads) of the compression policy of a stage class ("temp" or "final")."""
+    policy = dict(COMPRESSION_DEFAULTS[stage], **(compression.get(stage) or {}))
+    fmt = str(policy["format"]).lower()
+    if fmt != "bcf" and not re.fullmatch("bgzf[0-9]", fmt):
+        raise ValueError("compression: " + stage + ": format must be bcf or bgzf0 to bgzf9, not " + fmt)
+    return fmt, int(policy["threads"]) or threads
+
+def compression_threads(stage):
+    """Threads to give a rule compressing a stage class's output."""
+    return compression_policy(stage)[1]
+
+def bgzf_level(stage):
+    """BGZF level of a stage class; bcf stands for level 1 where the output must be a BGZF VCF."""
+    fmt = compression_policy(stage)[0]
+    return 1 if fmt == "bcf" else int(fmt[4:])
+
+def bcftools_write(stage, out, bcf=False, through=None):
+    """bcftools output options (and bgzip pipe) writing out, a VCF or with bcf a BCF file,
+    as the compression policy of its stage class says.  A VCF can be piped through a shell
+    filter (through) on its way to bgzip.  The bcf format writes level 0 BGZF (-Ob0), not
+    plain uncompressed BCF (-Ou), so that the output can still be indexed.
+    """
+    fmt, n = compression_policy(stage)
+    if bcf and fmt == "bcf":
+        return " -Ob0 -o " + out
+    pipe = " | " + through if through else ""
+    return (" -Ou" if bcf else " -Ov") + pipe + " | bgzip -c -l " + str(bgzf_level(stage)) + " -@ " + str(n) + " > " + out
+
+# stage class of the whole-genome per-caller VCFs, deliverables only with keep_caller_vcfs
+CALLER_VCF_STAGE = "final" if keep_caller_vcfs else "temp"
+
+def ordered_concat(fallback, out="{output.vcf}", vcfs="{input.vcf}", ref_dict="{input.dict}"):
+    """Shell command concatenating sorted, indexed vcfs of disjoint stretches of the genome into
+    out with concat_vcfs.py (block copy, no sort); fallback runs when they are not in .dict order (exit 3).
+    """
+    return (
+        "status=0; python3 scripts/concat_vcfs.py " + out + " " + vcfs + " --dict " + ref_dict
+        + " || status=$?; if [ $status -eq 3 ]; then " + fallback + "; else exit $status; fi"
+    )
+
+# with call_regions (and by_chrom_gvcf) the callers run on the regions that plan_call_regions
+# balances by the samples' reads, otherwise on one region per chromosome of chromList
+CALL_REGIONS_DIR = outputDir + "call_regions/"
+
+def call_region_bed(suffix=""):
+    """BED file of a calling region (the {region} wildcard), or its bgzipped copy with suffix."""
+    return (CALL_REGIONS_DIR if call_regions else outputDir + "split_regions/") + "{region}.bed" + suffix
+
+def call_region_names(wildcards=None):
+    """Calling regions, in reference order."""
+    if not call_regions:
+        return chromList
+    with open(os.path.join(checkpoints.plan_call_regions.get().output[0], "regions.tsv")) as f:
+        return [line.split("\t", 1)[0] for line in f if not line.startswith("#")]
+
+# GLnexus writes Number=. for Strelka2's per-allele depths; bcftools norm needs Number=R to split them.
+# One sed, which only tries the substitution on the header lines
+STRELKA2_HEADER_FIX = "sed -E '1,/^#CHROM/ s/ID=(AD|ADF|ADR),Number=\\.,/ID=\\1,Number=R,/'"
+
 def get_DBImport_path1(wildcards):
     return(glob.glob('HaplotypeCaller/DBImport/' +  wildcards.chrom + '/' + wildcards.chrom + '*/genomicsdb_meta_dir/genomicsdb_meta*.json'))
 
@@ -59,16 +131,33 @@ def get_DBImport_path2(wildcards):
 
 # read in chromosome list from reference dict file (assumes the dict is already created)
 # this circumvents the issue of whether to use hg19-style or b37-style chromosome annotation
-# as it just pulls the chromosome names directly from the dict index.    
-def get_chrom_names(dictionaryFile, bedFile):
+# as it just pulls the chromosome names directly from the dict index.
+# Only the chromosomes with regions in the bed file are kept (otherwise GATK gets an empty
+# interval file, which it doesn't like).  The bed file is read once for its set of contigs,
+# and the list is cached under the size and mtime of both files, so that status checks and
+# dry runs do not read them again.
+def get_chrom_names(dictionaryFile, bedFile, cache=".snakemake/chrom_names.json"):
+    key = [[os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in (dictionaryFile, bedFile)]
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["chroms"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    with open(bedFile) as f:
+        bedContigs = {fields[0] for fields in (line.split(None, 1) for line in f) if len(fields) > 1}
     chromList = []
     with open(dictionaryFile) as f:
-        next(f)
         for line in f:
-            f1 = line.split("\t")[1]
-            f2 = f1.split(":")[1]
-            # if hc_mode and not subprocess.call(['grep', '-q', '^' + f2 + ':', intervalFile]): # exclude chroms not in the regions of interest, otherwise creates an empty interval file which GATK doesn't like
-            # chromList.append(f2)
-            if not subprocess.call(['grep', '-q', '^' + f2 + '\\s', bedFile]):
-                chromList.append(f2)
-    return(chromList)   
+            if line.startswith("@SQ"):
+                name = [field[3:] for field in line.rstrip("\r\n").split("\t") if field.startswith("SN:")][0]
+                if name in bedContigs:
+                    chromList.append(name)
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(cache, "w") as f:
+            json.dump({"key": key, "chroms": chromList}, f)
+    except OSError:
+        pass
+    return(chromList)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks genotype_union.py on synthetic three-caller VCFs (see simulate_callers_vcf.py)
+and compares the results with a stored baseline.
+
+For each sample count the script simulates an input, runs genotype_union.py on it
+--repeat times and keeps the best throughput (records/s) and the largest peak memory
+(maximum resident set size).  The --pool-samples counts are also run with
+--pool-workers workers (cases named <samples>x<variants>w<workers>), so that a small
+cohort slowed down by the process pool shows up.  A case is a regression when its
+throughput drops, or its peak memory grows, by more than the tolerance relative to
+the baseline; the script then exits with status 1.  --update-baseline stores the
+results instead.
+
+    python3 benchmark_genotype_union.py --samples 10 100 500 --variants 2000
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from common import VcfWriter
+from simulate_callers_vcf import DEFAULT_MIX, parse_mix, simulate
+
+log = logging.getLogger("benchmark_genotype_union")
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(
+    SCRIPT_DIR, "..", "..", "tests", "benchmarks", "genotype_union_baseline.json"
+)
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Measure genotype_union.py throughput and memory on synthetic input and compare with a baseline."
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[10, 20, 100, 500],
+        help="Sample counts to benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--variants", type=int, default=2000, help="Records per input (default: %(default)s)"
+    )
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Caller-set mix of the inputs")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs per case; the best is kept (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="genotype_union.py --workers (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pool-samples",
+        type=int,
+        nargs="*",
+        default=[20],
+        help="Sample counts also benchmarked with --pool-workers (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pool-workers",
+        type=int,
+        default=4,
+        help="genotype_union.py --workers of the --pool-samples cases (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=DEFAULT_BASELINE,
+        help="Baseline results (default: tests/benchmarks/genotype_union_baseline.json)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative loss of throughput (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative growth of peak memory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Write the results to the baseline file instead of comparing with it",
+    )
+    parser.add_argument("--output", help="Also write the results (JSON) to this file")
+    parser.add_argument(
+        "--workdir",
+        help="Keep the simulated inputs here and reuse them in later runs (default: a temporary directory)",
+    )
+    return parser.parse_args()
+
+
+def case_name(n_samples, n_variants, workers=None):
+    name = str(n_samples) + "x" + str(n_variants)
+    return name + "w" + str(workers) if workers else name
+
+
+def simulated_input(workdir, n_samples, n_variants, mix):
+    """Simulate the input of a case (unless workdir already has it); returns its name."""
+    mix_id = "%08x" % zlib.crc32(mix.encode())
+    fname = os.path.join(
+        workdir, "sim_" + case_name(n_samples, n_variants) + "_" + mix_id + ".vcf.gz"
+    )
+    if not os.path.exists(fname + ".tbi"):
+        out = VcfWriter(fname)
+        simulate(out, n_samples, n_variants, parse_mix(mix))
+        out.close()
+    return fname
+
+
+def run_once(infile, outfile, workers):
+    """Run genotype_union.py once; returns (wall seconds, peak RSS in MB), or None if it failed."""
+    command = [
+        sys.executable,
+        os.path.join(SCRIPT_DIR, "genotype_union.py"),
+        infile,
+        outfile,
+        "--workers",
+        str(workers),
+    ]
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, stderr=subprocess.PIPE)
+    stderr = proc.stderr.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.stderr.close()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        log.error("%s failed:\n%s", " ".join(command), stderr.decode().rstrip())
+        return None
+    return wall, usage.ru_maxrss / 1024
+
+
+def run_case(workdir, n_samples, n_variants, mix, repeat, workers):
+    """Benchmark one sample count; returns its results, or None if a run failed."""
+    infile = simulated_input(workdir, n_samples, n_variants, mix)
+    outfile = os.path.join(workdir, "out_" + case_name(n_samples, n_variants, workers) + ".vcf.gz")
+    runs = []
+    for _ in range(repeat):
+        result = run_once(infile, outfile, workers)
+        if result is None:
+            return None
+        runs.append(result)
+    wall = min(w for w, _ in runs)
+    return {
+        "samples": n_samples,
+        "variants": n_variants,
+        "workers": workers,
+        "seconds": round(wall, 3),
+        "records_per_second": round(n_variants / wall, 1),
+        "genotypes_per_second": round(n_variants * n_samples / wall, 1),
+        "peak_rss_mb": round(max(rss for _, rss in runs), 1),
+    }
+
+
+def scaling(cases, workers):
+    """Exponent k of time ~ samples^k between consecutive sample counts (1 is linear),
+    over the cases run with workers.
+    """
+    ordered = sorted(
+        (c for c in cases.values() if c.get("workers", workers) == workers),
+        key=lambda c: c["samples"],
+    )
+    exponents = {}
+    for a, b in zip(ordered, ordered[1:]):
+        if a["variants"] == b["variants"] and b["samples"] > a["samples"]:
+            name = str(a["samples"]) + "->" + str(b["samples"]) + " samples"
+            k = math.log(b["seconds"] / a["seconds"]) / math.log(b["samples"] / a["samples"])
+            exponents[name] = round(k, 3)
+    return exponents
+
+
+def compare(results, baseline, tolerance, memory_tolerance):
+    """Check each case against the baseline; returns a list of regression messages."""
+    regressions = []
+    for name, case in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            log.warning("No baseline for %s; not compared", name)
+            continue
+        speed = case["records_per_second"] / base["records_per_second"]
+        memory = case["peak_rss_mb"] / base["peak_rss_mb"]
+        log.info(
+            "%s: %.1f records/s (%+.0f%% vs baseline), peak RSS %.1f MB (%+.0f%%)",
+            name,
+            case["records_per_second"],
+            100 * (speed - 1),
+            case["peak_rss_mb"],
+            100 * (memory - 1),
+        )
+        if speed < 1 - tolerance:
+            regressions.append(
+                "%s: throughput %.1f records/s is %.0f%% below the baseline %.1f"
+                % (name, case["records_per_second"], 100 * (1 - speed), base["records_per_second"])
+            )
+        if memory > 1 + memory_tolerance:
+            regressions.append(
+                "%s: peak RSS %.1f MB is %.0f%% above the baseline %.1f"
+                % (name, case["peak_rss_mb"], 100 * (memory - 1), base["peak_rss_mb"])
+            )
+    return regressions
+
+
+def benchmark(args, workdir):
+    """Run all cases; returns the results, or 1 if a run failed."""
+    cases = {}
+    runs = [(n, args.workers, None) for n in args.samples]
+    runs += [(n, args.pool_workers, args.pool_workers) for n in args.pool_samples]
+    for n_samples, workers, suffix in runs:
+        case = run_case(workdir, n_samples, args.variants, args.mix, args.repeat, workers)
+        if case is None:
+            return 1
+        cases[case_name(n_samples, args.variants, suffix)] = case
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "workers": args.workers,
+        "repeat": args.repeat,
+        "mix": args.mix,
+        "cases": cases,
+        "scaling": scaling(cases, args.workers),
+    }
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = benchmark(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = benchmark(args, workdir)
+    if results == 1:
+        sys.exit(1)
+    for name, exponent in results["scaling"].items():
+        log.info("time ~ samples^%.2f for %s", exponent, name)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        log.info("Baseline written to %s", args.baseline)
+        sys.exit(0)
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, ValueError) as e:
+        log.error("Could not read the baseline %s: %s", args.baseline, e)
+        sys.exit(1)
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    for message in regressions:
+        log.error("PERFORMANCE REGRESSION %s", message)
+    if regressions:
+        sys.exit(1)
+    log.info("No performance regressions")
@@ -1 +1,1015 @@
 # Any Python script in the scripts folder will be able to import from this module.
+
+"""
+Shared helpers for the python scripts of the harmonization module.
+
+BGZF reading/writing and tabix/CSI index building are implemented here with
+the standard library only, so that scripts can read and write compressed,
+indexed VCFs without a separate bgzip/tabix pass.  BCF input requires pysam.
+
+VcfReader, VcfRecord and the stage helpers let several steps run on the same
+stream of records in one process:
+
+    reader = VcfReader("in.vcf.gz")
+    writer = VcfWriter("out.vcf.gz")
+    writer.write_header(reader.header)
+    write_records(chain_stages(reader, stage1, stage2), writer)
+    writer.close()
+"""
+
+import gzip
+import io
+import itertools
+import json
+import os
+import queue
+import re
+import stat
+import struct
+import sys
+import time
+import zlib
+
+# BGZF constants (see the SAM/BAM specification, section 4.1)
+BGZF_BLOCK_SIZE = 0xFF00  # maximum amount of uncompressed data per block, as in htslib
+BGZF_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# tabix configuration for VCF: format=2 (TBX_VCF), col_seq=1, col_beg=2, col_end=0, meta='#', skip=0
+TBX_VCF_CONF = (2, 1, 2, 0, ord("#"), 0)
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+TBI_MAX_LENGTH = 1 << (TBI_MIN_SHIFT + 3 * TBI_DEPTH)  # 2^29, the longest contig a .tbi can address
+
+_CONTIG_LENGTH = re.compile(rb"^##contig=<.*?ID=([^,>]+).*?[,<]length=(\d+)")
+_INFO_END = re.compile(rb"(?:^|;)END=(\d+)")
+_REGION = re.compile(r"^(.+):([\d,]+)(?:-([\d,]*))?$")
+
+
+############################################### BGZF ################################################
+
+
+def is_bgzf(fname):
+    """True if the file starts with a BGZF block header."""
+    with open(fname, "rb") as f:
+        head = f.read(16)
+    return len(head) == 16 and head[:4] == BGZF_HEADER[:4] and head[12:14] == b"BC"
+
+
+def read_bgzf_block(f):
+    """Read one raw BGZF block from an open binary file.
+    Returns the raw block bytes, or b"" at end of file.
+    """
+    head = f.read(18)
+    if not head:
+        return b""
+    if len(head) < 18 or head[:4] != BGZF_HEADER[:4]:
+        raise ValueError("Not a BGZF file (bad block header)")
+    xlen = struct.unpack("<H", head[10:12])[0]
+    if xlen != 6 or head[12:14] != b"BC":
+        # extra fields other than BC are legal but never written by htslib; fall back to a scan
+        extra = head[12:] + f.read(xlen - 6)
+        bsize = _find_bsize(extra)
+        rest = f.read(bsize + 1 - 12 - xlen)
+        return head[:12] + extra + rest
+    bsize = struct.unpack("<H", head[16:18])[0]
+    return head + f.read(bsize + 1 - 18)
+
+
+def _find_bsize(extra):
+    i = 0
+    while i + 4 <= len(extra):
+        si1, si2, slen = extra[i], extra[i + 1], struct.unpack("<H", extra[i + 2 : i + 4])[0]
+        if si1 == 66 and si2 == 67:
+            return struct.unpack("<H", extra[i + 4 : i + 6])[0]
+        i += 4 + slen
+    raise ValueError("Not a BGZF file (no BC extra field)")
+
+
+def inflate_bgzf_block(block):
+    """Decompress one raw BGZF block."""
+    xlen = struct.unpack("<H", block[10:12])[0]
+    data = zlib.decompress(block[12 + xlen : -8], -15)
+    if len(data) != struct.unpack("<I", block[-4:])[0]:
+        raise ValueError("Corrupt BGZF block (size mismatch)")
+    return data
+
+
+def deflate_bgzf_block(data, level=6):
+    """Compress up to BGZF_BLOCK_SIZE bytes into one raw BGZF block."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) > 0xFFFF - 26:
+        # incompressible input; store it instead
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    return (
+        BGZF_HEADER
+        + struct.pack("<H", len(cdata) + 25)
+        + cdata
+        + struct.pack("<II", zlib.crc32(data), len(data))
+    )
+
+
+def iter_bgzf_blocks(f):
+    """Yield (compressed offset, raw block) for each block of an open BGZF file."""
+    offset = f.tell()
+    while True:
+        block = read_bgzf_block(f)
+        if not block:
+            return
+        yield offset, block
+        offset += len(block)
+
+
+class BgzfWriter:
+    """Minimal BGZF writer.
+
+    Data is buffered into blocks of at most BGZF_BLOCK_SIZE bytes.  tell() returns the
+    virtual offset (compressed block offset << 16 | offset within block) of the next byte,
+    which is what tabix/CSI indices store.
+    """
+
+    def __init__(self, fileobj, level=6):
+        self.fileobj = fileobj
+        self.level = level
+        self.buffer = bytearray()
+        self.coffset = fileobj.tell() if fileobj.seekable() else 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def tell(self):
+        return (self.coffset << 16) | len(self.buffer)
+
+    def flush(self):
+        """End the current block."""
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _write_block(self, data):
+        block = deflate_bgzf_block(data, self.level)
+        self.fileobj.write(block)
+        self.coffset += len(block)
+
+    def close(self):
+        self.flush()
+        self.fileobj.write(BGZF_EOF)
+        self.fileobj.close()
+
+
+############################################### index ###############################################
+
+
+def reg2bin(beg, end, min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+    """Smallest bin containing the 0-based half-open interval [beg, end) (htslib hts_reg2bin)."""
+    end -= 1
+    s = min_shift
+    t = ((1 << (depth * 3)) - 1) // 7
+    for level in range(depth, 0, -1):
+        if beg >> s == end >> s:
+            return t + (beg >> s)
+        s += 3
+        t -= 1 << ((level - 1) * 3)
+    return 0
+
+
+def bin_first_position(b, min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+    """0-based start position of a bin."""
+    level = 0
+    t = 0
+    while b >= t + (1 << (level * 3)):
+        t += 1 << (level * 3)
+        level += 1
+    return (b - t) << (min_shift + 3 * (depth - level))
+
+
+def index_depth(max_length, min_shift=TBI_MIN_SHIFT):
+    """Number of binning levels needed to address contigs of max_length (as htslib does)."""
+    depth = 0
+    span = 1 << min_shift
+    while span < max_length:
+        span <<= 3
+        depth += 1
+    return max(depth, 1)
+
+
+def contig_lengths(header_lines):
+    """Map contig name to length from ##contig header lines (bytes or str)."""
+    lengths = {}
+    for line in header_lines:
+        if isinstance(line, str):
+            line = line.encode()
+        m = _CONTIG_LENGTH.match(line)
+        if m:
+            lengths[m.group(1).decode()] = int(m.group(2))
+    return lengths
+
+
+def record_span(fields):
+    """0-based [beg, end) of a split VCF record (CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, ...),
+    using INFO/END when present, as tabix does.
+    """
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    if len(fields) > 7 and b"END=" in fields[7]:
+        m = _INFO_END.search(fields[7])
+        if m:
+            end = max(end, int(m.group(1)))
+    return beg, end
+
+
+class VcfIndexer:
+    """Builds a .tbi or .csi index while a sorted BGZF VCF is written.
+
+    Call add() for every record with its contig, 0-based span and the virtual offsets of its
+    first byte and of the byte after it; write() then saves the index.  Contigs must be
+    contiguous and positions sorted within each contig, as for tabix.
+    """
+
+    def __init__(self, csi=False, min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+        self.csi = csi
+        self.min_shift = min_shift
+        self.depth = depth
+        self.names = []
+        self.refs = []
+        self.n_no_coor = 0
+        self._name = None
+        self._last_beg = -1
+        self._bin = None
+
+    @classmethod
+    def for_header(cls, header_lines, csi=None):
+        """Choose TBI or CSI (and the CSI depth) from the ##contig lengths of a header.
+        CSI is used when forced or when any contig is longer than a .tbi can address.
+        """
+        lengths = contig_lengths(header_lines)
+        longest = max(lengths.values(), default=0)
+        if csi is None:
+            csi = longest >= TBI_MAX_LENGTH
+        if not csi:
+            return cls()
+        return cls(csi=True, depth=max(TBI_DEPTH, index_depth(longest + 256)))
+
+    def add(self, name, beg, end, vstart, vend):
+        if name != self._name:
+            if name in self.names:
+                raise ValueError("Contig " + name + " is not contiguous; the file must be sorted")
+            self.names.append(name)
+            self.refs.append({"bins": {}, "lidx": [], "off_beg": vstart, "off_end": vend, "n": 0})
+            self._name = name
+            self._last_beg = -1
+            self._bin = None
+        elif beg < self._last_beg:
+            raise ValueError("Unsorted positions on contig " + name + " at " + str(beg + 1))
+        if end <= beg:
+            end = beg + 1
+        if self.depth == TBI_DEPTH and not self.csi and end > TBI_MAX_LENGTH:
+            raise ValueError("Position too large for a .tbi index; use a .csi index")
+        ref = self.refs[-1]
+        b = reg2bin(beg, end, self.min_shift, self.depth)
+        chunks = ref["bins"].setdefault(b, [])
+        if b == self._bin and chunks:
+            chunks[-1][1] = vend
+        else:
+            chunks.append([vstart, vend])
+        self._bin = b
+        lidx = ref["lidx"]
+        first, last = beg >> self.min_shift, (end - 1) >> self.min_shift
+        if last >= len(lidx):
+            lidx.extend([None] * (last + 1 - len(lidx)))
+        for w in range(first, last + 1):
+            if lidx[w] is None:
+                lidx[w] = vstart
+        ref["off_end"] = vend
+        ref["n"] += 1
+        self._last_beg = beg
+
+    def _filled_lidx(self, ref):
+        lidx = list(ref["lidx"])
+        prev = ref["off_beg"]
+        for i, off in enumerate(lidx):
+            if off is None:
+                lidx[i] = prev
+            else:
+                prev = off
+        return lidx
+
+    def _meta_bin(self):
+        return ((1 << (3 * self.depth + 3)) - 1) // 7 + 1
+
+    def _aux(self):
+        names = b"".join(n.encode() + b"\0" for n in self.names)
+        return struct.pack("<6i", *TBX_VCF_CONF) + struct.pack("<i", len(names)) + names
+
+    def serialize(self):
+        """Index contents, uncompressed."""
+        out = io.BytesIO()
+        if self.csi:
+            aux = self._aux()
+            out.write(b"CSI\x01" + struct.pack("<3i", self.min_shift, self.depth, len(aux)) + aux)
+        else:
+            out.write(b"TBI\x01" + struct.pack("<i", len(self.names)) + self._aux())
+        if self.csi:
+            out.write(struct.pack("<i", len(self.names)))
+        meta_bin = self._meta_bin()
+        for ref in self.refs:
+            lidx = self._filled_lidx(ref)
+            bins = sorted(ref["bins"].items())
+            out.write(struct.pack("<i", len(bins) + 1))
+            for b, chunks in bins:
+                if self.csi:
+                    if "loffs" in ref:
+                        loff = ref["loffs"][b]
+                    else:
+                        w = bin_first_position(b, self.min_shift, self.depth) >> self.min_shift
+                        loff = lidx[w] if w < len(lidx) else chunks[0][0]
+                    out.write(struct.pack("<IQi", b, loff, len(chunks)))
+                else:
+                    out.write(struct.pack("<Ii", b, len(chunks)))
+                for beg, end in chunks:
+                    out.write(struct.pack("<QQ", beg, end))
+            # pseudo-bin with the contig's offset range and record counts, as written by htslib
+            if self.csi:
+                out.write(struct.pack("<IQi", meta_bin, 0, 2))
+            else:
+                out.write(struct.pack("<Ii", meta_bin, 2))
+            out.write(struct.pack("<QQQQ", ref["off_beg"], ref["off_end"], ref["n"], 0))
+            if not self.csi:
+                out.write(struct.pack("<i", len(lidx)))
+                out.write(struct.pack("<%dQ" % len(lidx), *lidx))
+        out.write(struct.pack("<Q", self.n_no_coor))
+        return out.getvalue()
+
+    def write(self, fname):
+        """Save the index (BGZF-compressed, as htslib expects)."""
+        writer = BgzfWriter(open(fname, "wb"))
+        writer.write(self.serialize())
+        writer.close()
+
+
+def reg2bins(beg, end, min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+    """All bins overlapping the 0-based half-open interval [beg, end) (htslib reg2bins)."""
+    end = min(max(end, beg + 1), 1 << (min_shift + 3 * depth)) - 1
+    bins = []
+    for level in range(depth + 1):
+        t = ((1 << (level * 3)) - 1) // 7
+        s = min_shift + (depth - level) * 3
+        bins.extend(range(t + (beg >> s), t + (end >> s) + 1))
+    return bins
+
+
+class VcfIndex:
+    """A .tbi or .csi index read from disk, for random access to a BGZF VCF.
+    The contigs of a BCF's .csi, which has no names, are named by their number ("0", "1", ...).
+    """
+
+    def __init__(self, csi, min_shift, depth, names, refs):
+        self.csi = csi
+        self.min_shift = min_shift
+        self.depth = depth
+        self.names = names
+        self.refs = dict(zip(names, refs))
+        self.n_no_coor = 0
+
+    @classmethod
+    def read(cls, fname):
+        with gzip.open(fname, "rb") as f:
+            data = f.read()
+        magic = data[:4]
+        if magic == b"CSI\x01":
+            min_shift, depth, l_aux = struct.unpack_from("<3i", data, 4)
+            names = _index_names(data[16 : 16 + l_aux]) if l_aux else []
+            pos = 16 + l_aux
+            n_ref = struct.unpack_from("<i", data, pos)[0]
+            pos += 4
+            names = names or [str(i) for i in range(n_ref)]
+        elif magic == b"TBI\x01":
+            min_shift, depth = TBI_MIN_SHIFT, TBI_DEPTH
+            n_ref = struct.unpack_from("<i", data, 4)[0]
+            l_nm = struct.unpack_from("<i", data, 32)[0]
+            names = _index_names(data[8 : 36 + l_nm])
+            pos = 36 + l_nm
+        else:
+            raise ValueError("Not a tabix or CSI index: " + fname)
+        csi = magic == b"CSI\x01"
+        meta_bin = ((1 << (3 * depth + 3)) - 1) // 7 + 1
+        refs = []
+        for _ in range(n_ref):
+            bins = {}
+            loffs = {}
+            meta = None
+            n_bin = struct.unpack_from("<i", data, pos)[0]
+            pos += 4
+            for _ in range(n_bin):
+                if csi:
+                    b, loff, n_chunk = struct.unpack_from("<IQi", data, pos)
+                    pos += 16
+                else:
+                    b, n_chunk = struct.unpack_from("<Ii", data, pos)
+                    pos += 8
+                    loff = 0
+                chunks = struct.unpack_from("<%dQ" % (2 * n_chunk), data, pos)
+                pos += 16 * n_chunk
+                if b != meta_bin:
+                    bins[b] = list(zip(chunks[::2], chunks[1::2]))
+                    loffs[b] = loff
+                else:
+                    meta = chunks
+            lidx = []
+            if not csi:
+                n_intv = struct.unpack_from("<i", data, pos)[0]
+                lidx = list(struct.unpack_from("<%dQ" % n_intv, data, pos + 4))
+                pos += 4 + 8 * n_intv
+            refs.append({"bins": bins, "loffs": loffs, "lidx": lidx, "meta": meta})
+        index = cls(csi, min_shift, depth, names, refs)
+        if pos + 8 <= len(data):
+            index.n_no_coor = struct.unpack_from("<Q", data, pos)[0]
+        return index
+
+    def min_offset(self, ref, beg):
+        """Smallest virtual offset at which records overlapping beg can start."""
+        if not self.csi:
+            lidx = ref["lidx"]
+            return lidx[min(beg >> self.min_shift, len(lidx) - 1)] if lidx else 0
+        b = reg2bin(beg, beg + 1, self.min_shift, self.depth)
+        while b > 0 and b not in ref["loffs"]:
+            b = (b - 1) >> 3
+        return ref["loffs"].get(b, 0)
+
+    def chunks(self, name, beg, end):
+        """Sorted, merged (start, end) virtual offset ranges holding the records that
+        overlap the 0-based half-open interval [beg, end) of contig name.
+        """
+        ref = self.refs.get(name)
+        if ref is None:
+            return []
+        min_off = self.min_offset(ref, beg)
+        chunks = sorted(
+            chunk
+            for b in reg2bins(beg, end, self.min_shift, self.depth)
+            for chunk in ref["bins"].get(b, [])
+            if chunk[1] > min_off
+        )
+        merged = []
+        for start, stop in chunks:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+
+
+def _index_names(aux):
+    """Contig names from the tabix configuration block of an index."""
+    l_nm = struct.unpack_from("<i", aux, 24)[0]
+    return [n.decode() for n in aux[28 : 28 + l_nm].split(b"\0")[:-1]]
+
+
+def find_index(fname):
+    """Name of the .tbi or .csi index of fname, or None."""
+    for suffix in (".tbi", ".csi"):
+        if os.path.exists(fname + suffix):
+            return fname + suffix
+    return None
+
+
+def index_suffix(indexer):
+    return ".csi" if indexer.csi else ".tbi"
+
+
+def save_index_fingerprint(fname, index_name):
+    """Record the size and mtime of fname in <index_name>.fp, once its index is written."""
+    st = os.stat(fname)
+    with open(index_name + ".fp", "w") as f:
+        json.dump({"size": st.st_size, "mtime_ns": st.st_mtime_ns}, f)
+
+
+def index_is_fresh(fname, index_name):
+    """True if index_name was made from fname as it is now: the index is not older than fname,
+    and fname still has the size and mtime recorded by save_index_fingerprint().
+    """
+    try:
+        st, index_st = os.stat(fname), os.stat(index_name)
+        with open(index_name + ".fp") as f:
+            fingerprint = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return index_st.st_mtime_ns >= st.st_mtime_ns and fingerprint == {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
+
+
+############################################## VCF I/O ##############################################
+
+
+def iter_bgzf_lines(f):
+    """Yield the lines (bytes, newline included) of an open BGZF or gzip stream."""
+    carry = b""
+    if f.seekable():
+        blocks = (inflate_bgzf_block(block) for _, block in iter_bgzf_blocks(f))
+    else:
+        gz = gzip.GzipFile(fileobj=f)
+        blocks = iter(lambda: gz.read(1 << 16), b"")
+    for data in blocks:
+        if not data:
+            continue
+        lines = (carry + data).split(b"\n")
+        carry = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if carry:
+        yield carry + b"\n"
+
+
+def iter_bcf_lines(fname):
+    """Yield a BCF file as VCF text lines (bytes).  Requires pysam."""
+    import pysam
+
+    verbosity = pysam.set_verbosity(0)  # silence the missing-index warning; BCF is read in full
+    vf = pysam.VariantFile(fname)
+    pysam.set_verbosity(verbosity)
+    with vf:
+        for line in str(vf.header).splitlines(keepends=True):
+            yield line.encode()
+        for rec in vf:
+            yield str(rec).encode()
+
+
+def open_vcf_lines(fname):
+    """Iterate over the lines (bytes) of a plain, BGZF/gzip-compressed or BCF variant file.
+    "-" (stdin) and named pipes are read once, as plain or gzipped VCF.
+    """
+    if fname == "-":
+        return _iter_stream_lines(sys.stdin.buffer)
+    if stat.S_ISFIFO(os.stat(fname).st_mode):
+        return _iter_stream_lines(open(fname, "rb"))
+    with open(fname, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] != b"\x1f\x8b":
+        if magic[:3] == b"BCF":
+            return iter_bcf_lines(fname)
+        return _iter_plain_lines(fname)
+    with gzip.open(fname, "rb") as f:
+        if f.read(3) == b"BCF":
+            return iter_bcf_lines(fname)
+    return _iter_gz_lines(fname)
+
+
+def _iter_stream_lines(stream):
+    head = stream.peek(2)[:2] if hasattr(stream, "peek") else b""
+    return iter_bgzf_lines(stream) if head == b"\x1f\x8b" else iter(stream)
+
+
+def _iter_plain_lines(fname):
+    with open(fname, "rb") as f:
+        yield from f
+
+
+def _iter_gz_lines(fname):
+    with open(fname, "rb") as f:
+        if is_bgzf(fname):
+            yield from iter_bgzf_lines(f)
+        else:
+            with gzip.GzipFile(fileobj=f) as gz:
+                yield from gz
+
+
+def iter_bgzf_lines_at(f, voffset):
+    """Yield (virtual offset, line) for the lines of an open BGZF file from voffset on."""
+    f.seek(voffset >> 16)
+    skip = voffset & 0xFFFF
+    carry = b""
+    carry_start = None
+    for coffset, block in iter_bgzf_blocks(f):
+        data = inflate_bgzf_block(block)
+        pos, skip = skip, 0
+        while True:
+            nl = data.find(b"\n", pos)
+            if nl < 0:
+                if pos < len(data):
+                    if carry_start is None:
+                        carry_start = coffset << 16 | pos
+                    carry += data[pos:]
+                break
+            start = carry_start if carry_start is not None else coffset << 16 | pos
+            yield start, carry + data[pos : nl + 1]
+            carry = b""
+            carry_start = None
+            pos = nl + 1
+    if carry:
+        yield carry_start, carry + b"\n"
+
+
+def parse_region(text):
+    """chr, chr:start or chr:start-end (1-based, inclusive) as (chr, beg, end), 0-based half-open."""
+    m = _REGION.match(text)
+    if m is None:
+        return text, 0, TBI_MAX_LENGTH << 12
+    beg = int(m.group(2).replace(",", "")) - 1
+    end = int(m.group(3).replace(",", "")) if m.group(3) else TBI_MAX_LENGTH << 12
+    return m.group(1), max(beg, 0), end
+
+
+def read_bed_regions(fname):
+    """Regions (chr, beg, end) of a BED file, 0-based half-open."""
+    regions = []
+    for line in open_vcf_lines(fname):
+        fields = line.decode().split()
+        if not fields or fields[0] in ("track", "browser") or fields[0].startswith("#"):
+            continue
+        regions.append((fields[0], int(fields[1]), int(fields[2])))
+    return regions
+
+
+def read_dict(fname):
+    """Contig order of a sequence dictionary: {name (bytes): rank}."""
+    order = {}
+    with open(fname, "rb") as f:
+        for line in f:
+            if line.startswith(b"@SQ"):
+                for field in line.rstrip(b"\r\n").split(b"\t")[1:]:
+                    if field.startswith(b"SN:"):
+                        order.setdefault(field[3:], len(order))
+    return order
+
+
+def sort_regions(regions, names):
+    """Order regions as the contigs in names (dropping other contigs), merging overlaps."""
+    order = {name: i for i, name in enumerate(names)}
+    merged = []
+    for name, beg, end in sorted(
+        (r for r in regions if r[0] in order), key=lambda r: (order[r[0]], r[1], r[2])
+    ):
+        if merged and merged[-1][0] == name and beg <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([name, beg, end])
+    return [tuple(r) for r in merged]
+
+
+def fetch_vcf_lines(fname, regions, index=None):
+    """Yield the records (bytes) of an indexed BGZF VCF that start inside the regions
+    (chr, beg, end), reading only the blocks the index points to.  Records are yielded
+    in file order and at most once, so shards that tile a contig never share a record.
+    """
+    index = index or VcfIndex.read(find_index(fname))
+    with open(fname, "rb") as f:
+        for name, beg, end in sort_regions(regions, index.names):
+            region_done = False
+            for vstart, vend in index.chunks(name, beg, end):
+                for voffset, line in iter_bgzf_lines_at(f, vstart):
+                    if voffset >= vend:
+                        break
+                    fields = line.split(b"\t", 4)
+                    if fields[0].decode() != name:
+                        continue
+                    start = int(fields[1]) - 1
+                    if start >= end:
+                        region_done = True
+                        break
+                    if start >= beg:
+                        yield line
+                if region_done:
+                    break
+
+
+class VcfWriter:
+    """Write VCF lines (bytes) as plain text, or as BGZF with a .tbi/.csi index when the
+    output name ends in .gz.  The index type follows the header's contig lengths unless
+    csi is True/False.
+    """
+
+    def __init__(self, fname, csi=None, level=6, mode="wb"):
+        self.fname = fname
+        self.csi = csi
+        self.compressed = fname.endswith(".gz") or fname.endswith(".bgz")
+        if fname == "-":
+            self.out = sys.stdout.buffer
+        else:
+            self.out = open(fname, mode)
+            if mode != "wb":
+                self.out.seek(0, os.SEEK_END)
+        self.bgzf = BgzfWriter(self.out, level) if self.compressed else None
+        self.header = []
+        self.indexer = None
+        self.n_records = 0
+        self.last_record = None
+
+    @classmethod
+    def resume(cls, fname, offset, csi=None, level=6):
+        """Reopen a partly written output, keeping its first offset bytes (which must end on
+        a block boundary for BGZF) and appending after them.  The kept part is read back
+        to verify it and to rebuild the index; n_records and last_record describe it.
+        """
+        os.truncate(fname, offset)
+        writer = cls(fname, csi, level, mode="r+b")
+        with open(fname, "rb") as f:
+            if writer.compressed:
+                lines = iter_bgzf_lines_at(f, 0)
+            else:
+                lines = ((None, line) for line in f)
+            previous = None
+            for voffset, line in lines:
+                if not line.endswith(b"\n"):
+                    raise ValueError("Partial output " + fname + " ends inside a record")
+                if previous is not None and writer.compressed:
+                    writer._index(previous[1], previous[0], voffset)
+                if line.startswith(b"#"):
+                    writer.header.append(line)
+                    continue
+                previous = voffset, line
+                writer.n_records += 1
+                writer.last_record = line
+            if previous is not None and writer.compressed:
+                writer._index(previous[1], previous[0], offset << 16)
+        return writer
+
+    def write_header(self, lines):
+        """Write header lines; compressed output starts the records in a new block."""
+        self.header.extend(lines)
+        for line in lines:
+            self._write(line)
+        if self.bgzf is not None:
+            self.bgzf.flush()
+
+    def write_record(self, line):
+        self.n_records += 1
+        self.last_record = line
+        if self.bgzf is None:
+            self.out.write(line)
+            return
+        vstart = self.bgzf.tell()
+        self.bgzf.write(line)
+        self._index(line, vstart, self.bgzf.tell())
+
+    def _index(self, line, vstart, vend):
+        if self.indexer is None:
+            self.indexer = VcfIndexer.for_header(self.header, self.csi)
+        fields = line.split(b"\t", 8)
+        beg, end = record_span(fields)
+        self.indexer.add(fields[0].decode(), beg, end, vstart, vend)
+
+    def _write(self, line):
+        if self.bgzf is None:
+            self.out.write(line)
+        else:
+            self.bgzf.write(line)
+
+    def sync(self):
+        """End the current BGZF block and push everything written so far to disk.
+        Returns the file size, a point from which resume() can continue.
+        """
+        if self.bgzf is not None:
+            self.bgzf.flush()
+        self.out.flush()
+        if self.out is not sys.stdout.buffer:
+            os.fsync(self.out.fileno())
+        return self.out.tell()
+
+    def close(self):
+        """Finish the output; returns the name of the index written, if any."""
+        if self.bgzf is None:
+            if self.out is not sys.stdout.buffer:
+                self.out.close()
+            else:
+                self.out.flush()
+            return None
+        self.bgzf.close()
+        if self.indexer is None:
+            self.indexer = VcfIndexer.for_header(self.header, self.csi)
+        index_name = self.fname + index_suffix(self.indexer)
+        self.indexer.write(index_name)
+        save_index_fingerprint(self.fname, index_name)
+        return index_name
+
+
+class Checkpoint:
+    """Restart points of a long VcfWriter job, kept in a JSON sidecar file.
+
+    save() syncs the output and records its size, the number of records written and
+    the position of the last one, together with a signature of the job (input file
+    and options) and whatever the function extra returns (a dict, for state of the job
+    besides its output); load() only returns a checkpoint with the same signature.
+    update() saves at most every interval seconds.
+    """
+
+    def __init__(self, fname, signature, interval=600, extra=None):
+        self.fname = fname
+        self.signature = json.loads(json.dumps(signature))
+        self.interval = interval
+        self.extra = extra
+        self.last_save = time.monotonic()
+
+    def load(self):
+        try:
+            with open(self.fname) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return state if state.get("signature") == self.signature else None
+
+    def update(self, out):
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save(out)
+
+    def save(self, out):
+        state = {"signature": self.signature, "offset": out.sync(), "records": out.n_records}
+        if out.last_record is not None:
+            fields = out.last_record.split(b"\t", 2)
+            state["chrom"], state["pos"] = fields[0].decode(), int(fields[1])
+        if self.extra is not None:
+            state.update(self.extra())
+        with open(self.fname + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.fname + ".tmp", self.fname)
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+############################################## Records ##############################################
+
+# VCF columns
+CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, FORMAT = range(9)
+
+
+class VcfRecord:
+    """One VCF record, parsed only as far as it is used.
+
+    A record is made from its raw line (bytes).  The columns are split on first access
+    to cols, INFO is parsed into a dict only for info(), and a sample is split into its
+    FORMAT fields only for sample().  Change a record through cols (or add_info()), and
+    bytes(record) gives the line back; an unchanged record returns its original bytes.
+    """
+
+    __slots__ = ("_line", "_cols")
+
+    def __init__(self, line):
+        self._line = line
+        self._cols = None
+
+    @property
+    def cols(self):
+        if self._cols is None:
+            self._cols = self._line.rstrip(b"\r\n").split(b"\t")
+            self._line = None
+        return self._cols
+
+    def _head(self):
+        return self._cols if self._cols is not None else self._line.split(b"\t", 2)
+
+    @property
+    def chrom(self):
+        return self._head()[CHROM].decode()
+
+    @property
+    def pos(self):
+        return int(self._head()[POS])
+
+    def info(self):
+        """INFO as a dict of bytes (True for flags)."""
+        info = self.cols[INFO]
+        if info == b".":
+            return {}
+        return dict((kv.split(b"=", 1) if b"=" in kv else (kv, True)) for kv in info.split(b";"))
+
+    def add_info(self, key, value):
+        """Append key=value to INFO."""
+        entry = key + b"=" + value
+        info = self.cols[INFO]
+        self.cols[INFO] = entry if info == b"." else info + b";" + entry
+
+    @property
+    def format_keys(self):
+        return self.cols[FORMAT].split(b":")
+
+    @property
+    def samples(self):
+        return self.cols[9:]
+
+    def sample(self, i):
+        """FORMAT fields of the i-th sample as a dict of bytes."""
+        return dict(zip(self.format_keys, self.cols[9 + i].split(b":")))
+
+    def __bytes__(self):
+        if self._cols is None:
+            return self._line if self._line.endswith(b"\n") else self._line + b"\n"
+        return b"\t".join(self._cols) + b"\n"
+
+    def __repr__(self):
+        return "VcfRecord(" + repr(bytes(self)) + ")"
+
+
+class VcfReader:
+    """Header and records of a VCF/BCF file.
+
+    header holds the meta-information lines and columns the split #CHROM line (str).
+    Iterating yields VcfRecords: all of them, or, when regions (chr, beg, end) are given,
+    those starting inside the regions (see fetch_vcf_lines; needs an index).
+    """
+
+    def __init__(self, fname, regions=None, index=None):
+        self.fname = fname
+        self.header = []
+        self.columns = None
+        self._lines = open_vcf_lines(fname)
+        for line in self._lines:
+            if line.startswith(b"#CHROM"):
+                self.columns = line.decode().rstrip("\r\n").split("\t")
+                break
+            if not line.startswith(b"#"):
+                self._lines = itertools.chain([line], self._lines)
+                break
+            self.header.append(line)
+        if regions is not None:
+            if hasattr(self._lines, "close"):
+                self._lines.close()
+            self._lines = fetch_vcf_lines(fname, regions, index)
+
+    @property
+    def samples(self):
+        return self.columns[9:] if self.columns else []
+
+    def lines(self):
+        """The remaining records as raw lines (bytes)."""
+        return self._lines
+
+    def __iter__(self):
+        return map(VcfRecord, self._lines)
+
+
+def chain_stages(records, *stages):
+    """Connect transform stages: each stage is a function from an iterator of
+    records to an iterator of records, and the records stream through all of them
+    without being written out in between.
+    """
+    for stage in stages:
+        records = stage(records)
+    return records
+
+
+def map_stage(func):
+    """Stage applying func to every record; records for which func returns None are dropped."""
+
+    def stage(records):
+        for rec in records:
+            rec = func(rec)
+            if rec is not None:
+                yield rec
+
+    return stage
+
+
+def write_records(records, writer):
+    """Write records (VcfRecords or bytes lines) with a VcfWriter; returns their number."""
+    n = 0
+    for rec in records:
+        writer.write_record(bytes(rec))
+        n += 1
+    return n
+
+
+############################################# Pipelines #############################################
+
+
+class StageQueue(queue.Queue):
+    """Bounded queue between two pipeline stages that counts how often, and for how
+    long, the producer waited for room (put_stalls, put_wait) and the consumer waited
+    for data (get_stalls, get_wait).
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.put_stalls = self.get_stalls = 0
+        self.put_wait = self.get_wait = 0.0
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            super().put(item, block=False)
+        except queue.Full:
+            if not block:
+                raise
+            start = time.perf_counter()
+            super().put(item, timeout=timeout)
+            self.put_stalls += 1
+            self.put_wait += time.perf_counter() - start
+
+    def get(self, block=True, timeout=None):
+        try:
+            return super().get(block=False)
+        except queue.Empty:
+            if not block:
+                raise
+            start = time.perf_counter()
+            item = super().get(timeout=timeout)
+            self.get_stalls += 1
+            self.get_wait += time.perf_counter() - start
+            return item
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+"""
+Concatenates sorted, indexed BGZF VCFs that hold consecutive stretches of the genome
+(such as the per-chromosome gVCFs of a sample, or the per-chromosome or per-shard
+outputs of genotype_union.py) without sorting or recompressing them.
+
+The inputs are checked to be ordered as the contigs of the reference .dict, and a
+contig split between inputs to have its records in one input after those in the
+other; their records are then copied block by block after the header of the
+first input (with the INFO, FORMAT, FILTER and contig lines only the others have), and
+the output index is made by shifting the inputs' indexes to the new block offsets
+rather than by reading the output again.  Only the BGZF block holding the end of each
+input's header is recompressed.
+
+When the inputs cannot be concatenated this way (unsorted or overlapping contigs,
+different samples, missing or differing indexes) the script exits with status 3, so
+that the caller can fall back to bcftools concat -a.
+"""
+
+import argparse
+import logging
+import re
+import sys
+from collections import Counter
+
+from common import (
+    BGZF_EOF,
+    BgzfWriter,
+    VcfIndex,
+    VcfIndexer,
+    VcfReader,
+    find_index,
+    index_suffix,
+    inflate_bgzf_block,
+    is_bgzf,
+    iter_bgzf_lines_at,
+    read_bgzf_block,
+    read_dict,
+    save_index_fingerprint,
+)
+
+log = logging.getLogger("concat_vcfs")
+
+# exit status when the inputs need a record-level concatenation instead
+NOT_CONCATENABLE = 3
+
+# header lines identified by their key and ID (##INFO=<ID=...) rather than their whole text
+STRUCTURED = re.compile(rb"##(\w+)=<ID=([^,>]*)")
+
+
+class NotConcatenable(Exception):
+    """The inputs cannot be concatenated block by block."""
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Concatenate sorted, indexed BGZF VCFs of consecutive contigs block by block."
+    )
+    parser.add_argument("outfile", help="Output VCF (.vcf.gz); its index is written next to it")
+    parser.add_argument("infiles", nargs="+", help="Input VCFs (.vcf.gz, indexed), in any order")
+    parser.add_argument(
+        "--dict",
+        required=True,
+        help="Reference sequence dictionary (.dict) giving the contig order",
+    )
+    return parser.parse_args()
+
+
+def combine_headers(headers):
+    """Header of the first input, with the structured lines (INFO, FORMAT, FILTER, contig,
+    ...) of the others that it does not have, as bcftools concat combines headers.
+    """
+    combined = list(headers[0])
+    seen = {m.groups() for m in map(STRUCTURED.match, combined) if m}
+    for header in headers[1:]:
+        for line in header:
+            m = STRUCTURED.match(line)
+            if m and m.groups() not in seen:
+                seen.add(m.groups())
+                combined.append(line)
+    return combined
+
+
+class Part:
+    """One input: its header, index, and where its records start (virtual offset)."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        index_name = find_index(fname)
+        if not is_bgzf(fname) or index_name is None:
+            raise NotConcatenable(fname + " is not an indexed BGZF file")
+        reader = VcfReader(fname)
+        if reader.columns is None:
+            raise NotConcatenable(fname + " has no #CHROM header line")
+        self.header = reader.header
+        self.columns = reader.columns
+        self.index = VcfIndex.read(index_name)
+        starts = [
+            chunk[0]
+            for ref in self.index.refs.values()
+            for chunks in ref["bins"].values()
+            for chunk in chunks
+        ]
+        self.start = min(starts) if starts else None
+        self.contigs = [n for n in self.index.names if self.index.refs[n]["bins"]]
+
+    def first_pos(self, name):
+        """POS of the first record of contig name."""
+        chunks = [c for cs in self.index.refs[name]["bins"].values() for c in cs]
+        with open(self.fname, "rb") as f:
+            line = next(iter_bgzf_lines_at(f, min(chunks)[0]))[1]
+        return int(line.split(b"\t", 2)[1])
+
+    def last_pos(self, name):
+        """POS of the last record of contig name (the last one of the chunk that ends last)."""
+        chunks = [c for cs in self.index.refs[name]["bins"].values() for c in cs]
+        start, end = max(chunks, key=lambda c: c[1])
+        pos = None
+        with open(self.fname, "rb") as f:
+            for voffset, line in iter_bgzf_lines_at(f, start):
+                if voffset >= end:
+                    break
+                pos = int(line.split(b"\t", 2)[1])
+        return pos
+
+
+def plan_parts(infiles, order):
+    """Open the inputs and sort them by contig order; returns the Parts holding records.
+    A contig may be split between inputs (as the shards of plan_shards.py split it) if
+    its records in each input follow those in the one before.
+    Raises NotConcatenable if they cannot be concatenated block by block.
+    """
+    parts = [Part(f) for f in infiles]
+    first = parts[0]
+    for part in parts[1:]:
+        if part.columns != first.columns:
+            raise NotConcatenable(part.fname + " does not have the samples of " + first.fname)
+        if (part.index.csi, part.index.min_shift, part.index.depth) != (
+            first.index.csi,
+            first.index.min_shift,
+            first.index.depth,
+        ):
+            raise NotConcatenable(part.fname + " has another type of index than " + first.fname)
+    ranks = {}
+    for part in parts:
+        for name in part.contigs:
+            rank = order.get(name.encode())
+            if rank is None:
+                raise NotConcatenable(
+                    "Contig " + name + " of " + part.fname + " is not in the .dict"
+                )
+            ranks[name] = rank
+        if [ranks[n] for n in part.contigs] != sorted(ranks[n] for n in part.contigs):
+            raise NotConcatenable(part.fname + " is not sorted in .dict order")
+    with_records = [p for p in parts if p.start is not None]
+    counts = Counter(n for p in with_records for n in p.contigs)
+    with_records.sort(
+        key=lambda p: (
+            ranks[p.contigs[0]],
+            p.first_pos(p.contigs[0]) if counts[p.contigs[0]] > 1 else 0,
+        )
+    )
+    for a, b in zip(with_records, with_records[1:]):
+        last, first = a.contigs[-1], b.contigs[0]
+        if ranks[last] > ranks[first]:
+            raise NotConcatenable(a.fname + " and " + b.fname + " have interleaved contigs")
+        if last == first and a.last_pos(last) > b.first_pos(first):
+            raise NotConcatenable(
+                "Contig "
+                + last
+                + " is in more than one input, with overlapping positions ("
+                + a.fname
+                + " and "
+                + b.fname
+                + ")"
+            )
+    return parts, with_records
+
+
+def copy_records(part, out, indexer):
+    """Append the BGZF blocks of part's records to out (an open binary file, positioned
+    at its end), and its index entries to indexer with shifted offsets.
+    """
+    start_block, start_within = part.start >> 16, part.start & 0xFFFF
+    with open(part.fname, "rb") as f:
+        f.seek(start_block)
+        first_block = read_bgzf_block(f)
+        dest = out.tell()
+        if start_within:
+            # the block also holds the end of the header: rewrite it with the records only
+            writer = BgzfWriter(out)
+            writer.write(inflate_bgzf_block(first_block)[start_within:])
+            writer.flush()
+            copied_from = start_block + len(first_block)
+        else:
+            copied_from = start_block
+        body_dest = out.tell()
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(end - len(BGZF_EOF))
+        if f.read() == BGZF_EOF:
+            end -= len(BGZF_EOF)
+        f.seek(copied_from)
+        remaining = end - copied_from
+        while remaining > 0:
+            data = f.read(min(remaining, 1 << 22))
+            if not data:
+                raise ValueError(part.fname + " is truncated")
+            out.write(data)
+            remaining -= len(data)
+
+    def shift(voffset):
+        block, within = voffset >> 16, voffset & 0xFFFF
+        if block < copied_from:
+            return (dest << 16) | (within - start_within)
+        return ((block - copied_from + body_dest) << 16) | within
+
+    for name in part.contigs:
+        ref = part.index.refs[name]
+        bins = {b: [[shift(s), shift(e)] for s, e in chunks] for b, chunks in ref["bins"].items()}
+        off_beg, off_end, n_mapped, _ = ref["meta"] or (
+            min(c[0] for cs in ref["bins"].values() for c in cs),
+            max(c[1] for cs in ref["bins"].values() for c in cs),
+            0,
+            0,
+        )
+        entry = {
+            "bins": bins,
+            "lidx": [shift(max(o, part.start)) for o in ref["lidx"]],
+            "off_beg": shift(off_beg),
+            "off_end": shift(off_end),
+            "n": n_mapped,
+        }
+        if indexer.csi:
+            entry["loffs"] = {b: shift(max(o, part.start)) for b, o in ref["loffs"].items()}
+        if indexer.names and indexer.names[-1] == name:
+            # the contig goes on from the previous input
+            merge_entry(indexer.refs[-1], entry)
+        else:
+            indexer.names.append(name)
+            indexer.refs.append(entry)
+    indexer.n_no_coor += part.index.n_no_coor
+
+
+def merge_entry(ref, entry):
+    """Add the index entry of a contig's records in one input to that of the records
+    before them.  Linear index windows and CSI bin offsets that ref already has keep its
+    (smaller) offsets.
+    """
+    for b, chunks in entry["bins"].items():
+        ref["bins"].setdefault(b, []).extend(chunks)
+    ref["lidx"] = ref["lidx"] + entry["lidx"][len(ref["lidx"]) :]
+    for b, loff in entry.get("loffs", {}).items():
+        ref["loffs"].setdefault(b, loff)
+    ref["off_end"] = entry["off_end"]
+    ref["n"] += entry["n"]
+
+
+def concat_vcfs(infiles, outfile, order):
+    """Concatenate infiles into outfile (BGZF) and write its index; returns the index name.
+    Raises NotConcatenable if the inputs cannot be concatenated block by block.
+    """
+    parts, with_records = plan_parts(infiles, order)
+    first = parts[0].index
+    indexer = VcfIndexer(csi=first.csi, min_shift=first.min_shift, depth=first.depth)
+    header = combine_headers([p.header for p in parts])
+    header.append(("\t".join(parts[0].columns) + "\n").encode())
+    with open(outfile, "wb") as out:
+        writer = BgzfWriter(out)
+        writer.write(b"".join(header))
+        writer.flush()
+        for part in with_records:
+            copy_records(part, out, indexer)
+        out.write(BGZF_EOF)
+    index_name = outfile + index_suffix(indexer)
+    indexer.write(index_name)
+    save_index_fingerprint(outfile, index_name)
+    return index_name
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    try:
+        concat_vcfs(args.infiles, args.outfile, read_dict(args.dict))
+    except NotConcatenable as e:
+        log.warning("Cannot concatenate block by block: %s", e)
+        sys.exit(NOT_CONCATENABLE)
+    except (IOError, ValueError) as e:
+        log.error("%s", e)
+        sys.exit(1)
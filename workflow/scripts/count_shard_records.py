@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Counts the records of each chromosome shard of the ensemble stage from the indexes of
+the callers' GLnexus output, so that shards without any record (chrY in female cohorts,
+chrM in exomes, small contigs) are not harmonized.
+
+The counts are the records of the index pseudo-bins (a contig whose index has bins but no
+pseudo-bin counts as one record), summed over the callers.  The indexes are either
+whole-genome indexes (.tbi/.csi of the callers' VCFs), counted per contig, or with
+--per-shard one index per shard and caller (the per-chromosome BCFs' .csi), given caller
+by caller in the order of --shards.
+
+The output lists every shard with its records, in the order of --shards.
+"""
+
+import argparse
+import logging
+import struct
+import sys
+from collections import Counter
+
+from common import VcfIndex
+
+log = logging.getLogger("count_shard_records")
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Count the records of each shard from the indexes of the callers' VCFs."
+    )
+    parser.add_argument("outfile", help="Output TSV: shard and records")
+    parser.add_argument("indexes", nargs="+", help=".tbi/.csi indexes of the callers' output")
+    parser.add_argument("--shards", nargs="+", required=True, help="Shards (chromosomes), in order")
+    parser.add_argument(
+        "--per-shard",
+        action="store_true",
+        help="The indexes are one per shard and caller, caller by caller in the order of --shards",
+    )
+    return parser.parse_args()
+
+
+def index_records(index):
+    """Records of an index per contig: {contig: records}, for the contigs with records."""
+    records = {}
+    for name, ref in index.refs.items():
+        if ref["meta"] and ref["meta"][2]:
+            records[name] = ref["meta"][2]
+        elif ref["bins"]:
+            records[name] = 1
+    return records
+
+
+def count_shard_records(indexes, shards, per_shard=False):
+    """Records of each shard in the indexes (file names): {shard: records}."""
+    counts = Counter({shard: 0 for shard in shards})
+    if per_shard and len(indexes) % len(shards):
+        raise ValueError("%d indexes for %d shards" % (len(indexes), len(shards)))
+    for i, fname in enumerate(indexes):
+        records = index_records(VcfIndex.read(fname))
+        if per_shard:
+            counts[shards[i % len(shards)]] += sum(records.values())
+        else:
+            for shard in shards:
+                counts[shard] += records.get(shard, 0)
+    return counts
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    try:
+        counts = count_shard_records(args.indexes, args.shards, args.per_shard)
+    except (IOError, ValueError, EOFError, struct.error) as e:
+        log.error("%s", e)
+        sys.exit(1)
+    with open(args.outfile, "w") as out:
+        out.write("#shard\trecords\n")
+        for shard in args.shards:
+            out.write("%s\t%d\n" % (shard, counts[shard]))
+    empty = [shard for shard in args.shards if not counts[shard]]
+    log.info("%d of %d shards have no records: %s", len(empty), len(args.shards), " ".join(empty))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+Makes sure that bgzipped VCFs (or BCFs, or bgzipped BED files) have an up-to-date index,
+building one only when the existing index cannot be trusted.
+
+An index is reused when it is not older than the data and the data still has the size
+and mtime recorded in <index>.fp when the index was made (the scripts that write indexed
+VCFs record it too).  An index without a .fp file, as written by the callers or by
+tabix, is reused when it is not older than the data and its last chunk ends where the
+data ends; its .fp file is written then, so that the check is only made once.
+
+Otherwise the index is rebuilt: BGZF VCFs by tabix, with a .csi instead of a .tbi
+index when the ##contig lengths (or the positions, when the header has no lengths) are
+too large for a .tbi; BCFs by bcftools index, and other files by tabix with the given
+preset.  Where there is no tabix, VCFs are indexed here (see common.VcfIndexer), which
+is much slower on large files.
+"""
+
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import sys
+
+from common import (
+    BGZF_EOF,
+    TBI_MAX_LENGTH,
+    VcfIndex,
+    VcfIndexer,
+    contig_lengths,
+    find_index,
+    index_depth,
+    index_is_fresh,
+    index_suffix,
+    is_bgzf,
+    iter_bgzf_lines_at,
+    open_vcf_lines,
+    read_bgzf_block,
+    record_span,
+    save_index_fingerprint,
+)
+
+log = logging.getLogger("ensure_index")
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Index bgzipped VCFs, BCFs or BED files unless their index is up to date."
+    )
+    parser.add_argument("files", nargs="+", help="Files to index (.vcf.gz, .bcf, .bed.gz, ...)")
+    parser.add_argument(
+        "--preset",
+        default="vcf",
+        choices=["vcf", "bed", "gff", "sam"],
+        help="tabix preset of the files (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--csi",
+        action="store_true",
+        default=None,
+        help="Build a .csi instead of a .tbi index (the default is chosen from contig lengths)",
+    )
+    return parser.parse_args()
+
+
+def data_end(fname):
+    """Offset at which the data of a BGZF file ends (the start of its EOF block, if any)."""
+    size = os.path.getsize(fname)
+    with open(fname, "rb") as f:
+        f.seek(max(size - len(BGZF_EOF), 0))
+        return size - len(BGZF_EOF) if f.read() == BGZF_EOF else size
+
+
+def index_covers(fname, index_name):
+    """True if the last chunk of a .tbi/.csi index ends where the data of fname ends."""
+    try:
+        index = VcfIndex.read(index_name)
+    except (OSError, ValueError, EOFError, struct.error):
+        return False
+    ends = [c[1] for ref in index.refs.values() for cs in ref["bins"].values() for c in cs]
+    if not ends:
+        return False
+    last = max(ends)
+    coffset, within = last >> 16, last & 0xFFFF
+    end = data_end(fname)
+    if within == 0:
+        return coffset == end
+    with open(fname, "rb") as f:
+        f.seek(coffset)
+        block = read_bgzf_block(f)
+    # the chunk ends in the last block, at the end of its uncompressed data (ISIZE)
+    return (
+        len(block) > 4
+        and coffset + len(block) == end
+        and within == struct.unpack("<I", block[-4:])[0]
+    )
+
+
+def is_bcf(fname):
+    """True for a BCF, uncompressed or BGZF-compressed."""
+    with open(fname, "rb") as f:
+        magic = f.read(3)
+    if magic[:2] == b"\x1f\x8b":
+        with gzip.open(fname, "rb") as f:
+            magic = f.read(3)
+    return magic == b"BCF"
+
+
+class _NeedsDeeperIndex(Exception):
+    """A record is beyond the positions the index can address."""
+
+
+def _index_records(fname, indexer_for):
+    """Add the records of a BGZF VCF to the indexer that indexer_for(header lines) returns;
+    returns the indexer.
+    """
+    end = data_end(fname)
+    indexer = previous = None
+    header = []
+
+    def add(line, vstart, vend):
+        fields = line.split(b"\t", 8)
+        beg, stop = record_span(fields)
+        if stop > 1 << (indexer.min_shift + 3 * indexer.depth):
+            raise _NeedsDeeperIndex()
+        indexer.add(fields[0].decode(), beg, stop, vstart, vend)
+
+    with open(fname, "rb") as f:
+        for voffset, line in iter_bgzf_lines_at(f, 0):
+            if line.startswith(b"#"):
+                header.append(line)
+                continue
+            if indexer is None:
+                indexer = indexer_for(header)
+            if previous is not None:
+                add(previous[1], previous[0], voffset)
+            previous = voffset, line
+        if indexer is None:
+            indexer = indexer_for(header)
+        if previous is not None:
+            add(previous[1], previous[0], last_record_end(f, previous[0], previous[1], end))
+    return indexer
+
+
+def last_record_end(f, voffset, line, end):
+    """Virtual offset after the last record of an open BGZF file (starting at voffset): in
+    its block, as htslib and common.VcfWriter give it, when the record does not span blocks.
+    """
+    f.seek(voffset >> 16)
+    block = read_bgzf_block(f)
+    stop = (voffset & 0xFFFF) + len(line)
+    if len(block) > 4 and stop <= struct.unpack("<I", block[-4:])[0]:
+        return voffset + len(line)
+    return end << 16
+
+
+def read_header(fname):
+    """Header lines (bytes) of a VCF."""
+    header = []
+    for line in open_vcf_lines(fname):
+        if not line.startswith(b"#"):
+            break
+        header.append(line)
+    return header
+
+
+def build_vcf_index(fname, csi=None):
+    """Index a BGZF VCF with tabix; returns the index name.  A .csi index is used when
+    forced, when a ##contig is longer than a .tbi can address, or when a record is beyond
+    that length (tabix fails on it).
+    """
+    if shutil.which("tabix") is None:
+        log.warning("No tabix: indexing %s in Python", fname)
+        return index_vcf_here(fname, csi)
+    forced = csi is not None
+    if not forced:
+        csi = max(contig_lengths(read_header(fname)).values(), default=0) >= TBI_MAX_LENGTH
+    try:
+        subprocess.run(["tabix", "-f", "-p", "vcf"] + (["-C"] if csi else []) + [fname], check=True)
+    except subprocess.CalledProcessError:
+        if forced or csi:
+            raise
+        csi = True
+        subprocess.run(["tabix", "-f", "-p", "vcf", "-C", fname], check=True)
+    return fname + (".csi" if csi else ".tbi")
+
+
+def index_vcf_here(fname, csi=None):
+    """Index a BGZF VCF with common.VcfIndexer; returns the index name (as build_vcf_index)."""
+    try:
+        indexer = _index_records(fname, lambda header: VcfIndexer.for_header(header, csi))
+    except _NeedsDeeperIndex:
+        # deep enough for any VCF position
+        indexer = _index_records(
+            fname, lambda header: VcfIndexer(csi=True, depth=index_depth(1 << 31))
+        )
+    index_name = fname + index_suffix(indexer)
+    indexer.write(index_name)
+    return index_name
+
+
+def build_index(fname, preset="vcf", csi=None):
+    """Build the index of fname; returns its name."""
+    if is_bcf(fname):
+        subprocess.run(["bcftools", "index", "-f", fname], check=True)
+        return fname + ".csi"
+    if preset != "vcf":
+        subprocess.run(
+            ["tabix", "-f", "-p", preset] + (["-C"] if csi else []) + [fname], check=True
+        )
+        return fname + (".csi" if csi else ".tbi")
+    if not is_bgzf(fname):
+        raise ValueError(fname + " is not bgzipped; it cannot be indexed")
+    return build_vcf_index(fname, csi)
+
+
+def ensure_index(fname, preset="vcf", csi=None):
+    """Index fname unless its index is up to date; returns (index name, True if built)."""
+    index_name = find_index(fname)
+    if index_name is not None and (csi is None or index_name.endswith(".csi") == csi):
+        if index_is_fresh(fname, index_name):
+            return index_name, False
+        if (
+            preset == "vcf"
+            and os.stat(index_name).st_mtime_ns >= os.stat(fname).st_mtime_ns
+            and index_covers(fname, index_name)
+        ):
+            save_index_fingerprint(fname, index_name)
+            return index_name, False
+    built = build_index(fname, preset, csi)
+    # drop an index of the other type, which readers could pick up instead
+    for stale in (fname + ".tbi", fname + ".csi"):
+        if stale != built and os.path.exists(stale):
+            os.remove(stale)
+            if os.path.exists(stale + ".fp"):
+                os.remove(stale + ".fp")
+    save_index_fingerprint(fname, built)
+    return built, True
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    for fname in args.files:
+        try:
+            index_name, built = ensure_index(fname, args.preset, args.csi)
+        except (IOError, ValueError, subprocess.CalledProcessError) as e:
+            log.error("Could not index %s: %s", fname, e)
+            sys.exit(1)
+        log.info("%s %s", "Wrote" if built else "Reusing up-to-date", index_name)
@@ -4,13 +4,37 @@
 The script merges calls from DeepVariant, HaplotypeCaller and Strelka2
 """
 
-# at some point, stop using print statements to log and use an actual logging framework.
-
 import argparse
-import csv
 import datetime
+import itertools
+import json
+import logging
+import os
+import queue
 import re
+import resource
+import struct
 import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common import (
+    Checkpoint,
+    StageQueue,
+    VcfIndex,
+    VcfReader,
+    VcfRecord,
+    VcfWriter,
+    chain_stages,
+    find_index,
+    parse_region,
+    read_bed_regions,
+)
 
 # global variables:
 # VCF structure (used instead of index numbers for readability)
@@ -24,6 +48,12 @@ filt = 6
 info = 7
 frmt = 8
 
+log = logging.getLogger("genotype_union")
+
+# callers in the order bcftools merge placed their sample blocks
+CALLERS = ["HC", "DV", "strelka2"]
+NUMBER_WORDS = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"]
+
 
 ############################################# Functions #############################################
 
@@ -33,10 +63,114 @@ def get_args():
     parser = argparse.ArgumentParser(
         description="Takes VCF file with samples that have been called by the three callers and returns a VCF file where the genotypes from each caller are combined."
     )
-    parser.add_argument("infile", help="Input VCF file name")
-    parser.add_argument("outfile", help="Output VCF file name")
+    parser.add_argument("infile", help="Input VCF file name (.vcf, .vcf.gz or .bcf)")
+    parser.add_argument(
+        "outfile", help="Output VCF file name; names ending in .gz are written as indexed BGZF"
+    )
+    parser.add_argument(
+        "--csi",
+        action="store_true",
+        default=None,
+        help="Write a .csi instead of a .tbi index (the default is chosen from contig lengths)",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        default=6,
+        choices=range(10),
+        metavar="0-9",
+        help="BGZF compression level of the output (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--callers",
+        nargs="+",
+        default=CALLERS,
+        help="Callers in the order of their sample blocks (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes merging records (default: %(default)s); at most one per"
+        + " available CPU, and one for inputs with few samples x records",
+    )
+    parser.add_argument(
+        "--chunk-bytes",
+        type=int,
+        default=1 << 22,
+        help="Approximate size of the record chunks handed to each worker (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=None,
+        help="Maximum number of chunks queued or being merged at once (default: 2 x workers)",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=4,
+        help="Chunks buffered between the reader, merge and writer stages; 0 runs the stages "
+        + "one after another in a single thread (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--regions",
+        action="append",
+        help="Only merge records starting in chr, chr:start or chr:start-end (1-based, inclusive);"
+        + " may be repeated.  The input must be bgzipped and indexed",
+    )
+    parser.add_argument(
+        "--regions-file",
+        help="Only merge records starting in the regions of a BED file (see --regions)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Save restart points in <outfile>.ckpt while running (removed when done)",
+    )
+    parser.add_argument(
+        "--final",
+        metavar="NAME",
+        help="When done, rename the output, its index and the index's .fp to this name"
+        + " (the output last), so that NAME only exists once it is complete",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=600,
+        help="Seconds between restart points (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a run of the same job from its last restart point, if there is one"
+        + " (implies --checkpoint)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="JSON",
+        help="Write a profile of the run (wall time per stage, CPU time per worker, records per"
+        + " caller set, records/s and peak memory) to this file",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="With --profile, also trace the allocations of the main process and report the top"
+        + " allocators (slower)",
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="JSON",
+        help="Write caller concordance statistics (records per caller set, per-sample pairwise"
+        + " caller GT agreement and concensus_GT no-calls) to this file",
+    )
+    parser.add_argument(
+        "--stall-report",
+        action="store_true",
+        help="Log how long each pipeline stage waited for the others",
+    )
     results = parser.parse_args()
-    return results.infile, results.outfile
+    return results
 
 
 def check_file(fname):
@@ -46,36 +180,147 @@ def check_file(fname):
         f.close()
         return 0
     except IOError:
-        print("ERROR: Could not read file", fname)
+        log.error("Could not read file %s", fname)
         return 1
         sys.exit()
     f.close()
 
 
-def get_header(infile):
+def get_header(infile, n_callers=len(CALLERS)):
     """Extract header from VCF.
     Exit with error message if no header detected.
     """
-    headerCheck = 1
-    with open(infile, "r") as file:
-        for line in csv.reader(file, delimiter="\t"):
-            if "#CHROM" in line:
-                headerCheck = vcf_check(line)
-                return line
-        if headerCheck == 1:
-            print("ERROR: File must contain header row matching VCF specification")
-            return 1
-            sys.exit()
+    line = VcfReader(infile).columns
+    if line is not None:
+        vcf_check(line, n_callers)
+        return line
+    else:
+        log.error("File must contain header row matching VCF specification")
+        return 1
+        sys.exit()
+
+
+def get_regions(infile, regions, regionsFile):
+    """Open the index of infile and collect the regions to merge.
+    Exit with error message if the input cannot be read by region.
+    """
+    indexName = find_index(infile)
+    if indexName is None:
+        log.error("--regions/--regions-file need a bgzipped input with a .tbi or .csi index")
+        return 1
+    wanted = [parse_region(r) for r in regions or []]
+    if regionsFile:
+        wanted.extend(read_bed_regions(regionsFile))
+    return VcfIndex.read(indexName), wanted
+
+
+def available_cpus():
+    """Number of CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def pool_workers(infile, workers, num_samples, index=None):
+    """Number of workers to merge with: 1 (no process pool) when the input has fewer than
+    POOL_MIN_COLUMNS sample columns (samples x records, the records counted from the
+    index of the input), otherwise workers.  Without an index that counts the records,
+    workers is kept.
+    """
+    if workers <= 1:
+        return workers
+    if index is None:
+        indexName = find_index(infile)
+        if indexName is None:
+            return workers
+        try:
+            index = VcfIndex.read(indexName)
+        except (IOError, ValueError, EOFError, struct.error):
+            return workers
+    if any(ref["meta"] is None and ref["bins"] for ref in index.refs.values()):
+        return workers
+    records = sum(ref["meta"][2] for ref in index.refs.values() if ref["meta"] is not None)
+    if records * num_samples < POOL_MIN_COLUMNS:
+        log.info("Merging %d records of %d samples without a process pool", records, num_samples)
+        return 1
+    return workers
+
+
+def job_signature(args):
+    """What a restart point must match: the input file and the options that change the output."""
+    st = os.stat(args.infile)
+    return {
+        "input": os.path.abspath(args.infile),
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "callers": args.callers,
+        "regions": args.regions,
+        "regions_file": args.regions_file,
+        "csi": args.csi,
+        "stats": bool(args.stats),
+    }
+
+
+def resume_output(outfile, state, csi, level=6):
+    """Reopen the partial output of an interrupted run at its restart point.
+    Exit with error message if the partial output does not match the restart point.
+    """
+    try:
+        out = VcfWriter.resume(outfile, state["offset"], csi=csi, level=level)
+    except (IOError, ValueError) as e:
+        log.error("Could not resume from %s: %s", outfile, e)
+        return 1
+    last = out.last_record.split(b"\t", 2)[:2] if out.last_record else []
+    if out.n_records != state["records"] or (
+        last and [last[0].decode(), int(last[1])] != [state["chrom"], state["pos"]]
+    ):
+        log.error("Partial output %s does not match its checkpoint", outfile)
+        return 1
+    return out
+
+
+def finalize_output(outfile, final, index_name=None):
+    """Rename a finished output to final, with its index (whichever of .tbi and .csi
+    VcfWriter chose) and the index's .fp; the output is renamed last.
+    """
+    if index_name is not None:
+        final_index = final + index_name[len(outfile) :]
+        os.replace(index_name + ".fp", final_index + ".fp")
+        os.replace(index_name, final_index)
+    os.replace(outfile, final)
+
+
+def skip_records(records, n, chrom, pos):
+    """Skip the n records (VcfRecords) of the input that a resumed run has already written,
+    checking that the last one is at chrom:pos.  Returns 1 if it is not.
+    """
+    last = None
+    for last in itertools.islice(records, n):
+        pass
+    if n and (last is None or (last.chrom, last.pos) != (chrom, pos)):
+        log.error(
+            "Input does not match the checkpoint (expected record %d at %s:%s)", n, chrom, pos
+        )
+        return 1
+    return 0
+
 
+def split_line(line):
+    """Split a raw VCF line (bytes) into a list of str columns."""
+    return line.decode().rstrip("\r\n").split("\t")
 
-def vcf_check(line):
+
+def vcf_check(line, n_callers=len(CALLERS)):
     """Rudimentary format check.
     Must have #CHROM-designated header row and >=2 genotype columns.
-    Must have an 3X number of genotype columns (does not actually
-    check pairing).
+    Must have an 3X (one block per caller) number of genotype columns
+    (does not actually check pairing).
     """
-    if (len(line) - 9) % 3 != 0 or len(line) < 12:
-        print("ERROR: Unpaired sample names detected.  File must contain triple number of samples.")
+    if (len(line) - 9) % n_callers != 0 or len(line) < 9 + n_callers:
+        log.error(
+            "Unpaired sample names detected.  File must contain %d blocks of samples, one per caller.",
+            n_callers,
+        )
         return 1
         sys.exit()
         # note that there should be (9 + 3 x no. of samples) number of columns
@@ -133,7 +378,7 @@ def evaluate_variant_line(line, start1, end1, start2, end2, start3, end3):
         line[snpID] = "."
         return line
     else:
-        print("ERROR: No caller annotation found in FORMAT field.")
+        log.error("No caller annotation found in FORMAT field.")
         return 1
         sys.exit()
 
@@ -168,8 +413,8 @@ def add_set_tag(caller, line):
 
 def remove_empty_genotypes(line, start1, end1, start2, end2, start3, end3):
     """For variants found by only one caller, remove empty (.:.:.) fields.
-       If only DeepVariant has call, set dv_priority_GT to the DV GT
-       Set all consensus GT to ./.
+    If only DeepVariant has call, set dv_priority_GT to the DV GT
+    Set all consensus GT to ./.
     """
     line[8] = line[8] + ":concensus_GT:dv_priority_GT"
 
@@ -191,8 +436,7 @@ def remove_empty_genotypes(line, start1, end1, start2, end2, start3, end3):
         line = line[0:9] + line[start3:end3]
         return line
     else:
-        print("remove_empty_genotypes ERROR: All genotype fields are blank.")
-        print(line)
+        log.error("remove_empty_genotypes: All genotype fields are blank.\n%s", line)
         return 1
         sys.exit()
 
@@ -263,11 +507,12 @@ def combine_genotypes(line, start1, end1, start2, end2, start3, end3):
     Finally, If only one caller has call, it's set to that GT
     """
 
-    for x, y, z in zip(line[start1:end1], line[start2:end2], line[start3:end3]):
+    for field, (x, y, z) in enumerate(
+        zip(line[start1:end1], line[start2:end2], line[start3:end3]), start1
+    ):
         geno1 = x.split(":")
         geno2 = y.split(":")
         geno3 = z.split(":")
-        field = line.index(x)
         for i, g1 in enumerate(geno1):
             if i == 0:
                 if (geno1[i] != geno2[i]) and (geno1[i] != geno3[i]) and (geno2[i] != geno3[i]):
@@ -294,40 +539,795 @@ def combine_genotypes(line, start1, end1, start2, end2, start3, end3):
     return line[0:end1]
 
 
-def add_headers(ts, ver, scriptName, cmdString):
+def filter_name(n):
+    """FILTER value for a variant called by n callers (oneCaller, twoCallers, ...)."""
+    word = NUMBER_WORDS[n - 1] if n <= len(NUMBER_WORDS) else str(n)
+    return word + ("Caller" if n == 1 else "Callers")
+
+
+def caller_sets(callers):
+    """All set= tags, smallest sets first (HC, DV, strelka2, HC-DV, ..., HC-DV-strelka2)."""
+    return [
+        "-".join(s) for n in range(1, len(callers) + 1) for s in itertools.combinations(callers, n)
+    ]
+
+
+def find_block_indices(line, n_callers=len(CALLERS)):
+    """Generalisation of find_genotype_indices to any number of callers:
+    returns a (start, end) pair for each caller's block of sample columns.
+    """
+    num_samples = (len(line) - 9) // n_callers
+    return [(9 + i * num_samples, 9 + (i + 1) * num_samples) for i in range(n_callers)]
+
+
+def flip_het(gt):
+    """flip_hets for bytes."""
+    return b"0/1" if gt == b"1/0" else gt
+
+
+def resolve_gts(gts, priority):
+    """GT, concensus_GT and dv_priority_GT of one sample from the GTs of all caller blocks
+    (bytes, in block order).  For three callers this is what combine_genotypes,
+    get_concensus_gt and get_dv_priority_gt compute; it generalises to any number:
+        GT: the first GT that another caller agrees with, otherwise ./.; a missing (.)
+            result is replaced by the first non-missing GT.
+        concensus_GT: the first GT that another caller agrees with (ignoring het
+            order), taking the merged GT for the first caller; otherwise ./.
+        dv_priority_GT: the priority caller's GT if fully called, otherwise the
+            concensus of the remaining callers.
+    """
+    n = len(gts)
+    merged = b"./."
+    for i in range(n):
+        if gts[i] in gts[i + 1 :] or gts[i] in gts[:i]:
+            merged = gts[i]
+            break
+    if merged == b".":
+        merged = next((g for g in gts[1:] if g != b"."), merged)
+    flipped = [flip_het(merged)] + [flip_het(g) for g in gts[1:]]
+    concensus = b"./."
+    for i in range(n):
+        if flipped[i] in flipped[i + 1 :]:
+            concensus = merged if i == 0 else gts[i]
+            break
+    if priority is not None and b"." not in gts[priority]:
+        return merged, concensus, gts[priority]
+    dv_priority = b"./."
+    others = [i for i in range(n) if i != priority]
+    for a, i in enumerate(others):
+        if any(flipped[i] == flipped[j] for j in others[a + 1 :]):
+            dv_priority = merged if i == 0 else gts[i]
+            break
+    return merged, concensus, dv_priority
+
+
+class GenotypeCache:
+    """GT, concensus_GT and dv_priority_GT of samples from their callers' GTs, with
+    the results of resolve_gts kept per combination of GTs: a cohort only has a few
+    distinct combinations, so almost every sample is a dictionary lookup.
+    """
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.resolved = {}
+        self.compare_codes = {}
+
+    def resolve(self, gts):
+        """(GT, concensus_GT, dv_priority_GT, codes) of a sample with the callers' GTs
+        gts (a tuple of bytes); codes are the comparable codes (see comparable_code) of
+        the GTs and of concensus_GT, for the ConcordanceStats.
+        """
+        result = self.resolved.get(gts)
+        if result is None:
+            gt, concensus, dv_priority = resolve_gts(gts, self.priority)
+            codes = tuple(map(self.comparable_code, gts + (concensus,)))
+            result = self.resolved[gts] = gt, concensus, dv_priority, codes
+        return result
+
+    def comparable_code(self, gt):
+        """Code a GT is compared by: the same for GTs that only differ in het allele
+        order (as for concensus_GT), -1 for a GT with a missing allele.
+        """
+        if b"." in gt:
+            return -1
+        return self.compare_codes.setdefault(flip_het(gt), len(self.compare_codes))
+
+
+class MergePlan:
+    """How to merge the records that share one FORMAT string.
+
+    mask        bit i is set if callers[i] has fields in FORMAT
+    tag         set= value (e.g. b"HC-DV")
+    filter      FILTER value (b"oneCaller", b"twoCallers", ...)
+    keep_id     only variants found by the first caller alone keep their ID
+    single      block index of the only caller, or None
+    n_fields    number of FORMAT fields
+    owners      block index of the caller owning each FORMAT field (None for GT)
+    gt_fields   index of each caller's <caller>_GT field (None if absent)
+    format_out  FORMAT of the merged record
+    """
+
+    __slots__ = (
+        "mask",
+        "tag",
+        "filter",
+        "keep_id",
+        "single",
+        "n_fields",
+        "owners",
+        "gt_fields",
+        "format_out",
+    )
+
+    def __init__(self, frmt, callers):
+        keys = frmt.split(b":")
+        prefixes = [c.encode() + b"_" for c in callers]
+        self.owners = tuple(
+            next((i for i, p in enumerate(prefixes) if key.startswith(p)), None) if k else None
+            for k, key in enumerate(keys)
+        )
+        self.mask = 0
+        for owner in self.owners:
+            if owner is not None:
+                self.mask |= 1 << owner
+        members = [i for i in range(len(callers)) if self.mask >> i & 1]
+        self.tag = "-".join(callers[i] for i in members).encode()
+        self.filter = filter_name(len(members)).encode() if members else b""
+        self.single = members[0] if len(members) == 1 else None
+        self.keep_id = members == [0]
+        self.n_fields = len(keys)
+        self.gt_fields = tuple(
+            keys.index(p + b"GT") if p + b"GT" in keys else None for p in prefixes
+        )
+        self.format_out = frmt + b":concensus_GT:dv_priority_GT"
+
+
+class RecordTokenizer:
+    """Byte-level processing of bcftools merge --force-samples records.
+
+    evaluate() gives the same result as evaluate_variant_line, but works on the raw
+    record (bytes) and only splits the columns it has to change.  For variants
+    found by one caller, the empty caller blocks are recognised by comparing
+    them with an all-missing template (./.:.:...), so the surviving block is sliced
+    out of the record without looking at individual samples.  Records that do not
+    match the template, and records found by several callers, are handled column by
+    column.
+
+    Classification uses a MergePlan per distinct FORMAT string, cached in self.plans,
+    and works for any number of callers (default: HC, DV, strelka2 in block order).
+    If self.stats is set to a ConcordanceStats, every merged record is counted in it.
+    """
+
+    MISSING_SUFFIX = b":./.:./."
+    # first column of a sample (GT) and the rest of it; only matches at column starts
+    SAMPLE = re.compile(rb"(?<![^\t])([^\t:]*)([^\t]*)")
+
+    def __init__(self, headerLine, callers=CALLERS):
+        self.callers = list(callers)
+        self.indices = find_block_indices(headerLine, len(self.callers))
+        self.num_samples = num_samples = self.indices[0][1] - self.indices[0][0]
+        self.priority = self.callers.index("DV") if "DV" in self.callers else None
+        column = rb"[^\t]*"
+        block = b"(" + rb"(?:" + column + rb"\t){%d}" % (num_samples - 1) + column + b")"
+        self.blocks = re.compile(rb"\t".join([block] * len(self.callers)))
+        self.empty_blocks = {}
+        self.plans = {}
+        self.genotypes = GenotypeCache(self.priority)
+        self.stats = None
+
+    def plan(self, frmt):
+        """MergePlan for a FORMAT string (cached)."""
+        plan = self.plans.get(frmt)
+        if plan is None:
+            plan = self.plans[frmt] = MergePlan(frmt, self.callers)
+        return plan
+
+    def empty_block(self, n_fields):
+        """All-missing sample columns for one caller block, for a FORMAT of n_fields fields."""
+        if n_fields not in self.empty_blocks:
+            sample = b"./." + b":." * (n_fields - 1)
+            self.empty_blocks[n_fields] = b"\t".join([sample] * self.num_samples)
+        return self.empty_blocks[n_fields]
+
+    def split_blocks(self, samples):
+        """Split the sample columns into the callers' blocks."""
+        m = self.blocks.fullmatch(samples)
+        if m is None:
+            raise ValueError(
+                "Record does not have "
+                + str(len(self.callers))
+                + " x "
+                + str(self.num_samples)
+                + " samples"
+            )
+        return m.groups()
+
+    def surviving_block(self, samples, plan):
+        """For a variant found by one caller, return (index, sample columns) of the block that
+        has calls, searching the blocks in order as remove_empty_genotypes does.
+        """
+        empty = self.empty_block(plan.n_fields) + b"\t"
+        k = plan.single
+        before = empty * k
+        after = (b"\t" + empty * (len(self.callers) - k - 1))[:-1]
+        if samples.startswith(before) and samples.endswith(after):
+            block = samples[len(before) : len(samples) - len(after)]
+            if b"0" in block or b"1" in block:
+                return k, block
+            return None, None
+        for i, block in enumerate(self.split_blocks(samples)):
+            if b"0" in block or b"1" in block:
+                return i, block
+        return None, None
+
+    def merge_blocks(self, blocks, plan):
+        """Integrate the callers' sample columns (combine_genotypes for any number of callers):
+        each field takes the first non-missing value across the blocks, and GT,
+        concensus_GT and dv_priority_GT come from the GenotypeCache.  The fields of each
+        block are handled as one flat list (sample by sample); samples that do not have
+        every FORMAT field are merged one at a time by merge_samples.
+        """
+        fields = []
+        for block in blocks:
+            if block.count(b":") != self.num_samples * (plan.n_fields - 1):
+                return self.merge_samples(blocks, plan)
+            fields.append(block.replace(b"\t", b":").split(b":"))
+        n = plan.n_fields
+        merged = fields[0]
+        for other in fields[1:]:
+            merged = [f if f != b"." else o for f, o in zip(merged, other)]
+        results = [self.genotypes.resolve(gts) for gts in zip(*[f[::n] for f in fields])]
+        merged[::n] = [result[0] for result in results]
+        if self.stats is not None:
+            codes = np.array([result[3] for result in results], dtype=np.int64).T
+            self.stats.add(plan.tag, codes[:-1], codes[-1])
+        return b"\t".join(
+            b":".join(merged[i * n : (i + 1) * n]) + b":" + result[1] + b":" + result[2]
+            for i, result in enumerate(results)
+        )
+
+    def merge_samples(self, blocks, plan):
+        """merge_blocks one sample at a time, for records whose samples have differing
+        numbers of fields.
+        """
+        merged = []
+        compare = []
+        for samples in zip(*[block.split(b"\t") for block in blocks]):
+            genos = [s.split(b":") for s in samples]
+            fields = [
+                next((v for v in values if v != b"."), b".")
+                for values in itertools.zip_longest(*genos, fillvalue=b".")
+            ][: len(genos[0])]
+            gt, concensus, dv_priority, codes = self.genotypes.resolve(tuple(g[0] for g in genos))
+            compare.append(codes)
+            fields[0] = gt
+            fields.append(concensus)
+            fields.append(dv_priority)
+            merged.append(b":".join(fields))
+        if self.stats is not None:
+            codes = np.array(compare, dtype=np.int64).T
+            self.stats.add(plan.tag, codes[:-1], codes[-1])
+        return b"\t".join(merged)
+
+    def stage(self, records):
+        """Transform stage (see common.chain_stages): yields the merged VcfRecord of each record.
+        Raises ValueError for a record that cannot be merged.
+        """
+        for rec in records:
+            merged = self.evaluate(bytes(rec))
+            if merged == 1:
+                raise ValueError("Could not merge the record at " + rec.chrom + ":" + str(rec.pos))
+            yield VcfRecord(merged)
+
+    def evaluate(self, rec):
+        """Byte-level equivalent of evaluate_variant_line for one raw record.
+        Returns the output record (bytes, with newline), or 1 on error.
+        """
+        line = rec.rstrip(b"\r\n").split(b"\t", 9)
+        plan = self.plans.get(line[frmt]) or self.plan(line[frmt])
+        if not plan.mask:
+            log.error("No caller annotation found in FORMAT field.")
+            return 1
+        if plan.single is None:
+            line[9] = self.merge_blocks(self.split_blocks(line[9]), plan)
+        else:
+            block_index, block = self.surviving_block(line[9], plan)
+            if block is None:
+                log.error(
+                    "remove_empty_genotypes: All genotype fields are blank.\n%s",
+                    rec.decode().rstrip(),
+                )
+                return 1
+            if self.stats is not None:
+                self.stats.add(plan.tag)
+            if block_index == self.priority:
+                block = self.SAMPLE.sub(rb"\1\2:./.:\1", block)
+            else:
+                block = block.replace(b"\t", self.MISSING_SUFFIX + b"\t") + self.MISSING_SUFFIX
+            line[9] = block
+        line[info] += b";set=" + plan.tag
+        line[filt] = plan.filter
+        line[frmt] = plan.format_out
+        if not plan.keep_id:
+            line[snpID] = b"."
+        return b"\t".join(line) + b"\n"
+
+
+class ProfilingTokenizer(RecordTokenizer):
+    """RecordTokenizer that keeps the CPU time spent combining caller blocks (merge_blocks)
+    and classifying (the rest of evaluate) in self.times, for --profile.
+    """
+
+    def __init__(self, headerLine, callers=CALLERS):
+        super().__init__(headerLine, callers)
+        self.times = {"classify": 0.0, "combine": 0.0}
+
+    def evaluate(self, rec):
+        start = time.process_time()
+        combine = self.times["combine"]
+        result = super().evaluate(rec)
+        elapsed = time.process_time() - start
+        self.times["classify"] += elapsed - (self.times["combine"] - combine)
+        return result
+
+    def merge_blocks(self, blocks, plan):
+        start = time.process_time()
+        result = super().merge_blocks(blocks, plan)
+        self.times["combine"] += time.process_time() - start
+        return result
+
+
+class MergedChunk(list):
+    """Merged records of a chunk, with the tokenizer CPU times spent on them and the
+    worker that merged them (for --profile) and their ConcordanceStats (for --stats).
+    """
+
+    times = None
+    worker = None
+    stats = None
+
+
+class ConcordanceStats:
+    """Caller concordance of the merged records, for --stats: records per caller set, and
+    for each sample how often each pair of callers agree on the GT (compared as for
+    concensus_GT, over the records that both callers called) and how often concensus_GT
+    is a no-call.  Counted by the RecordTokenizer while it merges, from the GT codes it
+    already has; counts of separate chunks are combined with update().
+    """
+
+    def __init__(self, n_callers, num_samples):
+        self.n_callers = n_callers
+        self.sets = Counter()
+        self.records = 0
+        self.pairs = list(itertools.combinations(range(n_callers), 2))
+        self.compared = np.zeros((len(self.pairs), num_samples), dtype=np.int64)
+        self.agreed = np.zeros_like(self.compared)
+        self.no_calls = np.zeros(num_samples, dtype=np.int64)
+
+    def fresh(self):
+        """An empty ConcordanceStats of the same shape."""
+        return ConcordanceStats(self.n_callers, len(self.no_calls))
+
+    def add(self, tag, gts=None, concensus=None):
+        """Count a merged record with set= tag (bytes).  gts: (callers x samples) array of comparable GT codes
+        (GenotypeCache.comparable_code), concensus: those of concensus_GT; both None for a
+        variant found by one caller, whose concensus_GT is always a no-call.
+        """
+        self.records += 1
+        self.sets[tag.decode()] += 1
+        if gts is None:
+            self.no_calls += 1
+            return
+        called = gts >= 0
+        for p, (i, j) in enumerate(self.pairs):
+            both = called[i] & called[j]
+            self.compared[p] += both
+            self.agreed[p] += both & (gts[i] == gts[j])
+        self.no_calls += concensus < 0
+
+    def update(self, other):
+        """Add the counts of another ConcordanceStats."""
+        self.records += other.records
+        self.sets.update(other.sets)
+        self.compared += other.compared
+        self.agreed += other.agreed
+        self.no_calls += other.no_calls
+
+    def state(self):
+        """The counts as JSON-compatible values (to save with a checkpoint)."""
+        return {
+            "records": self.records,
+            "sets": dict(self.sets),
+            "compared": self.compared.tolist(),
+            "agreed": self.agreed.tolist(),
+            "no_calls": self.no_calls.tolist(),
+        }
+
+    def load(self, state):
+        """Restore the counts saved by state()."""
+        self.records = state["records"]
+        self.sets = Counter(state["sets"])
+        self.compared[:] = state["compared"]
+        self.agreed[:] = state["agreed"]
+        self.no_calls[:] = state["no_calls"]
+
+    def report(self, fname, callers, samples):
+        """Write the statistics as JSON.  Each sample has a callers x callers matrix of GT
+        agreement rates (null where the two callers never both called it) and one of
+        the number of records compared.
+        """
+        n = len(callers)
+
+        def matrix(values, diagonal):
+            rows = [[diagonal] * n for _ in range(n)]
+            for (i, j), value in zip(self.pairs, values):
+                rows[i][j] = rows[j][i] = value
+            return rows
+
+        per_sample = {}
+        for s, sample in enumerate(samples):
+            compared = self.compared[:, s].tolist()
+            agreed = self.agreed[:, s].tolist()
+            per_sample[sample] = {
+                "agreement": matrix(
+                    [round(a / c, 6) if c else None for a, c in zip(agreed, compared)], 1.0
+                ),
+                "compared": matrix(compared, None),
+                "concensus_GT_no_calls": int(self.no_calls[s]),
+            }
+        cells = self.records * len(samples)
+        report = {
+            "records": self.records,
+            "sets": dict(sorted(self.sets.items())),
+            "callers": list(callers),
+            "concensus_GT_no_call_rate": (
+                round(int(self.no_calls.sum()) / cells, 6) if cells else None
+            ),
+            "samples": per_sample,
+        }
+        with open(fname, "w") as f:
+            json.dump(report, f, separators=(",", ":"))
+
+
+class Profiler:
+    """Collects the --profile report: wall time of the stages of the main process (parse:
+    reading and splitting the input, write: compression and indexing), CPU time of each
+    worker (classify and combine: see ProfilingTokenizer), records per caller set,
+    throughput and memory use.  With trace_memory the top allocators of the main process
+    are traced as well, from start_memory_trace on.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.start = time.perf_counter()
+        self.times = {"parse": 0.0, "write": 0.0}
+        self.worker_times = defaultdict(lambda: {"classify": 0.0, "combine": 0.0})
+        self.sets = Counter()
+        self.records = 0
+        self.trace_memory = trace_memory
+        self.peak = 0
+        self.peak_snapshot = None
+
+    def start_memory_trace(self):
+        """Start tracing allocations, with trace_memory.  Called once the worker pool has
+        started, so that the workers, which are forked from this process, do not trace
+        (and pay for) their own allocations.
+        """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def timed(self, iterable, stage):
+        """Iterate, adding the time spent producing each item to stage."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.times[stage] += time.perf_counter() - start
+                return
+            self.times[stage] += time.perf_counter() - start
+            yield item
+
+    def add_chunk(self, merged):
+        """Count the records of a merged chunk by caller set."""
+        self.records += len(merged)
+        for rec in merged:
+            self.sets[rec.split(b"\t", 8)[info].rpartition(b";set=")[2].decode()] += 1
+        if getattr(merged, "times", None):
+            for stage, seconds in merged.times.items():
+                self.worker_times[merged.worker][stage] += seconds
+        if not tracemalloc.is_tracing():
+            return
+        traced = tracemalloc.get_traced_memory()[0]
+        if traced > self.peak * 1.1:
+            # keep the allocations of the largest memory footprint seen
+            self.peak = traced
+            self.peak_snapshot = tracemalloc.take_snapshot()
+
+    def report(self, fname, **extra):
+        """Write the report as JSON."""
+        wall = time.perf_counter() - self.start
+        worker_total = Counter()
+        for times in self.worker_times.values():
+            worker_total.update(times)
+        report = {
+            "records": self.records,
+            "wall_seconds": round(wall, 3),
+            "records_per_second": round(self.records / wall, 1) if wall else None,
+            "stage_wall_seconds": {stage: round(t, 3) for stage, t in self.times.items()},
+            "worker_cpu_seconds": {
+                str(worker): {stage: round(t, 3) for stage, t in times.items()}
+                for worker, times in sorted(self.worker_times.items(), key=lambda w: str(w[0]))
+            },
+            "total_worker_cpu_seconds": {stage: round(t, 3) for stage, t in worker_total.items()},
+            "sets": dict(sorted(self.sets.items())),
+            "peak_rss_mb": {
+                "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            },
+        }
+        if tracemalloc.is_tracing():
+            snapshot = (self.peak_snapshot or tracemalloc.take_snapshot()).filter_traces(
+                [tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+            )
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report["tracemalloc"] = {
+                "peak_mb": round(traced_peak / 2**20, 3),
+                "top": [
+                    {
+                        "location": str(stat.traceback),
+                        "size_kb": round(stat.size / 1024, 1),
+                        "count": stat.count,
+                    }
+                    for stat in snapshot.statistics("lineno")[:10]
+                ],
+            }
+        report.update(extra)
+        with open(fname, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def chunk_records(records, chunk_bytes):
+    """Group records (VcfRecords or lines) into chunks of about chunk_bytes (bytes, whole
+    records only), the unit of work passed between pipeline stages and worker processes.
+    """
+    chunk = []
+    size = 0
+    for rec in records:
+        rec = bytes(rec)
+        chunk.append(rec)
+        size += len(rec)
+        if size >= chunk_bytes:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+# RecordTokenizer of a worker process (set by init_worker)
+worker_tokenizer = None
+
+# inputs with fewer sample columns (samples x records) are merged without a process pool:
+# a single process merges a column in about 3 us, and the pool costs about 15 ms to start
+# and 0.2 us per column to pass the chunks, so even 2 workers only gain above ~10000
+POOL_MIN_COLUMNS = 20000
+
+
+def make_tokenizer(headerLine, callers, profile=False, stats=False):
+    """RecordTokenizer for merge_chunks (a ProfilingTokenizer for --profile, collecting
+    ConcordanceStats for --stats).
+    """
+    tokenizer = (ProfilingTokenizer if profile else RecordTokenizer)(headerLine, callers)
+    if stats:
+        tokenizer.stats = ConcordanceStats(len(tokenizer.callers), tokenizer.num_samples)
+    return tokenizer
+
+
+def init_worker(headerLine, callers, profile=False, stats=False):
+    global worker_tokenizer
+    if tracemalloc.is_tracing():
+        # forked from a main process that traces its allocations
+        tracemalloc.stop()
+    worker_tokenizer = make_tokenizer(headerLine, callers, profile, stats)
+
+
+def evaluate_chunk(chunk, tokenizer=None):
+    """Merge a chunk of records (in a worker, unless a tokenizer is given);
+    returns the output records, or 1 on error.
+    """
+    tokenizer = tokenizer or worker_tokenizer
+    records = map(VcfRecord, chunk.splitlines(keepends=True))
+    times = dict(getattr(tokenizer, "times", {}))
+    if tokenizer.stats is not None:
+        tokenizer.stats = tokenizer.stats.fresh()
+    try:
+        merged = MergedChunk(bytes(rec) for rec in chain_stages(records, tokenizer.stage))
+    except ValueError as e:
+        log.error("%s", e)
+        return 1
+    if times:
+        merged.times = {stage: tokenizer.times[stage] - t for stage, t in times.items()}
+        merged.worker = "main" if tokenizer is not worker_tokenizer else os.getpid()
+    merged.stats = tokenizer.stats
+    return merged
+
+
+def merge_chunks(
+    chunks, headerLine, callers, workers=1, max_inflight=2, profile=False, stats=False, started=None
+):
+    """Merge chunks of records; yields the merged records of each chunk (or 1 on error)
+    in input order.  With several workers the chunks are merged in a process pool,
+    with at most max_inflight chunks queued or being merged at a time, which bounds
+    memory use.  started, if given, is called once the pool's workers have started
+    (or, without a pool, before the first chunk is merged).
+    """
+    if workers <= 1:
+        tokenizer = make_tokenizer(headerLine, callers, profile, stats)
+        if started is not None:
+            started()
+        for chunk in chunks:
+            yield evaluate_chunk(chunk, tokenizer)
+        return
+    pool = ProcessPoolExecutor(
+        workers, initializer=init_worker, initargs=(headerLine, callers, profile, stats)
+    )
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.submit(evaluate_chunk, chunk))
+            if started is not None:
+                # the first submit starts the workers
+                started()
+                started = None
+            while len(pending) >= max_inflight or (pending and pending[0].done()):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def write_chunks(merged_chunks, out, checkpoint=None, profiler=None, stats=None):
+    """Write merged chunks; returns 1 if a chunk could not be merged.
+    A checkpoint, if given, is updated between chunks, and the chunks' ConcordanceStats
+    are added to stats, if given.
+    """
+    for merged in merged_chunks:
+        if merged == 1:
+            return 1
+        start = time.perf_counter()
+        for rec in merged:
+            out.write_record(rec)
+        if stats is not None:
+            stats.update(merged.stats)
+        if checkpoint is not None:
+            checkpoint.update(out)
+        if profiler is not None:
+            profiler.times["write"] += time.perf_counter() - start
+            profiler.add_chunk(merged)
+    return 0
+
+
+def run_pipeline(
+    records, out, merge, chunk_bytes, queue_depth, checkpoint=None, profiler=None, stats=None
+):
+    """Run reading (and decompression), merging and writing (and compression) as three
+    stages connected by queues of at most queue_depth chunks: a reader thread, the
+    merge stage in this thread (merge: function from an iterator of chunks to an
+    iterator of merged chunks) and a writer thread.  zlib releases the GIL, so the
+    stages overlap.  Returns (status, queues); the queues' stall counters show
+    which stage held up the others.
+    """
+    read_q = StageQueue(queue_depth)
+    write_q = StageQueue(queue_depth)
+    stop = threading.Event()
+    errors = []
+
+    def reader():
+        chunks = chunk_records(records, chunk_bytes)
+        if profiler is not None:
+            chunks = profiler.timed(chunks, "parse")
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                read_q.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            read_q.put(None)
+
+    def writer():
+        try:
+            status = write_chunks(iter(write_q.get, None), out, checkpoint, profiler, stats)
+        except Exception as e:
+            errors.append(e)
+            status = 1
+        if status == 1:
+            stop.set()
+            while write_q.get() is not None:
+                pass
+
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    status = 0
+    merged_chunks = merge(iter(read_q.get, None))
+    try:
+        for merged in merged_chunks:
+            write_q.put(merged)
+            if merged == 1 or stop.is_set():
+                status = 1
+                break
+    finally:
+        merged_chunks.close()
+        write_q.put(None)
+        stop.set()
+        while threads[0].is_alive():
+            try:
+                read_q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        threads[1].join()
+    if errors:
+        raise errors[0]
+    return status, {"reader": read_q, "writer": write_q}
+
+
+def report_stalls(queues):
+    """Log how long each pipeline stage waited on its neighbours."""
+    read_q, write_q = queues["reader"], queues["writer"]
+    waits = [
+        ("reader", "output", read_q.put_stalls, read_q.put_wait),
+        ("merge", "input", read_q.get_stalls, read_q.get_wait),
+        ("merge", "output", write_q.put_stalls, write_q.put_wait),
+        ("writer", "input", write_q.get_stalls, write_q.get_wait),
+    ]
+    for stage, direction, stalls, seconds in waits:
+        log.info("pipeline %s: waited %.2f s for %s (%d stalls)", stage, seconds, direction, stalls)
+
+
+def add_headers(ts, ver, scriptName, cmdString, callers=CALLERS):
     """Add metadata to the vcf
     To A) account for new INFO field and to B) document provenance.
     ###TODO: add reference info as well?
     """
-    infoHeader = '##INFO=<ID=set,Number=.,Type=String,Description="Set of callers that identified a variant (HC, DV, strelka2, HC-DV, HC-strelka2, DV-strelka2, or HC-DV-strelka2 )">'
-    filterHeaderOneCaller = (
-        '##FILTER=<ID=oneCaller,Description="The variant was called by exactly one caller">'
-    )
-    filterHeaderTwoCallers = (
-        '##FILTER=<ID=twoCallers,Description="The variant was called by exactly two callers">'
-    )
-    filterHeaderThreeCallers = (
-        '##FILTER=<ID=threeCallers,Description="The variant was called by all three callers">'
+    sets = caller_sets(callers)
+    setList = sets[0] if len(sets) == 1 else ", ".join(sets[:-1]) + ", or " + sets[-1] + " "
+    infoHeader = (
+        '##INFO=<ID=set,Number=.,Type=String,Description="Set of callers that identified a variant ('
+        + setList
+        + ')">'
     )
+    filterHeaders = []
+    for n in range(1, len(callers) + 1):
+        amount = "all " if n == len(callers) and n > 1 else "exactly "
+        word = NUMBER_WORDS[n - 1] if n <= len(NUMBER_WORDS) else str(n)
+        filterHeaders.append(
+            "##FILTER=<ID="
+            + filter_name(n)
+            + ',Description="The variant was called by '
+            + amount
+            + word
+            + (" caller" if n == 1 else " callers")
+            + '">'
+        )
     formatHeaderConcensusGT = (
         '##FORMAT=<ID=concensus_GT,Number=1,Type=String,Description="Genotype">'
     )
     formatHeaderDVPriorityGT = (
         '##FORMAT=<ID=dv_priority_GT,Number=1,Type=String,Description="Genotype">'
     )
+    callerList = (
+        callers[0] if len(callers) == 1 else ", ".join(callers[:-1]) + " and " + callers[-1]
+    )
     prov1 = (
-        "##"
-        + scriptName
-        + "_Version="
-        + ver
-        + ", Union of HC, DV and strelka2 genotype data, "
-        + ts
+        "##" + scriptName + "_Version=" + ver + ", Union of " + callerList + " genotype data, " + ts
     )
     prov2 = "##" + scriptName + "_Command=" + cmdString
-    return [
-        filterHeaderOneCaller,
-        filterHeaderTwoCallers,
-        filterHeaderThreeCallers,
+    return filterHeaders + [
         infoHeader,
         formatHeaderConcensusGT,
         formatHeaderDVPriorityGT,
@@ -339,22 +1339,130 @@ def add_headers(ts, ver, scriptName, cmdString):
 #####################################################################################################
 
 
-if __name__ == "__main__":
+def open_output(args, stats):
+    """Checkpoint of a --checkpoint/--resume run (or None), the state to resume from (or
+    None) and the VcfWriter of the output; the state also restores the counts of stats.
+    Returns 1 if the output cannot be resumed.
+    """
+    checkpoint = state = None
+    if args.checkpoint or args.resume:
+        checkpoint = Checkpoint(
+            args.outfile + ".ckpt",
+            job_signature(args),
+            args.checkpoint_interval,
+            extra=(lambda: {"stats": stats.state()}) if stats is not None else None,
+        )
+        state = checkpoint.load() if args.resume else None
+    if not state:
+        return checkpoint, state, VcfWriter(args.outfile, csi=args.csi, level=args.level)
+    if stats is not None:
+        stats.load(state["stats"])
+    out = resume_output(args.outfile, state, args.csi, args.level)
+    if out == 1:
+        return 1
+    return checkpoint, state, out
+
+
+def open_input(args):
+    """VcfReader of the input, restricted to --regions/--regions-file if given, and the
+    index it reads them with (or None).  Returns 1 if the input cannot be read by region.
+    """
+    regions = index = None
+    if args.regions or args.regions_file:
+        regions = get_regions(args.infile, args.regions, args.regions_file)
+        if regions == 1:
+            return 1
+        index, regions = regions
+    return VcfReader(args.infile, regions, index), index
+
+
+def merge_records(args, records, out, headerLine, workers, checkpoint, profiler, stats):
+    """Merge the records into out, through the reader/merger/writer pipeline if
+    --queue-depth is set.  Returns 0, or 1 on error.
+    """
+
+    def merge(chunks):
+        return merge_chunks(
+            chunks,
+            headerLine,
+            args.callers,
+            workers,
+            args.max_inflight or 2 * workers,
+            profile=profiler is not None,
+            stats=stats is not None,
+            started=profiler.start_memory_trace if profiler is not None else None,
+        )
+
+    if args.queue_depth > 0:
+        status, queues = run_pipeline(
+            records, out, merge, args.chunk_bytes, args.queue_depth, checkpoint, profiler, stats
+        )
+        if args.stall_report:
+            report_stalls(queues)
+        return status
+    chunks = chunk_records(records, args.chunk_bytes)
+    if profiler is not None:
+        chunks = profiler.timed(chunks, "parse")
+    return write_chunks(merge(chunks), out, checkpoint, profiler, stats)
+
+
+def finish(args, out, samples, workers, checkpoint, profiler, stats):
+    """Close the output and write the --profile report and --stats of the merged
+    samples; then drop the checkpoint and give the output its --final name.
+    """
+    if profiler is not None:
+        start = time.perf_counter()
+        index_name = out.close()
+        profiler.times["write"] += time.perf_counter() - start
+        profiler.report(args.profile, input=args.infile, workers=workers)
+    else:
+        index_name = out.close()
+    if stats is not None:
+        stats.report(args.stats, args.callers, samples)
+    if checkpoint is not None:
+        checkpoint.remove()
+    if args.final:
+        finalize_output(args.outfile, args.final, index_name)
+
+
+def main():
     ts = str(datetime.datetime.now())
     ver = "someversion"  # https://stackoverflow.com/questions/5581722/how-can-i-rewrite-python-version-with-git
     scriptName = sys.argv[0]
     cmdString = " ".join(sys.argv)
-    infile, outfile = get_args()
-    check_file(infile)
-    headerLine = get_header(infile)
-    start1, end1, start2, end2, start3, end3 = find_genotype_indices(headerLine)
-    with open(infile, "r") as file, open(outfile, "w") as out:
-        for line in csv.reader(file, delimiter="\t"):
-            if re.search(r"#", line[chrom]) is None:
-                line = evaluate_variant_line(line, start1, end1, start2, end2, start3, end3)
-                out.write("\t".join(line) + "\n")
-            elif "#CHROM" in line:
-                out.write("\n".join(add_headers(ts, ver, scriptName, cmdString)) + "\n")
-                out.write("\t".join(line[0:start2]) + "\n")
-            else:
-                out.write("\t".join(line) + "\n")
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    check_file(args.infile)
+    headerLine = get_header(args.infile, len(args.callers))
+    if headerLine == 1:
+        sys.exit(1)
+    end1 = find_block_indices(headerLine, len(args.callers))[0][1]
+    stats = ConcordanceStats(len(args.callers), end1 - 9) if args.stats else None
+    opened = open_output(args, stats)
+    if opened == 1:
+        sys.exit(1)
+    checkpoint, state, out = opened
+    opened = open_input(args)
+    if opened == 1:
+        sys.exit(1)
+    reader, index = opened
+    header = reader.header + [
+        (h + "\n").encode() for h in add_headers(ts, ver, scriptName, cmdString, args.callers)
+    ]
+    header.append(("\t".join(reader.columns[0:end1]) + "\n").encode())
+    if not state:
+        out.write_header(header)
+    records = iter(reader)
+    if state and skip_records(records, state["records"], state.get("chrom"), state.get("pos")) == 1:
+        sys.exit(1)
+
+    profiler = Profiler(args.profile_memory) if args.profile else None
+    workers = pool_workers(args.infile, min(args.workers, available_cpus()), end1 - 9, index)
+    status = merge_records(args, records, out, headerLine, workers, checkpoint, profiler, stats)
+    if status == 1:
+        sys.exit(1)
+    finish(args, out, reader.columns[9:end1], workers, checkpoint, profiler, stats)
+
+
+if __name__ == "__main__":
+    main()
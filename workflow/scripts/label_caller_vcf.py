@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+Labels the INFO and FORMAT fields of one caller's VCF with the caller name, in one
+pass from the normalized VCF to a bgzipped, indexed output.
+
+The output is the same as that of prepend_labels.sh run on the header and the
+records of the VCF (and concatenated again):
+    - every INFO field is prefixed with the label (AF=0.5 becomes HC_AF=0.5), and
+      the original QUAL is added as <caller>_QUAL
+    - every FORMAT field is prefixed with the label, and GT is duplicated: the
+      first entry stays GT, so that bcftools merge works as intended
+    - the ##INFO and ##FORMAT header lines are renamed to match, and the GT and
+      <caller>_QUAL definitions are inserted before the <caller>_GT one
+"""
+
+import argparse
+import logging
+import re
+import sys
+
+from common import VcfReader, VcfWriter, chain_stages, map_stage, write_records
+
+log = logging.getLogger("label_caller_vcf")
+
+# first subfield (GT) of each sample column; only matches at column starts
+SAMPLE_GT = re.compile(rb"(?<![^\t])([^\t:]*)")
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Prepend the caller label to the INFO and FORMAT fields of a VCF, duplicate GT and keep QUAL in INFO."
+    )
+    parser.add_argument("infile", help="Input VCF file name (.vcf, .vcf.gz or .bcf)")
+    parser.add_argument(
+        "outfile", help="Output VCF file name; names ending in .gz are written as indexed BGZF"
+    )
+    parser.add_argument("--caller", required=True, help="Caller label (e.g. HC, DV or strelka2)")
+    parser.add_argument(
+        "--csi",
+        action="store_true",
+        default=None,
+        help="Write a .csi instead of a .tbi index (the default is chosen from contig lengths)",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        default=6,
+        choices=range(10),
+        metavar="0-9",
+        help="BGZF compression level of the output (default: %(default)s)",
+    )
+    return parser.parse_args()
+
+
+def label_header(lines, caller):
+    """Header lines (bytes) with the INFO and FORMAT IDs labelled, as prepend_labels.sh does it."""
+    label = caller.encode() + b"_"
+    gt_line = b"##FORMAT=<ID=" + label + b"GT"
+    inserted = [
+        b'##FORMAT=<ID=GT,Number=1,Type=String,Description="Concordant Genotype">\n',
+        b"##INFO=<ID="
+        + label
+        + b'QUAL,Number=1,Type=String,Description="Record of original QUAL value">\n',
+    ]
+    labelled = []
+    for line in lines:
+        line = line.replace(b"##INFO=<ID=", b"##INFO=<ID=" + label, 1)
+        line = line.replace(b"##FORMAT=<ID=", b"##FORMAT=<ID=" + label, 1)
+        if gt_line in line:
+            labelled.extend(inserted)
+        labelled.append(line)
+    return labelled
+
+
+def label_record(line, caller):
+    """One record (bytes) with its INFO and FORMAT fields labelled.
+    Raises ValueError for a record without sample columns.
+    """
+    label = caller.encode() + b"_"
+    if line.endswith(b"\n"):
+        line = line[:-1]
+    cols = line.split(b"\t", 9)
+    if len(cols) < 10:
+        raise ValueError("Record has no sample columns: " + line.decode(errors="replace")[:200])
+    cols[7] = label + cols[7].replace(b";", b";" + label) + b";" + label + b"QUAL=" + cols[5]
+    cols[8] = b"GT:" + label + cols[8].replace(b":", b":" + label)
+    cols[9] = SAMPLE_GT.sub(rb"\1:\1", cols[9])
+    return b"\t".join(cols) + b"\n"
+
+
+def label_vcf(reader, out, caller):
+    """Write the labelled header and records of reader (a common.VcfReader) with out
+    (a common.VcfWriter); returns the number of records.
+    """
+    header = reader.header + [("\t".join(reader.columns) + "\n").encode()]
+    out.write_header(label_header(header, caller))
+    return write_records(
+        chain_stages(reader.lines(), map_stage(lambda line: label_record(line, caller))), out
+    )
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    reader = VcfReader(args.infile)
+    if reader.columns is None:
+        log.error("File must contain header row matching VCF specification")
+        sys.exit(1)
+    out = VcfWriter(args.outfile, csi=args.csi, level=args.level)
+    try:
+        label_vcf(reader, out, args.caller)
+    except ValueError as e:
+        log.error("%s", e)
+        sys.exit(1)
+    out.close()
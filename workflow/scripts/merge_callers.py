@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+"""
+Merges the labeled VCFs of HaplotypeCaller, DeepVariant and Strelka2 into one record
+per variant with the union of the callers' genotype data.
+
+The result is what bcftools merge --force-samples -m none followed by
+genotype_union.py gives, without the intermediate VCF that has one block of sample
+columns per caller.  The callers' VCFs (labelled by label_caller_vcf.py, sorted) are
+read side by side and merged on (contig, POS, REF, ALT), contigs in the order of the
+reference .dict, with a heap; each variant gets the set= tag, FILTER, GT,
+concensus_GT and dv_priority_GT that genotype_union.py gives it, and the other
+fields as bcftools merge combines them:
+    - ID: kept only for variants found by the first caller alone (as genotype_union.py)
+    - QUAL: the highest of the callers' QUALs
+    - INFO: the callers' fields in caller order, fields with Number=A, R or G last
+    - FORMAT: GT followed by each caller's labelled fields, missing values filled in
+"""
+
+import argparse
+import datetime
+import heapq
+import itertools
+import logging
+import re
+import sys
+
+import numpy as np
+
+from common import VcfReader, VcfWriter, read_dict
+from genotype_union import (
+    CALLERS,
+    ConcordanceStats,
+    GenotypeCache,
+    RecordTokenizer,
+    add_headers,
+    filter_name,
+)
+
+log = logging.getLogger("merge_callers")
+
+# VCF columns
+CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, FORMAT, SAMPLES = range(10)
+
+# header lines identified by their key and ID (##INFO=<ID=...) rather than their whole text
+STRUCTURED = re.compile(rb"##(\w+)=<ID=([^,>]*)")
+INFO_NUMBER = re.compile(rb"##INFO=<ID=([^,>]*),Number=([^,>]*)")
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Merge the labeled VCFs of several callers into one VCF with the union of their genotypes."
+    )
+    parser.add_argument(
+        "outfile", help="Output VCF file name; names ending in .gz are written as indexed BGZF"
+    )
+    parser.add_argument(
+        "infiles", nargs="+", help="Labeled caller VCFs (.vcf, .vcf.gz or .bcf), one per caller"
+    )
+    parser.add_argument(
+        "--callers",
+        nargs="+",
+        default=CALLERS,
+        help="Callers of the input files, in the same order (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dict",
+        help="Reference sequence dictionary (.dict) giving the contig order; by default the"
+        + " ##contig lines of the first input",
+    )
+    parser.add_argument(
+        "--csi",
+        action="store_true",
+        default=None,
+        help="Write a .csi instead of a .tbi index (the default is chosen from contig lengths)",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        default=6,
+        choices=range(10),
+        metavar="0-9",
+        help="BGZF compression level of the output (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="JSON",
+        help="Write caller concordance statistics to this file (see genotype_union.py --stats)",
+    )
+    return parser.parse_args()
+
+
+def header_contigs(header):
+    """Contig order of the ##contig lines of a header: {name (bytes): rank}."""
+    order = {}
+    for line in header:
+        m = STRUCTURED.match(line)
+        if m and m.group(1) == b"contig":
+            order.setdefault(m.group(2), len(order))
+    return order
+
+
+def agr_fields(header):
+    """IDs of the INFO fields with one value per allele or genotype (Number=A, R or G),
+    which bcftools merge writes after the others.
+    """
+    fields = set()
+    for line in header:
+        m = INFO_NUMBER.match(line)
+        if m and m.group(2) in (b"A", b"R", b"G"):
+            fields.add(m.group(1))
+    return fields
+
+
+def merge_headers(headers):
+    """Meta-information lines of several headers: those of the first, followed by the lines
+    of the others that it does not have (structured lines are compared by key and ID).
+    """
+    merged = []
+    seen = set()
+    for header in headers:
+        for line in header:
+            m = STRUCTURED.match(line)
+            key = m.groups() if m else line
+            if line.startswith(b"##fileformat=") and merged:
+                continue
+            if key not in seen:
+                seen.add(key)
+                merged.append(line)
+    return merged
+
+
+def caller_records(reader, order, caller):
+    """Yields (key, columns) for the records of a caller's VCF in merge order, key being
+    (contig rank, POS, REF, ALT); records at one position are sorted by REF and ALT.
+    Raises ValueError for unsorted input or contigs missing from the order.
+    """
+    group = []
+    last = None
+    for line in reader.lines():
+        cols = line.rstrip(b"\r\n").split(b"\t", SAMPLES)
+        rank = order.get(cols[CHROM])
+        if rank is None:
+            raise ValueError(
+                caller + ": contig " + cols[CHROM].decode() + " is not in the contig order"
+            )
+        site = (rank, int(cols[POS]))
+        if site != last:
+            if last is not None and site < last:
+                raise ValueError(
+                    caller
+                    + ": records are not sorted at "
+                    + cols[CHROM].decode()
+                    + ":"
+                    + cols[POS].decode()
+                )
+            group.sort(key=lambda record: record[0])
+            yield from group
+            group = []
+            last = site
+        group.append((site + (cols[REF], cols[ALT]), cols))
+    group.sort(key=lambda record: record[0])
+    yield from group
+
+
+def variant_groups(streams):
+    """Merge the callers' record streams (see caller_records); yields {caller index: columns}
+    for each variant.  A variant repeated in a caller's VCF is paired with the repeats of
+    the other callers in order.
+    """
+    tagged = [zip(itertools.repeat(i), stream) for i, stream in enumerate(streams)]
+    merged = heapq.merge(*tagged, key=lambda record: record[1][0])
+    for _, records in itertools.groupby(merged, key=lambda record: record[1][0]):
+        per_caller = {}
+        for i, (_, cols) in records:
+            per_caller.setdefault(i, []).append(cols)
+        for j in range(max(len(r) for r in per_caller.values())):
+            yield {i: r[j] for i, r in per_caller.items() if j < len(r)}
+
+
+class CallerMerger:
+    """Builds the merged record of a variant from the callers' records (see the module
+    docstring).  sample_orders gives, per caller, the positions of the first caller's
+    samples among its sample columns (None if they are in the same order), and
+    agr the INFO fields with Number=A, R or G of each caller.
+    """
+
+    # sample columns: GT and the rest of the column
+    SAMPLE = re.compile(rb"(?<![^\t])([^\t:]*)([^\t]*)")
+
+    def __init__(self, callers, num_samples, agr, sample_orders=None, stats=None):
+        self.callers = list(callers)
+        self.num_samples = num_samples
+        self.agr = agr
+        self.sample_orders = sample_orders or [None] * len(self.callers)
+        self.priority = self.callers.index("DV") if "DV" in self.callers else None
+        self.genotypes = GenotypeCache(self.priority)
+        self.missing_gts = [b"./."] * num_samples
+        self.tags = {}
+        self.stats = stats
+
+    def tag(self, members):
+        """set= tag, FILTER and FORMAT keys of the variants found by a set of callers."""
+        if members not in self.tags:
+            self.tags[members] = (
+                "-".join(self.callers[i] for i in members).encode(),
+                filter_name(len(members)).encode(),
+            )
+        return self.tags[members]
+
+    def samples(self, i, cols):
+        """The sample columns of caller i, in the first caller's sample order, with the
+        trailing fields bcftools leaves out filled in.
+        """
+        samples = cols[SAMPLES]
+        order = self.sample_orders[i]
+        if order is not None:
+            columns = samples.split(b"\t")
+            samples = b"\t".join(columns[k] for k in order)
+        n_fields = cols[FORMAT].count(b":") + 1
+        if (
+            samples.count(b":") != self.num_samples * (n_fields - 1)
+            or samples.count(b"\t") != self.num_samples - 1
+        ):
+            columns = samples.split(b"\t")
+            if len(columns) != self.num_samples:
+                raise ValueError(
+                    self.callers[i]
+                    + ": record at "
+                    + cols[CHROM].decode()
+                    + ":"
+                    + cols[POS].decode()
+                    + " does not have "
+                    + str(self.num_samples)
+                    + " samples"
+                )
+            samples = b"\t".join(
+                c + b":." * (n_fields - 1 - c.count(b":")) if c else b"./." + b":." * (n_fields - 1)
+                for c in columns
+            )
+        return samples
+
+    def merge(self, group):
+        """The merged record (bytes, with newline) of {caller index: columns}.
+        Raises ValueError for a record that cannot be merged.
+        """
+        members = tuple(sorted(group))
+        first = group[members[0]]
+        tag, filt = self.tag(members)
+        for i in members:
+            if not (group[i][FORMAT] == b"GT" or group[i][FORMAT].startswith(b"GT:")):
+                raise ValueError(
+                    self.callers[i]
+                    + ": FORMAT does not start with GT at "
+                    + first[CHROM].decode()
+                    + ":"
+                    + first[POS].decode()
+                )
+        if len(members) == 1:
+            frmt = first[FORMAT]
+            block = self.samples(members[0], first)
+            if b"0" not in block and b"1" not in block:
+                raise ValueError(
+                    "All genotype fields are blank at "
+                    + first[CHROM].decode()
+                    + ":"
+                    + first[POS].decode()
+                )
+            if self.stats is not None:
+                self.stats.add(tag)
+            if members[0] == self.priority:
+                block = RecordTokenizer.SAMPLE.sub(rb"\1\2:./.:\1", block)
+            else:
+                block = (
+                    block.replace(b"\t", RecordTokenizer.MISSING_SUFFIX + b"\t")
+                    + RecordTokenizer.MISSING_SUFFIX
+                )
+        else:
+            frmt = b"GT" + b"".join(group[i][FORMAT][2:] for i in members)
+            gt_columns = [self.missing_gts] * len(self.callers)
+            rests = []
+            for i in members:
+                pairs = self.SAMPLE.findall(self.samples(i, group[i]))
+                gt_columns[i], rest = zip(*pairs)
+                rests.append(rest)
+            results = [self.genotypes.resolve(gts) for gts in zip(*gt_columns)]
+            if self.stats is not None:
+                codes = np.array([result[3] for result in results], dtype=np.int64).T
+                self.stats.add(tag, codes[:-1], codes[-1])
+            block = b"\t".join(
+                result[0] + b"".join(rest) + b":" + result[1] + b":" + result[2]
+                for result, rest in zip(results, zip(*rests))
+            )
+        direct = []
+        agr = []
+        for i in members:
+            if group[i][INFO] == b".":
+                continue
+            for field in group[i][INFO].split(b";"):
+                (agr if field.split(b"=", 1)[0] in self.agr[i] else direct).append(field)
+        quals = [group[i][QUAL] for i in members if group[i][QUAL] != b"."]
+        line = [
+            first[CHROM],
+            first[POS],
+            first[ID] if members == (0,) else b".",
+            first[REF],
+            first[ALT],
+            max(quals, key=float) if quals else b".",
+            filt,
+            (b";".join(direct + agr) or b".") + b";set=" + tag,
+            frmt + b":concensus_GT:dv_priority_GT",
+            block,
+        ]
+        return b"\t".join(line) + b"\n"
+
+
+def open_callers(infiles, callers, order=None):
+    """Open the callers' VCFs; returns (readers, contig order, CallerMerger arguments:
+    sample names, per-caller sample orders and INFO fields with Number=A, R or G).
+    Raises ValueError if the files do not have the same samples.
+    """
+    readers = [VcfReader(f) for f in infiles]
+    for f, reader in zip(infiles, readers):
+        if reader.columns is None:
+            raise ValueError(f + " has no #CHROM header line")
+    samples = readers[0].samples
+    sample_orders = []
+    for f, reader in zip(infiles, readers):
+        if sorted(reader.samples) != sorted(samples) or len(set(samples)) != len(samples):
+            raise ValueError(f + " does not have the same samples as " + infiles[0])
+        if reader.samples == samples:
+            sample_orders.append(None)
+        else:
+            position = {s: k for k, s in enumerate(reader.samples)}
+            sample_orders.append([position[s] for s in samples])
+    if order is None:
+        order = header_contigs(merge_headers([r.header for r in readers]))
+    agr = [agr_fields(r.header) for r in readers]
+    return readers, order, (samples, sample_orders, agr)
+
+
+def merge_callers(readers, order, samples, sample_orders, agr, out, callers, stats=None):
+    """Write the merged records of the callers' VCFs with out (a common.VcfWriter);
+    returns the number of records.  Raises ValueError for input that cannot be merged.
+    """
+    merger = CallerMerger(callers, len(samples), agr, sample_orders, stats)
+    streams = [caller_records(r, order, c) for r, c in zip(readers, callers)]
+    n = 0
+    for group in variant_groups(streams):
+        out.write_record(merger.merge(group))
+        n += 1
+    return n
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    ts = str(datetime.datetime.now())
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    if len(args.infiles) != len(args.callers):
+        log.error("Give one input file per caller (%s)", " ".join(args.callers))
+        sys.exit(1)
+    try:
+        order = read_dict(args.dict) if args.dict else None
+        readers, order, (samples, sample_orders, agr) = open_callers(
+            args.infiles, args.callers, order
+        )
+    except (IOError, ValueError) as e:
+        log.error("%s", e)
+        sys.exit(1)
+    stats = ConcordanceStats(len(args.callers), len(samples)) if args.stats else None
+    header = merge_headers([r.header for r in readers])
+    header += [
+        (h + "\n").encode()
+        for h in add_headers(ts, "someversion", sys.argv[0], " ".join(sys.argv), args.callers)
+    ]
+    header.append(("\t".join(readers[0].columns[:9] + samples) + "\n").encode())
+    out = VcfWriter(args.outfile, csi=args.csi, level=args.level)
+    out.write_header(header)
+    try:
+        merge_callers(readers, order, samples, sample_orders, agr, out, args.callers, stats)
+    except ValueError as e:
+        log.error("%s", e)
+        sys.exit(1)
+    out.close()
+    if stats is not None:
+        stats.report(args.stats, args.callers, samples)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+Plans the regions that the variant callers are run on (with by_chrom_gvcf), so that
+each region takes about the same time to call for the cohort.
+
+Calling time follows the reads more than the length of the targets, so the work of each
+16 kb window of the genome is estimated from the samples' BAM or CRAM indexes: the span
+of the reads that the .bai bins point to, or the size of the CRAM slices of the .crai.
+The work of a window is spread over the targets of the capture BED in it, and each
+target base also costs a small share of the mean (TARGET_COST), so that targets without
+reads are not free.  The windows are then cut into regions as plan_shards.py cuts the
+genome into shards: large chromosomes at window boundaries, and runs of small contigs
+together, each region being a stretch of the genome in .dict order.
+
+The .bai contigs are taken to be those of the .dict, in its order; an index that does
+not have as many contigs, or cannot be read (such as a .csi), only adds the target sizes.
+
+The output directory gets one BED file per region (<region>.bed, the targets of the
+region) and regions.tsv, listing the regions in order with their targets and estimated
+work.
+"""
+
+import argparse
+import gzip
+import logging
+import struct
+import sys
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from common import TBI_DEPTH, TBI_MIN_SHIFT, VcfIndex, read_bed_regions, sort_regions
+from plan_shards import (
+    COMPRESSION_RATIO,
+    index_weights,
+    plan_shards,
+    read_dict_lengths,
+    write_shards,
+)
+
+log = logging.getLogger("plan_call_regions")
+
+WINDOW = 1 << TBI_MIN_SHIFT
+
+# work of one target base, as a share of the mean work per target base
+TARGET_COST = 0.05
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Split the capture regions into calling regions with about the same work."
+    )
+    parser.add_argument("outdir", help="Output directory for <region>.bed and regions.tsv")
+    parser.add_argument("bed", help="Capture regions (BED)")
+    parser.add_argument("indexes", nargs="*", help=".bai/.crai indexes of the samples' reads")
+    parser.add_argument(
+        "--dict",
+        required=True,
+        help="Reference sequence dictionary (.dict): contig order and lengths",
+    )
+    parser.add_argument("--regions", type=int, required=True, help="Number of regions to aim for")
+    return parser.parse_args()
+
+
+def read_bai(fname, names):
+    """A .bai index as a VcfIndex, with the contigs named after names (in order)."""
+    with open(fname, "rb") as f:
+        data = f.read()
+    if data[:4] != b"BAI\x01":
+        raise ValueError("Not a BAM index: " + fname)
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    if n_ref != len(names):
+        raise ValueError("%s has %d contigs, the .dict %d" % (fname, n_ref, len(names)))
+    meta_bin = ((1 << (3 * TBI_DEPTH + 3)) - 1) // 7 + 1
+    pos = 8
+    refs = []
+    for _ in range(n_ref):
+        bins = {}
+        meta = None
+        n_bin = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        for _ in range(n_bin):
+            b, n_chunk = struct.unpack_from("<Ii", data, pos)
+            chunks = struct.unpack_from("<%dQ" % (2 * n_chunk), data, pos + 8)
+            pos += 8 + 16 * n_chunk
+            if b != meta_bin:
+                bins[b] = list(zip(chunks[::2], chunks[1::2]))
+            else:
+                meta = chunks
+        n_intv = struct.unpack_from("<i", data, pos)[0]
+        pos += 4 + 8 * n_intv
+        refs.append({"bins": bins, "loffs": {}, "lidx": [], "meta": meta})
+    return VcfIndex(False, TBI_MIN_SHIFT, TBI_DEPTH, names, refs)
+
+
+def crai_weights(fname, names):
+    """Approximate uncompressed size of the reads of a .crai index per window:
+    {contig: {window start: size}}.  Each slice is spread evenly over the positions it spans.
+    """
+    weights = defaultdict(lambda: defaultdict(float))
+    with gzip.open(fname, "rt") as f:
+        for line in f:
+            fields = line.split("\t")
+            ref, start, span, size = int(fields[0]), int(fields[1]), int(fields[2]), int(fields[5])
+            # unmapped (-1) and multi-reference (-2) slices
+            if ref < 0 or span <= 0:
+                continue
+            if ref >= len(names):
+                raise ValueError("%s has more contigs than the .dict" % fname)
+            beg, end = start - 1, start - 1 + span
+            for w in range(beg - beg % WINDOW, end, WINDOW):
+                overlap = min(end, w + WINDOW) - max(beg, w)
+                weights[names[ref]][w] += size * COMPRESSION_RATIO * overlap / span
+    return weights
+
+
+def read_weights(fname, names):
+    """Reads of a .bai or .crai index per window: {contig: {window start: size}}."""
+    with open(fname, "rb") as f:
+        magic = f.read(4)
+    if magic == b"BAI\x01":
+        return index_weights(read_bai(fname, names), records=False)
+    if fname.endswith(".crai"):
+        return crai_weights(fname, names)
+    raise ValueError("Not a .bai or .crai index: " + fname)
+
+
+def target_weights(targets, reads):
+    """Work of the targets per window, from the reads ({contig: {window start: size}}, the
+    windows of all samples summed) and TARGET_COST: {contig: {window start: work}}.
+    """
+    pieces = []
+    for name, beg, end in targets:
+        for w in range(beg - beg % WINDOW, end, WINDOW):
+            pieces.append((name, w, min(end, w + WINDOW) - max(beg, w)))
+    target_bases = sum(overlap for _, _, overlap in pieces)
+    if not target_bases:
+        return {}
+    work = [reads.get(name, {}).get(w, 0.0) * overlap / WINDOW for name, w, overlap in pieces]
+    base_cost = TARGET_COST * max(sum(work) / target_bases, 1.0)
+    weights = defaultdict(lambda: defaultdict(float))
+    for (name, w, overlap), read_work in zip(pieces, work):
+        weights[name][w] += read_work + overlap * base_cost
+    return weights
+
+
+def clip_targets(targets, regions):
+    """The targets (sorted, disjoint) inside the regions (contig, start, end), clipped."""
+    by_contig = defaultdict(list)
+    for target in targets:
+        by_contig[target[0]].append(target)
+    clipped = []
+    for name, beg, end in regions:
+        contig = by_contig[name]
+        ends = [t[2] for t in contig]
+        starts = [t[1] for t in contig]
+        for _, t_beg, t_end in contig[bisect_right(ends, beg) : bisect_left(starts, end)]:
+            clipped.append((name, max(beg, t_beg), min(end, t_end)))
+    return clipped
+
+
+def plan_call_regions(targets, reads, lengths, n_regions):
+    """Cut the targets (sorted in .dict order) into about n_regions regions of about equal
+    work; returns a list of (targets, work).
+    """
+    shards = plan_shards(target_weights(targets, reads), lengths, n_regions)
+    return [(clip_targets(targets, regions), work) for regions, work in shards]
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    lengths = read_dict_lengths(args.dict)
+    names = list(lengths)
+    targets = sort_regions(read_bed_regions(args.bed), names)
+    reads = defaultdict(lambda: defaultdict(float))
+    for fname in args.indexes:
+        try:
+            weights = read_weights(fname, names)
+        except (IOError, ValueError, EOFError, struct.error) as e:
+            log.warning("Not using the reads of %s: %s", fname, e)
+            continue
+        for name, w in weights.items():
+            for pos, size in w.items():
+                reads[name][pos] += size
+    if not targets:
+        log.error("No region of %s is on a contig of %s", args.bed, args.dict)
+        sys.exit(1)
+    regions = plan_call_regions(targets, reads, lengths, args.regions)
+    write_shards(args.outdir, regions, kind="region", weight="estimated_work")
+    log.info("%d regions for %d indexes", len(regions), len(args.indexes))
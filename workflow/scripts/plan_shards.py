@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Plans the shards of the ensemble stage from the indexes of the callers' VCFs, so that
+each shard holds about the same number of variants.
+
+The records of each contig are estimated per index bin from the bins' chunks (the
+compressed span of their records, scaled to the contig's record count in the index's
+pseudo-bin) and summed over the callers.  Spans across BGZF blocks are put on the scale
+of spans within a block with the compression ratio of the first blocks of the indexed
+VCF, when it is next to its index.  Walking the contigs in .dict order, a shard
+is closed whenever it has its share of the records: large contigs are cut at bin
+boundaries into several shards, and runs of small contigs (chrM, unplaced and alt
+contigs) are packed into one.  Each shard is a stretch of the genome in .dict order, so
+that the shard outputs concatenate back in reference order.
+
+The output directory gets one BED file per shard (<shard>.bed, for bcftools -R/-T) and
+shards.tsv, listing the shards in order with their regions and estimated records.
+"""
+
+import argparse
+import logging
+import os
+import struct
+import sys
+from collections import defaultdict
+
+from common import VcfIndex, bin_first_position, read_bgzf_block
+
+log = logging.getLogger("plan_shards")
+
+# rough BGZF compression ratio of VCF text, for indexes without their VCF
+COMPRESSION_RATIO = 4
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Split the genome into shards with about the same number of variants."
+    )
+    parser.add_argument("outdir", help="Output directory for <shard>.bed and shards.tsv")
+    parser.add_argument("indexes", nargs="+", help=".tbi/.csi indexes of the callers' VCFs")
+    parser.add_argument(
+        "--dict",
+        required=True,
+        help="Reference sequence dictionary (.dict): contig order and lengths",
+    )
+    parser.add_argument("--shards", type=int, required=True, help="Number of shards to aim for")
+    return parser.parse_args()
+
+
+def read_dict_lengths(fname):
+    """Contigs of a sequence dictionary in order: {name: length}."""
+    lengths = {}
+    with open(fname) as f:
+        for line in f:
+            if line.startswith("@SQ"):
+                fields = dict(field.split(":", 1) for field in line.rstrip("\r\n").split("\t")[1:])
+                lengths[fields["SN"]] = int(fields["LN"])
+    return lengths
+
+
+def compression_ratio(fname, blocks=64):
+    """Uncompressed over compressed size of the first BGZF blocks of fname."""
+    raw = data = 0
+    with open(fname, "rb") as f:
+        for _ in range(blocks):
+            block = read_bgzf_block(f)
+            if len(block) <= 4:
+                break
+            raw += len(block)
+            data += struct.unpack("<I", block[-4:])[0]
+    return data / raw if data else COMPRESSION_RATIO
+
+
+def chunk_span(start, end, ratio=COMPRESSION_RATIO):
+    """Approximate uncompressed size of the records between two virtual offsets."""
+    return max(((end >> 16) - (start >> 16)) * ratio + (end & 0xFFFF) - (start & 0xFFFF), 1)
+
+
+def index_weights(index, ratio=COMPRESSION_RATIO, records=True):
+    """Estimated records of an index: {contig: {bin start position: records}}, or with
+    records False the approximate uncompressed size of the records.
+    """
+    weights = {}
+    for name, ref in index.refs.items():
+        spans = defaultdict(float)
+        for b, chunks in ref["bins"].items():
+            pos = bin_first_position(b, index.min_shift, index.depth)
+            spans[pos] += sum(chunk_span(s, e, ratio) for s, e in chunks)
+        total = sum(spans.values())
+        if not total:
+            continue
+        # records per span unit, from the record count of the pseudo-bin when there is one
+        scale = ref["meta"][2] / total if records and ref["meta"] and ref["meta"][2] else 1.0
+        weights[name] = {pos: span * scale for pos, span in spans.items()}
+    return weights
+
+
+def plan_shards(weights, lengths, n_shards):
+    """Cut the contigs of lengths (in order) with records in weights ({contig: {position:
+    records}}) into about n_shards shards of about equal records.  Returns a list of
+    (regions, records), regions being (contig, 0-based start, end) in order.
+    """
+    remaining = sum(sum(w.values()) for w in weights.values())
+    target = remaining / max(n_shards, 1)
+    shards = []
+    regions, records = [], 0.0
+    for name, length in lengths.items():
+        if name not in weights:
+            continue
+        beg = 0
+        for pos, w in sorted(weights[name].items()):
+            # close the shard before this bin if it is closer to its share without it
+            if records and pos > beg and records + w / 2 > target:
+                regions.append((name, beg, pos))
+                shards.append((regions, records))
+                # share the rest out again, so that the last shard is not left with the slack
+                remaining -= records
+                target = remaining / max(n_shards - len(shards), 1)
+                regions, records, beg = [], 0.0, pos
+            records += w
+        regions.append((name, beg, length))
+    if regions:
+        shards.append((regions, records))
+    return shards
+
+
+def write_shards(outdir, shards, kind="shard", weight="estimated_records"):
+    """Write <kind>NNNN.bed for each shard and <kind>s.tsv; returns the shard names."""
+    os.makedirs(outdir, exist_ok=True)
+    names = ["%s%04d" % (kind, i + 1) for i in range(len(shards))]
+    with open(os.path.join(outdir, kind + "s.tsv"), "w") as tsv:
+        tsv.write("#%s\tregions\t%s\n" % (kind, weight))
+        for name, (regions, records) in zip(names, shards):
+            with open(os.path.join(outdir, name + ".bed"), "w") as bed:
+                for contig, beg, end in regions:
+                    bed.write("%s\t%d\t%d\n" % (contig, beg, end))
+            tsv.write(
+                "%s\t%s\t%d\n"
+                % (name, ",".join("%s:%d-%d" % (c, b + 1, e) for c, b, e in regions), records)
+            )
+    return names
+
+
+def read_shards(outdir, kind="shard"):
+    """Shard names of a plan, in order."""
+    with open(os.path.join(outdir, kind + "s.tsv")) as f:
+        return [line.split("\t", 1)[0] for line in f if not line.startswith("#")]
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    lengths = read_dict_lengths(args.dict)
+    weights = defaultdict(lambda: defaultdict(float))
+    for fname in args.indexes:
+        data = os.path.splitext(fname)[0]
+        try:
+            index = VcfIndex.read(fname)
+            ratio = compression_ratio(data) if os.path.exists(data) else COMPRESSION_RATIO
+        except (IOError, ValueError) as e:
+            log.error("Could not read index %s: %s", fname, e)
+            sys.exit(1)
+        for name, w in index_weights(index, ratio).items():
+            if name not in lengths:
+                log.error("Contig %s of %s is not in %s", name, fname, args.dict)
+                sys.exit(1)
+            for pos, records in w.items():
+                weights[name][pos] += records
+    shards = plan_shards(weights, lengths, args.shards)
+    write_shards(args.outdir, shards)
+    log.info(
+        "%d shards of about %d records",
+        len(shards),
+        sum(records for _, records in shards) / max(len(shards), 1),
+    )
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Rewrites the header of a sorted, indexed BGZF VCF without decompressing its records.
+
+The new header is written in blocks of its own, the BGZF block that holds the end of
+the old header is recompressed with the records it holds, and every other block is
+copied byte for byte; the output index is the input's with its offsets shifted, so the
+output does not need to be read again by tabix.  It is meant for VCFs that are already
+compressed and indexed; a VCF that is being written anyway is better fixed in its stream.
+
+The header can be changed with regular expression substitutions applied to every
+## line (--replace, as many as needed, in order), or replaced with the header of
+another file (--header), which must have the same sample columns.
+"""
+
+import argparse
+import logging
+import re
+import sys
+
+from common import (
+    BGZF_EOF,
+    BgzfWriter,
+    VcfIndexer,
+    index_suffix,
+    open_vcf_lines,
+    save_index_fingerprint,
+)
+from concat_vcfs import NotConcatenable, Part, copy_records
+
+log = logging.getLogger("rewrite_header")
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Rewrite the header of an indexed BGZF VCF, copying its records as they are."
+    )
+    parser.add_argument("infile", help="Input VCF (.vcf.gz, indexed)")
+    parser.add_argument("outfile", help="Output VCF (.vcf.gz); its index is written next to it")
+    parser.add_argument(
+        "--replace",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("PATTERN", "REPLACEMENT"),
+        help="Python regular expression substitution applied to each ## line (repeatable)",
+    )
+    parser.add_argument(
+        "--header", help="File whose header (## lines and #CHROM line) replaces the input's"
+    )
+    return parser.parse_args()
+
+
+def substitutions(pairs):
+    """Header transform (list of lines -> list of lines) applying (pattern, replacement)
+    pairs, as str or bytes, to every ## line in turn.
+    """
+    compiled = [
+        (
+            re.compile(p.encode() if isinstance(p, str) else p),
+            r.encode() if isinstance(r, str) else r,
+        )
+        for p, r in pairs
+    ]
+
+    def transform(lines):
+        changed = []
+        for line in lines:
+            if line.startswith(b"##"):
+                for pattern, replacement in compiled:
+                    line = pattern.sub(replacement, line)
+            changed.append(line)
+        return changed
+
+    return transform
+
+
+def read_header(fname):
+    """Header lines (bytes, the #CHROM line last) of a VCF or plain header file."""
+    header = []
+    for line in open_vcf_lines(fname):
+        if not line.startswith(b"#"):
+            break
+        header.append(line if line.endswith(b"\n") else line + b"\n")
+    return header
+
+
+def rewrite_header(infile, outfile, transform):
+    """Write infile to outfile (BGZF) with its header (lines, #CHROM last) passed through
+    transform, and the index of outfile; returns the index name.
+    Raises NotConcatenable if infile is not an indexed BGZF VCF, and ValueError if the
+    new header does not end with the same #CHROM line.
+    """
+    part = Part(infile)
+    columns = ("\t".join(part.columns) + "\n").encode()
+    header = transform(part.header + [columns])
+    if not header or header[-1] != columns:
+        raise ValueError("The new header of " + infile + " does not end with its #CHROM line")
+    index = part.index
+    indexer = VcfIndexer(csi=index.csi, min_shift=index.min_shift, depth=index.depth)
+    with open(outfile, "wb") as out:
+        writer = BgzfWriter(out)
+        writer.write(b"".join(header))
+        writer.flush()
+        if part.start is not None:
+            copy_records(part, out, indexer)
+        out.write(BGZF_EOF)
+    index_name = outfile + index_suffix(indexer)
+    indexer.write(index_name)
+    save_index_fingerprint(outfile, index_name)
+    return index_name
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    if args.header:
+        new_header = read_header(args.header)
+
+        def transform(lines):
+            return new_header
+
+    else:
+        transform = substitutions(args.replace)
+    try:
+        rewrite_header(args.infile, args.outfile, transform)
+    except (NotConcatenable, IOError, ValueError) as e:
+        log.error("%s", e)
+        sys.exit(1)
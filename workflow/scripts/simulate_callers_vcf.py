@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+"""
+Writes a synthetic three-caller VCF for testing and benchmarking genotype_union.py.
+
+The records look like the ensemble/all_callers.vcf.gz that bcftools merge
+--force-samples builds from the prepended HaplotypeCaller, DeepVariant and
+Strelka2 VCFs: one block of sample columns per caller (s1 ... 2:s1 ... 3:s1 ...),
+caller-prefixed INFO and FORMAT fields, and all-missing columns in the blocks of
+callers that did not call the variant.
+"""
+
+import argparse
+import bisect
+import itertools
+import logging
+import random
+import sys
+
+from common import VcfWriter
+
+log = logging.getLogger("simulate_callers_vcf")
+
+CALLERS = ["HC", "DV", "strelka2"]
+
+# FORMAT fields after <caller>_GT, in the order the callers write them
+CALLER_FORMAT = {
+    "HC": ["AD", "DP", "GQ", "PL"],
+    "DV": ["DP", "AD", "GQ", "PL", "RNC"],
+    "strelka2": ["DP", "AD", "GQ", "FT", "ADF", "ADR", "RNC"],
+}
+# HaplotypeCaller adds physical phasing fields to some records
+HC_PHASED_FORMAT = ["AD", "DP", "GQ", "PGT", "PID", "PL"]
+
+CALLER_INFO = {
+    "HC": ["AC", "AF", "AN", "DP", "QUAL"],
+    "DV": ["AF", "AQ", "AC", "AN", "QUAL"],
+    "strelka2": ["AF", "AQ", "AC", "AN", "QUAL"],
+}
+
+# caller-set mix of the chr3 test region (tests/expected_outputs), for --mix
+DEFAULT_MIX = "HC-DV-strelka2=0.86,strelka2=0.08,HC=0.02,DV=0.02,HC-strelka2=0.01,HC-DV=0.005,DV-strelka2=0.005"
+
+# GRCh38 autosome lengths
+CONTIG_LENGTHS = {
+    "chr1": 248956422,
+    "chr2": 242193529,
+    "chr3": 198295559,
+    "chr4": 190214555,
+    "chr5": 181538259,
+    "chr6": 170805979,
+    "chr7": 159345973,
+    "chr8": 145138636,
+    "chr9": 138394717,
+    "chr10": 133797422,
+    "chr11": 135086622,
+    "chr12": 133275309,
+    "chr13": 114364328,
+    "chr14": 107043718,
+    "chr15": 101991189,
+    "chr16": 90338345,
+    "chr17": 83257441,
+    "chr18": 80373285,
+    "chr19": 58617616,
+    "chr20": 64444167,
+    "chr21": 46709983,
+    "chr22": 50818468,
+}
+
+GENOTYPES = ["0/0", "0/1", "1/1"]
+# distinct sample values drawn per caller and genotype; samples are picked from these
+POOL_SIZE = 64
+
+
+def get_args():
+    """Handle command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic bcftools merge --force-samples style VCF of HaplotypeCaller, DeepVariant and Strelka2 calls."
+    )
+    parser.add_argument(
+        "outfile", help="Output VCF; names ending in .gz are written as indexed BGZF, - is stdout"
+    )
+    parser.add_argument(
+        "--samples", type=int, default=100, help="Number of samples (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--variants", type=int, default=10000, help="Number of records (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help="Relative frequency of each caller set, as set=weight pairs separated by commas"
+        + " (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--discordance",
+        type=float,
+        default=0.03,
+        help="Probability that a caller reports another genotype than the true one (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--missing",
+        type=float,
+        default=0.02,
+        help="Probability that a caller does not call a sample (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--contigs",
+        type=int,
+        default=22,
+        help="Spread the records over the first N autosomes (default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: %(default)s)")
+    return parser.parse_args()
+
+
+def parse_mix(text):
+    """Parse --mix into a list of (caller tuple, weight).
+    Raises ValueError for unknown callers or malformed pairs.
+    """
+    mix = []
+    for item in text.split(","):
+        name, sep, weight = item.partition("=")
+        members = tuple(name.strip().split("-"))
+        if not sep or any(c not in CALLERS for c in members) or len(set(members)) != len(members):
+            raise ValueError("Bad caller set in --mix: " + item)
+        mix.append((tuple(c for c in CALLERS if c in members), float(weight)))
+    return mix
+
+
+def caller_format(caller, phased=False):
+    """FORMAT fields of one caller, with its label."""
+    fields = HC_PHASED_FORMAT if phased else CALLER_FORMAT[caller]
+    return [caller + "_GT"] + [caller + "_" + f for f in fields]
+
+
+def make_header(samples, contigs):
+    """Header lines (str) of the merged VCF."""
+    header = [
+        "##fileformat=VCFv4.2",
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Concordant Genotype">',
+    ]
+    for caller in CALLERS:
+        fields = caller_format(caller, caller == "HC") + caller_format(caller)
+        for field in sorted(set(fields), key=fields.index):
+            header.append(
+                "##FORMAT=<ID=" + field + ',Number=.,Type=String,Description="Simulated">'
+            )
+        for field in CALLER_INFO[caller]:
+            header.append(
+                "##INFO=<ID="
+                + caller
+                + "_"
+                + field
+                + ',Number=.,Type=String,Description="Simulated">'
+            )
+    for contig in contigs:
+        header.append("##contig=<ID=" + contig + ",length=" + str(CONTIG_LENGTHS[contig]) + ">")
+    header.append(
+        "\t".join(
+            ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+            + samples
+            + ["2:" + s for s in samples]
+            + ["3:" + s for s in samples]
+        )
+    )
+    return header
+
+
+def sample_values(rng, caller, gt, phased=False):
+    """FORMAT values (after GT and <caller>_GT) of one caller's call."""
+    depth = rng.randint(8, 80)
+    alt = {"0/0": 0, "0/1": depth // 2 + rng.randint(-3, 3), "1/1": depth}.get(gt, 0)
+    alt = min(max(alt, 0), depth)
+    ad = str(depth - alt) + "," + str(alt)
+    gq = str(rng.randint(5, 99))
+    pl = [rng.randint(20, 900) for _ in range(3)]
+    pl[GENOTYPES.index(gt) if gt in GENOTYPES else 0] = 0
+    pl = ",".join(map(str, pl))
+    values = {
+        "AD": ad,
+        "DP": str(depth),
+        "GQ": gq,
+        "PL": pl,
+        "RNC": "..",
+        "FT": "PASS",
+        "ADF": str((depth - alt) // 2) + "," + str(alt // 2),
+        "ADR": str(depth - alt - (depth - alt) // 2) + "," + str(alt - alt // 2),
+        "PGT": "0|1",
+        "PID": str(rng.randint(10000, 99999)) + "_A_G",
+    }
+    return [values[f] for f in (HC_PHASED_FORMAT if phased else CALLER_FORMAT[caller])]
+
+
+def value_pools(rng, caller, phased=False):
+    """For each genotype, POOL_SIZE distinct values of one caller's FORMAT fields
+    (<caller>_GT onwards), plus its no-call values.
+    """
+    pools = {}
+    for gt in GENOTYPES:
+        pools[gt] = [
+            ":".join([gt] + sample_values(rng, caller, gt, phased)) for _ in range(POOL_SIZE)
+        ]
+    nocall = ["./."] + ["."] * len(HC_PHASED_FORMAT if phased else CALLER_FORMAT[caller])
+    if caller != "HC":
+        nocall[-1] = "MM"
+    pools["./."] = [":".join(nocall)]
+    return pools
+
+
+def record_blocks(rng, members, formats, pools, truth, discordance, missing):
+    """Sample columns of all caller blocks for one record: each caller's block has the
+    GT and that caller's fields of its calls, and missing values for the other callers'
+    fields.  A caller misses a sample with probability missing and reports a wrong
+    genotype with probability discordance.
+    """
+    n_fields = len(formats)
+    empty = "\t".join(["./." + ":." * (n_fields - 1)] * len(truth))
+    blocks = []
+    for caller in CALLERS:
+        if caller not in members:
+            blocks.append(empty)
+            continue
+        offset = formats.index(caller + "_GT")
+        own = sum(f.startswith(caller + "_") for f in formats)
+        before = ":." * (offset - 1) + ":"
+        after = ":." * (n_fields - offset - own)
+        columns = []
+        for gt in truth:
+            draw = rng.random()
+            if draw < missing:
+                gt = "./."
+            elif draw < missing + discordance:
+                gt = rng.choice([g for g in GENOTYPES if g != gt])
+            columns.append(gt + before + rng.choice(pools[caller][gt]) + after)
+        blocks.append("\t".join(columns))
+    return "\t".join(blocks)
+
+
+def positions(rng, n, contigs):
+    """n sorted (contig, position) pairs spread over contigs in proportion to their length."""
+    bounds = list(itertools.accumulate(CONTIG_LENGTHS[c] for c in contigs))
+    picks = sorted(rng.randrange(bounds[-1]) for _ in range(n))
+    result = []
+    for pick in picks:
+        i = bisect.bisect_right(bounds, pick)
+        start = bounds[i - 1] if i else 0
+        result.append((contigs[i], pick - start + 1))
+    return result
+
+
+def simulate(out, n_samples, n_variants, mix, discordance=0.03, missing=0.02, n_contigs=22, seed=1):
+    """Write the header and n_variants records to out (a common.VcfWriter)."""
+    rng = random.Random(seed)
+    contigs = list(CONTIG_LENGTHS)[:n_contigs]
+    samples = ["SAMPLE" + str(i + 1) for i in range(n_samples)]
+    out.write_header([(h + "\n").encode() for h in make_header(samples, contigs)])
+    pools = {(c, False): value_pools(rng, c) for c in CALLERS}
+    pools[("HC", True)] = value_pools(rng, "HC", phased=True)
+    sets, weights = zip(*mix)
+    last = None
+    for chrom, pos in positions(rng, n_variants, contigs):
+        if (chrom, pos) == last:
+            pos += 1
+        last = (chrom, pos)
+        members = rng.choices(sets, weights)[0]
+        phased = "HC" in members and rng.random() < 0.1
+        formats = ["GT"]
+        for caller in members:
+            formats += caller_format(caller, phased and caller == "HC")
+        af = rng.random() ** 2
+        truth = rng.choices(GENOTYPES, [(1 - af) ** 2, 2 * af * (1 - af), af**2], k=n_samples)
+        caller_pools = {c: pools[(c, phased and c == "HC")] for c in members}
+        ref, alt = rng.choice(
+            [("A", "G"), ("C", "T"), ("G", "A"), ("T", "C"), ("AT", "A"), ("C", "CA")]
+        )
+        quals = {c: str(rng.randint(10, 3000)) for c in members}
+        info = []
+        for caller in members:
+            values = {
+                "AC": "1",
+                "AF": "%.3g" % af,
+                "AN": "2",
+                "AQ": quals[caller],
+                "DP": "60",
+                "QUAL": quals[caller],
+            }
+            info += [caller + "_" + f + "=" + values[f] for f in CALLER_INFO[caller]]
+        columns = [
+            chrom,
+            str(pos),
+            ".",
+            ref,
+            alt,
+            quals[members[0]],
+            ".",
+            ";".join(info),
+            ":".join(formats),
+        ]
+        samples_text = record_blocks(
+            rng, members, formats, caller_pools, truth, discordance, missing
+        )
+        out.write_record(("\t".join(columns) + "\t" + samples_text + "\n").encode())
+
+
+#####################################################################################################
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        log.error("%s", e)
+        sys.exit(1)
+    if not 1 <= args.contigs <= len(CONTIG_LENGTHS):
+        log.error("--contigs must be between 1 and %d", len(CONTIG_LENGTHS))
+        sys.exit(1)
+    out = VcfWriter(args.outfile)
+    simulate(
+        out,
+        args.samples,
+        args.variants,
+        mix,
+        args.discordance,
+        args.missing,
+        args.contigs,
+        args.seed,
+    )
+    out.close()
@@ -1,8 +1,28 @@
 #!/usr/bin/env python3
 
+import gzip
+import itertools
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
 import unittest
 
+import benchmark_genotype_union as bench
+import common
+import concat_vcfs
+import count_shard_records
+import ensure_index
 import genotype_union as gt
+import label_caller_vcf as label
+import merge_callers as mc
+import plan_call_regions
+import plan_shards
+import rewrite_header
+import simulate_callers_vcf as sim
 
 ################# UNIT TESTS #################
 
@@ -484,6 +504,1046 @@ class TestGenotypeUnion(unittest.TestCase):
     # self.assert(gt.())
 
 
+class TestRecordTokenizer(unittest.TestCase):
+    header = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + [
+        "s1",
+        "s2",
+        "2:s1",
+        "2:s2",
+        "3:s1",
+        "3:s2",
+    ]
+
+    def assert_same_as_line(self, line):
+        tokenizer = gt.RecordTokenizer(self.header)
+        expected = gt.evaluate_variant_line(list(line), *gt.find_genotype_indices(self.header))
+        self.assertEqual(
+            tokenizer.evaluate(("\t".join(line) + "\n").encode()),
+            ("\t".join(expected) + "\n").encode(),
+        )
+
+    def test_evaluate_DV_only(self):
+        self.assert_same_as_line(
+            ["1", "2055702", "1_2055702_C_T", "C", "T", "9", ".", "DV_AF=0.5", "GT:DV_GT:DV_DP"]
+            + ["./.:.:.", "./.:.:.", "0/0:0/0:2", "1/1:1/1:2", "./.:.:.", "./.:.:."]
+        )
+
+    def test_evaluate_HC_only(self):
+        self.assert_same_as_line(
+            ["1", "829169", "rs1", "A", "*", "702.03", ".", "HC_AN=4", "GT:HC_GT:HC_DP"]
+            + ["0/1:0/1:30", "0/1:0/1:18", "./.:.:.", "./.:.:.", "./.:.:.", "./.:.:."]
+        )
+
+    def test_evaluate_strelka2_only_irregular_empty_block(self):
+        self.assert_same_as_line(
+            ["1", "100", "x", "C", "T", "9", ".", "strelka2_AF=0.5", "GT:strelka2_GT:strelka2_DP"]
+            + [".:.:.", "./.:.:.", "./.:.:.", ".:.:.", "0/1:0/1:7", "./.:.:."]
+        )
+
+    def test_evaluate_three_callers(self):
+        self.assert_same_as_line(
+            ["1", "100", "x", "C", "T", "9", ".", "HC_AN=2", "GT:HC_GT:DV_GT:strelka2_GT"]
+            + ["0/1:0/1:.:.", "1/1:1/1:.:.", "0/1:.:0/1:.", "0/1:.:0/1:."]
+            + ["1/1:.:.:1/1", "0/0:.:.:0/0"]
+        )
+
+    def test_evaluate_blank_genotypes(self):
+        tokenizer = gt.RecordTokenizer(self.header)
+        line = ["1", "100", "x", "C", "T", "9", ".", "DV_AF=0.5", "GT:DV_GT"] + ["./.:."] * 6
+        self.assertEqual(tokenizer.evaluate(("\t".join(line) + "\n").encode()), 1)
+
+
+class TestMergePlan(unittest.TestCase):
+    def test_plan_classification(self):
+        plan = gt.MergePlan(b"GT:HC_GT:strelka2_GT:strelka2_DP", gt.CALLERS)
+        self.assertEqual(plan.mask, 0b101)
+        self.assertEqual(plan.tag, b"HC-strelka2")
+        self.assertEqual(plan.filter, b"twoCallers")
+        self.assertIsNone(plan.single)
+        self.assertFalse(plan.keep_id)
+        self.assertEqual(plan.gt_fields, (1, None, 2))
+
+    def test_plan_single_caller(self):
+        plan = gt.MergePlan(b"GT:HC_GT:HC_DP", gt.CALLERS)
+        self.assertEqual((plan.mask, plan.single, plan.filter), (0b001, 0, b"oneCaller"))
+        self.assertTrue(plan.keep_id)
+        self.assertEqual(gt.MergePlan(b"GT:DP", gt.CALLERS).mask, 0)
+
+    def test_plans_are_cached(self):
+        tokenizer = gt.RecordTokenizer(TestRecordTokenizer.header)
+        self.assertIs(tokenizer.plan(b"GT:DV_GT"), tokenizer.plan(b"GT:DV_GT"))
+
+    def test_resolve_gts_matches_three_caller_rules(self):
+        values = ["0/1", "1/0", "1/1", "0/0", "./.", "."]
+        for gts in itertools.product(values, repeat=3):
+            geno1 = gt.combine_genotypes(
+                ["c"] * 9 + list(gts), *gt.find_genotype_indices(["c"] * 12)
+            )[9].split(":")
+            expected = tuple(g.encode() for g in geno1)
+            self.assertEqual(gt.resolve_gts(tuple(g.encode() for g in gts), 1), expected)
+
+    def test_four_callers(self):
+        callers = ["HC", "DV", "strelka2", "GATK"]
+        header = TestRecordTokenizer.header[:9] + ["s1", "2:s1", "3:s1", "4:s1"]
+        tokenizer = gt.RecordTokenizer(header, callers)
+        rec = b"1\t100\tx\tC\tT\t9\t.\tGATK_AF=1\tGT:GATK_GT\t./.:.\t./.:.\t./.:.\t0/1:0/1\n"
+        self.assertEqual(
+            tokenizer.evaluate(rec),
+            b"1\t100\t.\tC\tT\t9\toneCaller\tGATK_AF=1;set=GATK"
+            + b"\tGT:GATK_GT:concensus_GT:dv_priority_GT\t0/1:0/1:./.:./.\n",
+        )
+        rec = b"1\t100\tx\tC\tT\t9\t.\tHC_AF=1\tGT:HC_GT:GATK_GT\t0/1:0/1:.\t./.:.:.\t./.:.:.\t0/1:.:0/1\n"
+        self.assertEqual(
+            tokenizer.evaluate(rec).split(b"\t")[6:],
+            [b"twoCallers", b"HC_AF=1;set=HC-GATK"]
+            + [b"GT:HC_GT:GATK_GT:concensus_GT:dv_priority_GT", b"0/1:0/1:0/1:0/1:0/1\n"],
+        )
+
+    def test_headers_for_default_callers(self):
+        headers = gt.add_headers("ts", "v", "gu", "cmd")
+        self.assertIn(
+            '##INFO=<ID=set,Number=.,Type=String,Description="Set of callers that identified a '
+            + 'variant (HC, DV, strelka2, HC-DV, HC-strelka2, DV-strelka2, or HC-DV-strelka2 )">',
+            headers,
+        )
+        self.assertIn(
+            '##FILTER=<ID=threeCallers,Description="The variant was called by all three callers">',
+            headers,
+        )
+        self.assertEqual(
+            headers[-2], "##gu_Version=v, Union of HC, DV and strelka2 genotype data, ts"
+        )
+
+
+class TestGenotypeCache(unittest.TestCase):
+    def test_cache_matches_scalar_functions(self):
+        values = ["0/1", "1/0", "1/1", "0/0", "./.", ".", "0/2", "2/2", "1|2"]
+        genotypes = gt.GenotypeCache(1)
+        for combo in itertools.product(values, repeat=3):
+            geno1 = gt.combine_genotypes(
+                ["."] * 9 + list(combo), *gt.find_genotype_indices(["."] * 12)
+            )[9].split(":")
+            result = genotypes.resolve(tuple(g.encode() for g in combo))
+            self.assertEqual(result[:3], tuple(g.encode() for g in geno1))
+            self.assertIs(genotypes.resolve(tuple(g.encode() for g in combo)), result)
+
+    def test_comparable_codes(self):
+        genotypes = gt.GenotypeCache(1)
+        codes = genotypes.resolve((b"0/1", b"1/0", b"0/1"))[3]
+        self.assertEqual(codes, (codes[0],) * 4)
+        self.assertEqual(genotypes.resolve((b"0/1", b"1/0", b"./."))[3][2:], (-1, -1))
+        self.assertNotEqual(genotypes.comparable_code(b"1/1"), codes[0])
+
+    def test_combine_genotypes_sample_equal_to_other_column(self):
+        line = ["1", "100", ".", "C", "T", "9", ".", "HC_AN=2", "GT", ".", "0/1", "0/1"]
+        self.assertEqual(
+            gt.combine_genotypes(line, *gt.find_genotype_indices(line)),
+            ["1", "100", ".", "C", "T", "9", ".", "HC_AN=2", "GT:concensus_GT:dv_priority_GT"]
+            + ["0/1:0/1:0/1"],
+        )
+
+    def test_ragged_samples(self):
+        tokenizer = gt.RecordTokenizer(TestRecordTokenizer.header)
+        line = ["1", "100", "x", "C", "T", "9", ".", "HC_AN=2", "GT:HC_GT:DV_GT:DP"]
+        line += ["0/1:0/1", "0/1:0/1:.:3", "./.:.:.:.", "1/1:.:1/1:4", "./.", "./.:.:.:."]
+        self.assertEqual(
+            tokenizer.evaluate(("\t".join(line) + "\n").encode()).split(b"\t")[9:],
+            [b"./.:0/1:./.:./.", b"./.:0/1:1/1:3:./.:1/1\n"],
+        )
+
+    def test_ragged_samples_stats(self):
+        tokenizer = gt.RecordTokenizer(TestRecordTokenizer.header)
+        tokenizer.stats = gt.ConcordanceStats(3, 2)
+        line = ["1", "100", "x", "C", "T", "9", ".", "HC_AN=2", "GT:HC_GT:DV_GT:DP"]
+        line += ["0/1:0/1", "1/0:1/0:.:3", "./.:.:.:.", "0/1:.:0/1:4", "./.", "./.:.:.:."]
+        tokenizer.evaluate(("\t".join(line) + "\n").encode())
+        self.assertEqual(tokenizer.stats.compared.tolist(), [[0, 1], [0, 0], [0, 0]])
+        self.assertEqual(tokenizer.stats.agreed.tolist(), [[0, 1], [0, 0], [0, 0]])
+        self.assertEqual(tokenizer.stats.no_calls.tolist(), [1, 1])
+
+
+class TestWorkers(unittest.TestCase):
+    header = TestRecordTokenizer.header
+    records = [
+        b"1\t100\tx\tC\tT\t9\t.\tDV_AF=0.5\tGT:DV_GT\t./.:.\t./.:.\t0/1:0/1\t1/1:1/1\t./.:.\t./.:.\n",
+        b"1\t200\trs1\tA\tG\t9\t.\tHC_AN=2\tGT:HC_GT:DV_GT\t0/1:0/1:.\t0/0:0/0:.\t0/1:.:0/1\t"
+        + b"1/1:.:1/1\t./.:.:.\t./.:.:.\n",
+    ] * 5
+
+    def test_chunk_records(self):
+        chunks = list(gt.chunk_records(iter(self.records), 150))
+        self.assertEqual(b"".join(chunks), b"".join(self.records))
+        self.assertTrue(all(chunk.endswith(b"\n") for chunk in chunks))
+        self.assertGreater(len(chunks), 1)
+
+    def run_merge(self, workers, queue_depth):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "out.vcf")
+            out = common.VcfWriter(fname)
+
+            def merge(chunks):
+                return gt.merge_chunks(chunks, self.header, gt.CALLERS, workers, 2)
+
+            if queue_depth:
+                status, queues = gt.run_pipeline(iter(self.records), out, merge, 150, queue_depth)
+            else:
+                status = gt.write_chunks(merge(gt.chunk_records(iter(self.records), 150)), out)
+            out.close()
+            self.assertEqual(status, 0)
+            with open(fname, "rb") as f:
+                return f.read()
+
+    def test_parallel_and_pipeline_match_serial(self):
+        serial = self.run_merge(1, 0)
+        self.assertEqual(serial.count(b"\n"), len(self.records))
+        self.assertEqual(self.run_merge(2, 0), serial)
+        self.assertEqual(self.run_merge(1, 1), serial)
+        self.assertEqual(self.run_merge(2, 2), serial)
+
+    def test_pool_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "sim.vcf.gz")
+            out = common.VcfWriter(fname)
+            sim.simulate(out, 4, 300, sim.parse_mix(sim.DEFAULT_MIX))
+            out.close()
+            self.assertEqual(gt.pool_workers(fname, 4, 4), 1)
+            self.assertEqual(gt.pool_workers(fname, 4, 1000), 4)
+            self.assertEqual(gt.pool_workers(os.path.join(tmp, "none.vcf"), 4, 4), 4)
+        self.assertGreaterEqual(gt.available_cpus(), 1)
+
+    def test_pipeline_error(self):
+        blank = b"1\t5\tx\tA\tG\t1\t.\tI=1\tGT:DV_X" + b"\t./.:." * 6 + b"\n"
+        with tempfile.TemporaryDirectory() as tmp:
+            out = common.VcfWriter(os.path.join(tmp, "out.vcf"))
+
+            def merge(chunks):
+                return gt.merge_chunks(chunks, self.header, gt.CALLERS)
+
+            with self.assertLogs("genotype_union", "ERROR"):
+                status, queues = gt.run_pipeline(
+                    iter(self.records + [blank] + self.records), out, merge, 100, 1
+                )
+            out.close()
+        self.assertEqual(status, 1)
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = common.VcfWriter(os.path.join(tmp, "out.vcf"))
+            profiler = gt.Profiler(trace_memory=True)
+
+            def merge(chunks):
+                return gt.merge_chunks(
+                    chunks,
+                    self.header,
+                    gt.CALLERS,
+                    profile=True,
+                    started=profiler.start_memory_trace,
+                )
+
+            status, queues = gt.run_pipeline(
+                iter(self.records), out, merge, 150, 2, profiler=profiler
+            )
+            out.close()
+            profiler.report(os.path.join(tmp, "profile.json"))
+            with open(os.path.join(tmp, "profile.json")) as f:
+                report = json.load(f)
+        self.assertEqual(status, 0)
+        self.assertEqual(report["records"], 10)
+        self.assertEqual(report["sets"], {"DV": 5, "HC-DV": 5})
+        self.assertEqual(set(report["stage_wall_seconds"]), {"parse", "write"})
+        self.assertEqual(list(report["worker_cpu_seconds"]), ["main"])
+        self.assertEqual(set(report["total_worker_cpu_seconds"]), {"classify", "combine"})
+        self.assertTrue(report["tracemalloc"]["top"])
+
+    def test_finalize_output(self):
+        header = [
+            b"##fileformat=VCFv4.2\n",
+            b"##contig=<ID=1,length=1000>\n",
+            b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n",
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            partial = os.path.join(tmp, "out.partial.vcf.gz")
+            final = os.path.join(tmp, "out.vcf.gz")
+            out = common.VcfWriter(partial)
+            out.write_header(header)
+            out.write_record(b"1\t100\t.\tC\tT\t9\t.\t.\n")
+            gt.finalize_output(partial, final, out.close())
+            self.assertEqual(
+                sorted(os.listdir(tmp)), ["out.vcf.gz", "out.vcf.gz.tbi", "out.vcf.gz.tbi.fp"]
+            )
+            self.assertTrue(common.index_is_fresh(final, final + ".tbi"))
+
+    def test_profile_without_memory_trace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = common.VcfWriter(os.path.join(tmp, "out.vcf"))
+            profiler = gt.Profiler()
+            merged = gt.merge_chunks(
+                iter([b"".join(self.records)]),
+                self.header,
+                gt.CALLERS,
+                profile=True,
+                started=profiler.start_memory_trace,
+            )
+            gt.write_chunks(merged, out, profiler=profiler)
+            out.close()
+            self.assertFalse(gt.tracemalloc.is_tracing())
+            profiler.report(os.path.join(tmp, "profile.json"))
+            with open(os.path.join(tmp, "profile.json")) as f:
+                report = json.load(f)
+        self.assertEqual(report["records"], 10)
+        self.assertNotIn("tracemalloc", report)
+
+    def test_stats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = common.VcfWriter(os.path.join(tmp, "out.vcf"))
+            stats = gt.ConcordanceStats(3, 2)
+
+            def merge(chunks):
+                return gt.merge_chunks(chunks, self.header, gt.CALLERS, 2, stats=True)
+
+            status, queues = gt.run_pipeline(iter(self.records), out, merge, 150, 2, stats=stats)
+            out.close()
+            stats.report(os.path.join(tmp, "stats.json"), gt.CALLERS, ["s1", "s2"])
+            with open(os.path.join(tmp, "stats.json")) as f:
+                report = json.load(f)
+        self.assertEqual(status, 0)
+        self.assertEqual(report["records"], 10)
+        self.assertEqual(report["sets"], {"DV": 5, "HC-DV": 5})
+        self.assertEqual(report["concensus_GT_no_call_rate"], 0.75)
+        s1, s2 = report["samples"]["s1"], report["samples"]["s2"]
+        self.assertEqual(s1["agreement"], [[1.0, 1.0, None], [1.0, 1.0, None], [None, None, 1.0]])
+        self.assertEqual(s2["agreement"][0][1], 0.0)
+        self.assertEqual(s2["compared"][1][0], 5)
+        self.assertEqual([s1["concensus_GT_no_calls"], s2["concensus_GT_no_calls"]], [5, 10])
+
+    def test_stage_queue_counts_stalls(self):
+        q = common.StageQueue(1)
+        q.put(1)
+        threading.Timer(0.05, q.get).start()
+        q.put(2)
+        self.assertEqual(q.put_stalls, 1)
+        self.assertGreater(q.put_wait, 0)
+        self.assertEqual(q.get(), 2)
+        self.assertEqual(q.get_stalls, 0)
+
+
+class TestLabelCallerVcf(unittest.TestCase):
+    header = [
+        b"##fileformat=VCFv4.2\n",
+        b'##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">\n',
+        b'##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+        b'##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">\n',
+        b"##contig=<ID=chr1,length=248956422>\n",
+        b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n",
+    ]
+    records = [
+        b"chr1\t100\trs1\tA\tG\t30.5\tPASS\tAF=0.5;DB\tGT:GQ\t0/1:20\t./.:.\n",
+        b"chr1\t200\t.\tC\tT\t.\t.\t.\tGT\t1|1\t.\n",
+    ]
+
+    def test_label_record(self):
+        self.assertEqual(
+            label.label_record(self.records[0], "HC"),
+            b"chr1\t100\trs1\tA\tG\t30.5\tPASS\tHC_AF=0.5;HC_DB;HC_QUAL=30.5\t"
+            + b"GT:HC_GT:HC_GQ\t0/1:0/1:20\t./.:./.:.\n",
+        )
+        self.assertEqual(
+            label.label_record(self.records[1], "HC"),
+            b"chr1\t200\t.\tC\tT\t.\t.\tHC_.;HC_QUAL=.\tGT:HC_GT\t1|1:1|1\t.:.\n",
+        )
+
+    def test_label_header(self):
+        labelled = label.label_header(self.header, "DV")
+        self.assertEqual(labelled[1], self.header[1].replace(b"ID=AF", b"ID=DV_AF"))
+        self.assertEqual(
+            labelled[2:5],
+            [
+                b'##FORMAT=<ID=GT,Number=1,Type=String,Description="Concordant Genotype">\n',
+                b'##INFO=<ID=DV_QUAL,Number=1,Type=String,Description="Record of original QUAL value">\n',
+                self.header[2].replace(b"ID=GT", b"ID=DV_GT"),
+            ],
+        )
+        self.assertEqual(labelled[-1], self.header[-1])
+
+    @unittest.skipUnless(shutil.which("bash") and shutil.which("awk"), "needs bash and awk")
+    def test_same_as_prepend_labels(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prepend_labels.sh")
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, lines in (("header.vcf", self.header), ("vars.vcf", self.records)):
+                with open(os.path.join(tmp, name), "wb") as f:
+                    f.writelines(lines)
+            vcf, header = os.path.join(tmp, "vars.vcf"), os.path.join(tmp, "header.vcf")
+            subprocess.run(["bash", script, vcf, header, "strelka2"], cwd=tmp, check=True)
+            expected = b""
+            for name in ("prepended.header.vcf", "prepended.vars.vcf"):
+                with open(os.path.join(tmp, name), "rb") as f:
+                    expected += f.read()
+            with open(os.path.join(tmp, "in.vcf"), "wb") as f:
+                f.writelines(self.header + self.records)
+            out = common.VcfWriter(os.path.join(tmp, "out.vcf.gz"))
+            label.label_vcf(common.VcfReader(os.path.join(tmp, "in.vcf")), out, "strelka2")
+            out.close()
+            with gzip.open(os.path.join(tmp, "out.vcf.gz")) as f:
+                self.assertEqual(f.read(), expected)
+
+
+class TestMergeCallers(unittest.TestCase):
+    columns = b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n"
+    vcfs = {
+        "HC": [
+            b'##INFO=<ID=HC_AF,Number=A,Type=Float,Description="Allele Frequency">\n',
+            b'##INFO=<ID=HC_DP,Number=1,Type=Integer,Description="Depth">\n',
+            b"chr1\t100\trs1\tA\tG\t50\t.\tHC_AF=0.5;HC_DP=10\tGT:HC_GT:HC_GQ\t0/1:0/1:20\t0/0:0/0:30\n",
+            b"chr1\t200\trs2\tC\tT\t40\t.\tHC_DP=5\tGT:HC_GT:HC_GQ\t1/1:1/1:9\t0/1:0/1\n",
+        ],
+        "DV": [
+            b'##INFO=<ID=DV_AF,Number=A,Type=Float,Description="Allele Frequency">\n',
+            b"chr1\t100\t.\tA\tG\t60.5\t.\tDV_AF=0.4\tGT:DV_GT:DV_GQ\t0/1:0/1:33\t0/1:0/1:40\n",
+            b"chr1\t150\t.\tG\tA\t20\t.\tDV_AF=0.1\tGT:DV_GT:DV_GQ\t0/0:0/0:50\t0/1:0/1:12\n",
+        ],
+        "strelka2": [
+            b'##INFO=<ID=strelka2_MQ,Number=1,Type=Integer,Description="Mapping quality">\n',
+            b"chr1\t100\t.\tA\tG\t.\t.\tstrelka2_MQ=60\tGT:strelka2_GT:strelka2_FT\t0/1:0/1:PASS\t./.:./.:.\n",
+            b"chr1\t100\t.\tA\tC\t30\t.\tstrelka2_MQ=50\tGT:strelka2_GT:strelka2_FT\t0/1:0/1:PASS\t0/0:0/0:PASS\n",
+        ],
+    }
+    meta = [b"##fileformat=VCFv4.2\n", b"##contig=<ID=chr1,length=248956422>\n"]
+
+    def merge(self, vcfs, order=None, columns=None):
+        columns = columns or {}
+        with tempfile.TemporaryDirectory() as tmp:
+            infiles = []
+            for caller, lines in vcfs.items():
+                infiles.append(os.path.join(tmp, caller + ".vcf"))
+                with open(infiles[-1], "wb") as f:
+                    f.writelines(self.meta + [line for line in lines if line.startswith(b"##")])
+                    f.write(columns.get(caller, self.columns))
+                    f.writelines(line for line in lines if not line.startswith(b"#"))
+            readers, order, (samples, sample_orders, agr) = mc.open_callers(
+                infiles, gt.CALLERS, order
+            )
+            out = common.VcfWriter(os.path.join(tmp, "out.vcf"))
+            out.write_header([])
+            stats = gt.ConcordanceStats(3, 2)
+            mc.merge_callers(readers, order, samples, sample_orders, agr, out, gt.CALLERS, stats)
+            out.close()
+            with open(os.path.join(tmp, "out.vcf"), "rb") as f:
+                return f.read().splitlines(keepends=True), stats
+
+    def wide_record(self, record, members):
+        """The bcftools merge --force-samples record of a variant, for RecordTokenizer."""
+        cols = record.rstrip(b"\n").split(b"\t")
+        info = cols[7].rsplit(b";set=", 1)[0]
+        fields = cols[8].split(b":")[:-2]
+        samples = [s.split(b":") for s in cols[9:]]
+        blocks = []
+        for caller in gt.CALLERS:
+            for s in samples:
+                values = [
+                    v if f.startswith(caller.encode() + b"_") else b"." for f, v in zip(fields, s)
+                ]
+                values[0] = (
+                    values[fields.index(caller.encode() + b"_GT")] if caller in members else b"./."
+                )
+                blocks.append(b":".join(values))
+        return b"\t".join(cols[:7] + [info, b":".join(fields)] + blocks) + b"\n"
+
+    def test_merge(self):
+        vcfs = {c: list(lines) for c, lines in self.vcfs.items()}
+        # DV's VCF has the samples in the other order
+        vcfs["DV"][1:] = [
+            b"\t".join(
+                line.rstrip(b"\n").split(b"\t")[:9] + line.rstrip(b"\n").split(b"\t")[9:][::-1]
+            )
+            + b"\n"
+            for line in vcfs["DV"][1:]
+        ]
+        merged, stats = self.merge(vcfs, columns={"DV": self.columns.replace(b"s1\ts2", b"s2\ts1")})
+        self.assertEqual(
+            [r.split(b"\t")[1] + r.split(b"\t")[4] for r in merged],
+            [b"100C", b"100G", b"150A", b"200T"],
+        )
+        self.assertEqual(
+            merged[1],
+            b"chr1\t100\t.\tA\tG\t60.5\tthreeCallers\tHC_DP=10;strelka2_MQ=60;HC_AF=0.5;DV_AF=0.4;set=HC-DV-strelka2\t"
+            + b"GT:HC_GT:HC_GQ:DV_GT:DV_GQ:strelka2_GT:strelka2_FT:concensus_GT:dv_priority_GT\t"
+            + b"0/1:0/1:20:0/1:33:0/1:PASS:0/1:0/1\t./.:0/0:30:0/1:40:./.:.:./.:0/1\n",
+        )
+        self.assertEqual(merged[3].split(b"\t")[2], b"rs2")
+        # the missing HC_GQ of s2 is filled in
+        self.assertEqual(merged[3].split(b"\t")[9:], [b"1/1:1/1:9:./.:./.", b"0/1:0/1:.:./.:./.\n"])
+        tokenizer = gt.RecordTokenizer(
+            self.columns.decode().split("\t")[:9] + ["s1", "s2", "2:s1", "2:s2", "3:s1", "3:s2"]
+        )
+        for record, members in zip(merged, [["strelka2"], gt.CALLERS, ["DV"], ["HC"]]):
+            self.assertEqual(tokenizer.evaluate(self.wide_record(record, members)), record)
+        self.assertEqual(stats.records, 4)
+        self.assertEqual(dict(stats.sets), {"strelka2": 1, "HC-DV-strelka2": 1, "DV": 1, "HC": 1})
+
+    def test_contig_order_and_sorting(self):
+        order = {b"chr2": 0, b"chr1": 1}
+        vcfs = {c: list(lines) for c, lines in self.vcfs.items()}
+        vcfs["HC"].append(vcfs["HC"][-1].replace(b"chr1", b"chr2"))
+        with self.assertRaisesRegex(ValueError, "HC: records are not sorted"):
+            self.merge(vcfs, order)
+        with self.assertRaisesRegex(ValueError, "contig chr1 is not in the contig order"):
+            self.merge(self.vcfs, {b"chr2": 0})
+        self.assertEqual(mc.header_contigs(self.meta), {b"chr1": 0})
+
+    def test_different_samples(self):
+        with self.assertRaisesRegex(ValueError, "does not have the same samples"):
+            self.merge(self.vcfs, columns={"DV": self.columns.replace(b"s2", b"s3")})
+
+    def test_blank_single_caller(self):
+        vcfs = dict(self.vcfs, DV=self.vcfs["DV"][:2])
+        vcfs["DV"][1] = vcfs["DV"][1].replace(b"0/1:0/1:33\t0/1:0/1:40", b"./.:./.:.\t./.:./.:.")
+        with self.assertRaisesRegex(ValueError, "All genotype fields are blank at chr1:100"):
+            self.merge(dict(vcfs, HC=[], strelka2=[]))
+
+
+class TestConcatVcfs(unittest.TestCase):
+    header = [
+        b"##fileformat=VCFv4.2\n",
+        b"##contig=<ID=chr1,length=248956422>\n",
+        b"##contig=<ID=chr2,length=242193529>\n",
+        b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n",
+    ]
+    order = {b"chr1": 0, b"chr2": 1, b"chr3": 2}
+
+    def write_parts(self, tmp, contigs):
+        """One indexed VCF per list of contigs, with records spread over several blocks."""
+        fnames = []
+        for i, names in enumerate(contigs):
+            fnames.append(os.path.join(tmp, "part%d.vcf.gz" % i))
+            writer = common.VcfWriter(fnames[-1])
+            writer.write_header(self.header[:-1] + [b"##part=%d\n" % i, self.header[-1]])
+            for name in names:
+                for pos in range(1, 200000, 97):
+                    writer.write_record(b"%s\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n" % (name, pos))
+            writer.close()
+        return fnames
+
+    def test_concat(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            parts = self.write_parts(tmp, [[b"chr2"], [], [b"chr1"]])
+            out = os.path.join(tmp, "out.vcf.gz")
+            self.assertEqual(concat_vcfs.concat_vcfs(parts, out, self.order), out + ".tbi")
+            lines = list(common.open_vcf_lines(out))
+            expected = []
+            for part in (parts[2], parts[0]):
+                expected += [
+                    line for line in common.open_vcf_lines(part) if not line.startswith(b"#")
+                ]
+            # the header of the first input, the records in contig order
+            header = self.header[:-1] + [b"##part=0\n", self.header[-1]]
+            self.assertEqual(lines, header + expected)
+            for region in (("chr1", 150000, 150500), ("chr2", 0, 300)):
+                self.assertEqual(
+                    list(common.fetch_vcf_lines(out, [region])),
+                    [
+                        line
+                        for line in expected
+                        if line.startswith(region[0].encode())
+                        and region[1] < int(line.split(b"\t")[1]) <= region[2]
+                    ],
+                )
+
+    def test_split_contig(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            whole = self.write_parts(tmp, [[b"chr1", b"chr2"]])[0]
+            records = [line for line in common.open_vcf_lines(whole) if not line.startswith(b"#")]
+            # shards as plan_shards.py makes them: chr1 cut at 100000, the rest with chr2
+            cut = next(i for i, line in enumerate(records) if int(line.split(b"\t")[1]) > 100000)
+            parts = []
+            for i, lines in enumerate((records[cut:], records[:cut])):
+                parts.append(os.path.join(tmp, "shard%d.vcf.gz" % i))
+                writer = common.VcfWriter(parts[-1])
+                writer.write_header(self.header)
+                for line in lines:
+                    writer.write_record(line)
+                writer.close()
+            out = os.path.join(tmp, "out.vcf.gz")
+            concat_vcfs.concat_vcfs(parts, out, self.order)
+            self.assertEqual(list(common.open_vcf_lines(out)), self.header + records)
+            for region in (("chr1", 99000, 101000), ("chr1", 0, 300000), ("chr2", 0, 500)):
+                self.assertEqual(
+                    list(common.fetch_vcf_lines(out, [region])),
+                    list(common.fetch_vcf_lines(whole, [region])),
+                )
+
+    def test_not_concatenable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "out.vcf.gz")
+            parts = self.write_parts(tmp, [[b"chr1"], [b"chr1"]])
+            with self.assertRaisesRegex(concat_vcfs.NotConcatenable, "more than one input"):
+                concat_vcfs.concat_vcfs(parts, out, self.order)
+            parts = self.write_parts(tmp, [[b"chr2", b"chr1"]])
+            with self.assertRaisesRegex(concat_vcfs.NotConcatenable, "not sorted in .dict order"):
+                concat_vcfs.concat_vcfs(parts, out, self.order)
+            os.remove(parts[0] + ".tbi")
+            with self.assertRaisesRegex(concat_vcfs.NotConcatenable, "not an indexed BGZF"):
+                concat_vcfs.concat_vcfs(parts, out, self.order)
+
+
+class TestRewriteHeader(unittest.TestCase):
+    header = [
+        b"##fileformat=VCFv4.2\n",
+        b'##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths">\n',
+        b'##FORMAT=<ID=ADF,Number=.,Type=Integer,Description="Forward depths">\n',
+        b"##contig=<ID=chr1,length=248956422>\n",
+        b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n",
+    ]
+
+    def write_vcf(self, fname):
+        """Indexed VCF whose header ends in the block of the first records, as bgzip writes it."""
+        writer = common.VcfWriter(fname)
+        writer.header.extend(self.header)
+        for line in self.header:
+            writer._write(line)
+        records = [
+            b"chr1\t%d\t.\tA\tG\t50\tPASS\t.\tGT:AD\t0/1:3,4\n" % pos
+            for pos in range(1, 300000, 53)
+        ]
+        for line in records:
+            writer.write_record(line)
+        writer.close()
+        return records
+
+    def test_rewrite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            infile, outfile = os.path.join(tmp, "in.vcf.gz"), os.path.join(tmp, "out.vcf.gz")
+            records = self.write_vcf(infile)
+            transform = rewrite_header.substitutions(
+                [(r"ID=(AD|ADF),Number=\.", r"ID=\1,Number=R")]
+            )
+            self.assertEqual(
+                rewrite_header.rewrite_header(infile, outfile, transform), outfile + ".tbi"
+            )
+            header = [line.replace(b"Number=.", b"Number=R") for line in self.header]
+            self.assertEqual(list(common.open_vcf_lines(outfile)), header + records)
+            # the blocks after the one holding the end of the header are copied as they are
+            with open(infile, "rb") as f:
+                blocks = list(common.iter_bgzf_blocks(f))
+            with open(outfile, "rb") as f:
+                self.assertTrue(f.read().endswith(b"".join(b[1] for b in blocks[1:])))
+            for region in (("chr1", 0, 100), ("chr1", 150000, 150200)):
+                self.assertEqual(
+                    list(common.fetch_vcf_lines(outfile, [region])),
+                    list(common.fetch_vcf_lines(infile, [region])),
+                )
+
+    def test_header_must_keep_samples(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            infile, outfile = os.path.join(tmp, "in.vcf.gz"), os.path.join(tmp, "out.vcf.gz")
+            self.write_vcf(infile)
+            with self.assertRaisesRegex(ValueError, "#CHROM"):
+                rewrite_header.rewrite_header(
+                    infile, outfile, lambda lines: lines[:-1] + [lines[-1].replace(b"s1", b"s2")]
+                )
+
+
+class TestEnsureIndex(unittest.TestCase):
+    header = [
+        b"##fileformat=VCFv4.2\n",
+        b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n",
+    ]
+
+    def write_vcf(self, fname, positions, csi=None):
+        writer = common.VcfWriter(fname, csi=csi)
+        writer.write_header(self.header)
+        for pos in positions:
+            writer.write_record(b"chr1\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n" % pos)
+        return writer.close()
+
+    def test_reuse_and_rebuild(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "x.vcf.gz")
+            index_name = self.write_vcf(fname, range(1, 300000, 61))
+            with open(index_name, "rb") as f:
+                written = f.read()
+            # the writer recorded the fingerprint of its output
+            self.assertEqual(ensure_index.ensure_index(fname), (index_name, False))
+            # an index without fingerprint that covers the whole file is adopted
+            os.remove(index_name + ".fp")
+            self.assertEqual(ensure_index.ensure_index(fname), (index_name, False))
+            self.assertTrue(os.path.exists(index_name + ".fp"))
+            # the data changed: the index is rebuilt, as the writer made it
+            self.write_vcf(fname, range(1, 300000, 61))
+            os.utime(index_name, ns=(0, 0))
+            self.assertEqual(ensure_index.ensure_index(fname), (index_name, True))
+            with open(index_name, "rb") as f:
+                self.assertEqual(gzip.decompress(f.read()), gzip.decompress(written))
+            # an index that stops short of the data is not adopted
+            self.write_vcf(fname, range(1, 600000, 61))
+            shutil.copy(os.path.join(tmp, "x.vcf.gz.tbi"), os.path.join(tmp, "keep.tbi"))
+            self.write_vcf(fname, range(1, 300000, 61))
+            os.rename(os.path.join(tmp, "keep.tbi"), index_name)
+            self.assertFalse(ensure_index.index_covers(fname, index_name))
+
+    def test_csi_for_long_contigs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "x.vcf.gz")
+            self.write_vcf(fname, [100, 1 << 30], csi=True)
+            os.remove(fname + ".csi")
+            self.assertEqual(ensure_index.ensure_index(fname), (fname + ".csi", True))
+            self.assertEqual(
+                list(common.fetch_vcf_lines(fname, [("chr1", (1 << 30) - 10, (1 << 30) + 10)])),
+                [b"chr1\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n" % (1 << 30)],
+            )
+
+    def test_is_bcf(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            names = []
+            for name, data in (("u.bcf", b"BCF\x02\x02"), ("c.bcf", gzip.compress(b"BCF\x02\x02"))):
+                names.append(os.path.join(tmp, name))
+                with open(names[-1], "wb") as f:
+                    f.write(data)
+            vcf = os.path.join(tmp, "x.vcf.gz")
+            self.write_vcf(vcf, [100])
+            self.assertEqual([ensure_index.is_bcf(n) for n in names + [vcf]], [True, True, False])
+
+
+class TestPlanShards(unittest.TestCase):
+    def test_plan(self):
+        lengths = {"chr1": 1000000, "chr2": 500000, "chrM": 16569, "chrUn_1": 2000, "chrX": 9000}
+        weights = {
+            "chr1": {pos: 10.0 for pos in range(0, 1000000, 16384)},
+            "chr2": {pos: 10.0 for pos in range(0, 500000, 16384)},
+            "chrM": {0: 3.0},
+            "chrUn_1": {0: 1.0},
+        }
+        shards = plan_shards.plan_shards(weights, lengths, 4)
+        self.assertEqual(len(shards), 4)
+        regions = [r for shard, _ in shards for r in shard]
+        # the shards cover each contig with records once, in order, and chrX has none
+        self.assertEqual([r[0] for r in regions][-3:], ["chr2", "chrM", "chrUn_1"])
+        for contig in ("chr1", "chr2"):
+            pieces = [(b, e) for c, b, e in regions if c == contig]
+            self.assertEqual(pieces[0][0], 0)
+            self.assertEqual(pieces[-1][1], lengths[contig])
+            self.assertTrue(all(a[1] == b[0] for a, b in zip(pieces, pieces[1:])))
+        # chr1 is cut into balanced shards, the small contigs share the last one
+        self.assertLess(max(r for _, r in shards) - min(r for _, r in shards), 15)
+        self.assertEqual([c for c, _, _ in shards[-1][0]][-2:], ["chrM", "chrUn_1"])
+        with tempfile.TemporaryDirectory() as tmp:
+            names = plan_shards.write_shards(tmp, shards)
+            self.assertEqual(plan_shards.read_shards(tmp), names)
+            with open(os.path.join(tmp, names[0] + ".bed")) as f:
+                self.assertEqual(f.readline().split("\t")[:2], ["chr1", "0"])
+
+    def test_index_weights(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "x.vcf.gz")
+            writer = common.VcfWriter(fname)
+            writer.write_header([b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"])
+            for pos in list(range(1, 100000, 10)) + list(range(100001, 400000, 100)):
+                writer.write_record(b"chr1\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n" % pos)
+            index = common.VcfIndex.read(writer.close())
+            weights = plan_shards.index_weights(index, plan_shards.compression_ratio(fname))
+        weights = weights["chr1"]
+        self.assertAlmostEqual(sum(weights.values()), 13000)
+        dense = sum(w for pos, w in weights.items() if pos < 98304)
+        self.assertGreater(dense, 0.7 * 10000)
+
+
+class TestPlanCallRegions(unittest.TestCase):
+    def test_plan(self):
+        lengths = {"chr1": 1000000, "chr2": 500000, "chrM": 16569}
+        targets = [("chr1", 1000, 200000), ("chr1", 300000, 310000), ("chr2", 0, 50000)]
+        targets.append(("chrM", 0, 16569))
+        # the first 64 kb of chr1 are deep, the rest shallow
+        reads = {"chr1": {w: 1000.0 if w < 65536 else 10.0 for w in range(0, 1000000, 16384)}}
+        regions = plan_call_regions.plan_call_regions(targets, reads, lengths, 3)
+        self.assertEqual(len(regions), 3)
+        # the regions hold the targets, in order, cut at window boundaries only
+        self.assertEqual(common.sort_regions([t for r, _ in regions for t in r], lengths), targets)
+        self.assertTrue(all(t[1] % 16384 == 0 for r, _ in regions[1:] for t in r[:1]))
+        # the deep part of chr1 is split, the shallow rest shares a region with the other contigs
+        self.assertLess(regions[0][0][-1][2], 65536)
+        self.assertEqual([t[0] for t in regions[-1][0]][-2:], ["chr2", "chrM"])
+        work = [w for _, w in regions]
+        self.assertLess(max(work) / min(work), 1.5)
+
+    def test_read_indexes(self):
+        names = ["chr1", "chr2"]
+        with tempfile.TemporaryDirectory() as tmp:
+            bai = os.path.join(tmp, "s.bam.bai")
+            with open(bai, "wb") as f:
+                f.write(b"BAI\x01" + struct.pack("<ii", 2, 3))
+                # leaf bins of the first two 16 kb windows, and the pseudo-bin
+                f.write(struct.pack("<Ii2Q", 4681, 1, 0, 100 << 16))
+                f.write(struct.pack("<Ii2Q", 4682, 1, 100 << 16, 110 << 16))
+                f.write(struct.pack("<Ii4Q", 37450, 2, 0, 110 << 16, 5000, 0))
+                f.write(struct.pack("<i2Q", 2, 0, 100 << 16) + struct.pack("<ii", 0, 0))
+            weights = plan_call_regions.read_weights(bai, names)
+            crai = os.path.join(tmp, "s.cram.crai")
+            with gzip.open(crai, "wt") as f:
+                f.write("1\t1\t32768\t0\t10\t1000\n-1\t0\t0\t2000\t10\t500\n")
+            crai_weights = plan_call_regions.read_weights(crai, names)
+            # the contigs of the BAM must be those of the .dict
+            with self.assertRaises(ValueError):
+                plan_call_regions.read_bai(bai, names + ["chrM"])
+        self.assertEqual(set(weights), {"chr1"})
+        self.assertAlmostEqual(weights["chr1"][0] / weights["chr1"][16384], 10)
+        self.assertEqual(dict(crai_weights["chr2"]), {0: 2000.0, 16384: 2000.0})
+
+
+class TestCountShardRecords(unittest.TestCase):
+    def test_count(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            indexes = []
+            for caller, chroms in (("HC", ["chr1", "chr1", "chrM"]), ("DV", ["chr1", "chrX"])):
+                fname = os.path.join(tmp, caller + ".vcf.gz")
+                writer = common.VcfWriter(fname)
+                writer.write_header(
+                    [b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"]
+                )
+                for pos, chrom in enumerate(chroms):
+                    writer.write_record(
+                        b"%s\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n" % (chrom.encode(), pos + 1)
+                    )
+                indexes.append(writer.close())
+            shards = ["chr1", "chrX", "chrY", "chrM"]
+            counts = count_shard_records.count_shard_records(indexes, shards)
+            self.assertEqual(dict(counts), {"chr1": 3, "chrX": 1, "chrY": 0, "chrM": 1})
+            # a BCF .csi index, with no contig names, for each shard of one caller
+            bcf_indexes = []
+            for shard, n in zip(shards, (2, 0, 0, 1)):
+                fname = os.path.join(tmp, shard + ".bcf.csi")
+                data = b"CSI\x01" + struct.pack("<4i", 14, 5, 0, 1)
+                if n:
+                    data += struct.pack("<iIQi", 1, 37450, 0, 2) + struct.pack("<4Q", 0, 0, n, 0)
+                else:
+                    data += struct.pack("<i", 0)
+                with gzip.open(fname, "wb") as f:
+                    f.write(data + struct.pack("<Q", 0))
+                bcf_indexes.append(fname)
+            counts = count_shard_records.count_shard_records(bcf_indexes, shards, per_shard=True)
+            self.assertEqual(dict(counts), {"chr1": 2, "chrX": 0, "chrY": 0, "chrM": 1})
+            with self.assertRaises(ValueError):
+                count_shard_records.count_shard_records(bcf_indexes[:3], shards, per_shard=True)
+
+
+class TestSimulation(unittest.TestCase):
+    def test_simulated_vcf_merges(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "sim.vcf.gz")
+            out = common.VcfWriter(fname)
+            sim.simulate(out, 4, 200, sim.parse_mix("HC-DV-strelka2=3,strelka2=1"), n_contigs=2)
+            out.close()
+            reader = common.VcfReader(fname)
+            self.assertEqual(gt.vcf_check(reader.columns), 0)
+            self.assertEqual(reader.columns[9:11], ["SAMPLE1", "SAMPLE2"])
+            tokenizer = gt.make_tokenizer(reader.columns, gt.CALLERS, stats=True)
+            records = list(reader)
+            merged = [bytes(rec) for rec in tokenizer.stage(records)]
+        self.assertEqual(len(merged), 200)
+        self.assertEqual(set(tokenizer.stats.sets), {"HC-DV-strelka2", "strelka2"})
+        self.assertEqual({rec.chrom for rec in records}, {"chr1", "chr2"})
+        self.assertGreater(tokenizer.stats.agreed.sum(), tokenizer.stats.compared.sum() * 0.8)
+
+    def test_parse_mix(self):
+        self.assertEqual(
+            sim.parse_mix("DV-HC=2,strelka2=1"), [(("HC", "DV"), 2.0), (("strelka2",), 1.0)]
+        )
+        self.assertRaises(ValueError, sim.parse_mix, "HC-GATK=1")
+
+    def test_benchmark_compare(self):
+        baseline = {"cases": {"10x100": {"records_per_second": 1000.0, "peak_rss_mb": 50.0}}}
+        results = {"cases": {"10x100": {"records_per_second": 900.0, "peak_rss_mb": 55.0}}}
+        self.assertEqual(bench.compare(results, baseline, 0.25, 0.25), [])
+        results["cases"]["10x100"]["records_per_second"] = 700.0
+        results["cases"]["10x100"]["peak_rss_mb"] = 70.0
+        with self.assertLogs("benchmark_genotype_union"):
+            self.assertEqual(len(bench.compare(results, baseline, 0.25, 0.25)), 2)
+
+    def test_benchmark_pool_cases(self):
+        self.assertEqual(bench.case_name(20, 2000, 4), "20x2000w4")
+        cases = {
+            "10x100": {"samples": 10, "variants": 100, "workers": 1, "seconds": 1.0},
+            "20x100": {"samples": 20, "variants": 100, "workers": 1, "seconds": 2.0},
+            "20x100w4": {"samples": 20, "variants": 100, "workers": 4, "seconds": 3.0},
+        }
+        self.assertEqual(bench.scaling(cases, 1), {"10->20 samples": 1.0})
+
+
+class TestCommon(unittest.TestCase):
+    header = [
+        b"##fileformat=VCFv4.2\n",
+        b"##contig=<ID=chr1,length=248956422>\n",
+        b"##contig=<ID=chr2,length=242193529>\n",
+        b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n",
+    ]
+    records = [
+        b"chr1\t100\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n",
+        b"chr1\t20000\t.\tAT\tA\t50\tPASS\t.\tGT\t1/1\n",
+        b"chr2\t5\t.\tC\t<NON_REF>\t.\t.\tEND=40000\tGT\t0/0\n",
+    ]
+
+    def test_reg2bin(self):
+        self.assertEqual(common.reg2bin(0, 1), 4681)
+        self.assertEqual(common.reg2bin(0, 16385), 585)
+        self.assertEqual(common.reg2bin(0, 1 << 29), 0)
+
+    def test_record_span_uses_info_end(self):
+        self.assertEqual(common.record_span(self.records[1].split(b"\t")), (19999, 20001))
+        self.assertEqual(common.record_span(self.records[2].split(b"\t")), (4, 40000))
+
+    def test_vcf_writer_bgzf_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "test.vcf.gz")
+            writer = common.VcfWriter(out)
+            writer.write_header(self.header)
+            for rec in self.records:
+                writer.write_record(rec)
+            self.assertEqual(writer.close(), out + ".tbi")
+            self.assertTrue(common.is_bgzf(out))
+            with gzip.open(out) as f:
+                self.assertEqual(f.read(), b"".join(self.header + self.records))
+            self.assertEqual(list(common.open_vcf_lines(out)), self.header + self.records)
+            with gzip.open(out + ".tbi") as f:
+                self.assertEqual(f.read(4), b"TBI\x01")
+
+    @unittest.skipUnless(hasattr(os, "mkfifo"), "needs named pipes")
+    def test_named_pipe_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("plain.vcf", "bgzf.vcf.gz"):
+                fifo = os.path.join(tmp, name)
+                os.mkfifo(fifo)
+
+                def write():
+                    writer = common.VcfWriter(fifo)
+                    writer.write_header(self.header)
+                    for rec in self.records:
+                        writer.write_record(rec)
+                    writer.close()
+
+                thread = threading.Thread(target=write)
+                thread.start()
+                self.assertEqual(list(common.open_vcf_lines(fifo)), self.header + self.records)
+                thread.join()
+
+    def test_indexer_picks_csi_for_long_contigs(self):
+        indexer = common.VcfIndexer.for_header([b"##contig=<ID=chr1,length=900000000>\n"])
+        self.assertTrue(indexer.csi)
+        self.assertFalse(common.VcfIndexer.for_header(self.header).csi)
+
+    def test_indexer_rejects_unsorted(self):
+        indexer = common.VcfIndexer()
+        indexer.add("chr1", 100, 101, 0, 10)
+        with self.assertRaises(ValueError):
+            indexer.add("chr1", 50, 51, 10, 20)
+
+    def test_parse_region(self):
+        self.assertEqual(common.parse_region("chr1:1,001-2000"), ("chr1", 1000, 2000))
+        self.assertEqual(common.parse_region("chr1:5")[:2], ("chr1", 4))
+        self.assertEqual(common.parse_region("HLA-A*01:01")[:2], ("HLA-A*01", 0))
+        self.assertEqual(common.parse_region("chrUn_KI270302v1")[:2], ("chrUn_KI270302v1", 0))
+
+    def test_sort_regions(self):
+        regions = [("chr2", 10, 20), ("chr1", 50, 60), ("chr1", 0, 55), ("chrX", 0, 5)]
+        self.assertEqual(
+            common.sort_regions(regions, ["chr1", "chr2"]), [("chr1", 0, 60), ("chr2", 10, 20)]
+        )
+
+    def test_reg2bins(self):
+        self.assertEqual(common.reg2bins(0, 1), [0, 1, 9, 73, 585, 4681])
+        self.assertIn(common.reg2bin(100000, 100200), common.reg2bins(100100, 100101))
+
+    def test_fetch_by_region(self):
+        records = [
+            b"chr1\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n" % (1 + 997 * i) for i in range(2000)
+        ] + self.records[2:]
+        with tempfile.TemporaryDirectory() as tmp:
+            for csi in (False, True):
+                out = os.path.join(tmp, str(csi) + ".vcf.gz")
+                writer = common.VcfWriter(out, csi=csi)
+                writer.write_header(self.header)
+                for rec in records:
+                    writer.write_record(rec)
+                writer.close()
+                fetched = list(
+                    common.fetch_vcf_lines(
+                        out, [("chr2", 0, 10), ("chr1", 500000, 1000000), ("chr1", 900000, 1200000)]
+                    )
+                )
+                expected = [
+                    r for r in records[:-1] if 500000 <= int(r.split(b"\t")[1]) - 1 < 1200000
+                ]
+                self.assertEqual(fetched, expected + records[-1:])
+
+    def test_checkpoint_resume(self):
+        records = [b"chr1\t%d\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n" % (1 + 97 * i) for i in range(3000)]
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ("test.vcf.gz", "test.vcf"):
+                out = os.path.join(tmp, name)
+                checkpoint = common.Checkpoint(out + ".ckpt", {"input": "x"}, interval=0)
+                writer = common.VcfWriter(out)
+                writer.write_header(self.header)
+                for rec in records[:1234]:
+                    writer.write_record(rec)
+                checkpoint.update(writer)
+                for rec in records[1234:2000]:
+                    writer.write_record(rec)
+                writer.out.flush()  # the job dies here, leaving output after the checkpoint
+                state = common.Checkpoint(out + ".ckpt", {"input": "x"}).load()
+                self.assertEqual((state["records"], state["pos"]), (1234, 1 + 97 * 1233))
+                self.assertIsNone(common.Checkpoint(out + ".ckpt", {"input": "y"}).load())
+                writer = common.VcfWriter.resume(out, state["offset"])
+                self.assertEqual((writer.n_records, writer.last_record), (1234, records[1233]))
+                self.assertEqual(writer.header, self.header)
+                for rec in records[1234:]:
+                    writer.write_record(rec)
+                writer.close()
+                self.assertEqual(list(common.open_vcf_lines(out)), self.header + records)
+            self.assertEqual(
+                list(common.fetch_vcf_lines(os.path.join(tmp, "test.vcf.gz"), [("chr1", 0, 1000)])),
+                records[:11],
+            )
+
+    def test_vcf_record(self):
+        rec = common.VcfRecord(b"chr1\t100\trs1\tA\tG\t50\tPASS\tDP=5;DB\tGT:DP\t0/1:3\t1/1:.\n")
+        self.assertEqual((rec.chrom, rec.pos), ("chr1", 100))
+        self.assertEqual(
+            bytes(rec), b"chr1\t100\trs1\tA\tG\t50\tPASS\tDP=5;DB\tGT:DP\t0/1:3\t1/1:.\n"
+        )
+        self.assertEqual(rec.info(), {b"DP": b"5", b"DB": True})
+        self.assertEqual(rec.sample(1), {b"GT": b"1/1", b"DP": b"."})
+        rec.add_info(b"set", b"HC")
+        rec.cols[common.ID] = b"."
+        self.assertEqual(
+            bytes(rec), b"chr1\t100\t.\tA\tG\t50\tPASS\tDP=5;DB;set=HC\tGT:DP\t0/1:3\t1/1:.\n"
+        )
+
+    def test_reader_stages_writer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "in.vcf")
+            with open(fname, "wb") as f:
+                f.write(b"".join(self.header + self.records))
+            reader = common.VcfReader(fname)
+            self.assertEqual(reader.header, self.header[:-1])
+            self.assertEqual(reader.samples, ["s1"])
+
+            def mark(rec):
+                rec.add_info(b"seen", b"1")
+                return rec
+
+            records = common.chain_stages(
+                reader,
+                common.map_stage(lambda rec: rec if rec.chrom == "chr1" else None),
+                common.map_stage(mark),
+            )
+            out = os.path.join(tmp, "out.vcf.gz")
+            writer = common.VcfWriter(out)
+            writer.write_header(reader.header)
+            self.assertEqual(common.write_records(records, writer), 2)
+            writer.close()
+            self.assertEqual(
+                [bytes(rec) for rec in common.VcfReader(out)],
+                [r.replace(b"PASS\t.", b"PASS\tseen=1") for r in self.records[:2]],
+            )
+
+
 ################# BLACK BOX TESTS #################
 
 # class TestScript(unittest.TestCase):